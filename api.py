@@ -1,9 +1,9 @@
 from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
-import pickle
 import uvicorn
 import os
 import logging
@@ -12,8 +12,11 @@ import io
 import traceback
 import asyncio
 
-from client_logic import generate_query, finalize_answer
-from server_logic import preprocess_sender, process_query
+from server_logic import process_query_stream, UnknownContextError
+from sender_store import SenderStateStore
+from jobs import JobManager, QueueFullError, run_intersection
+from query_scheduler import QueryScheduler
+from set_reader import SetReader, SetTooLargeError, read_set_file, resolve_format, TEXT, BINARY
 from data_generator import generate_sets_to_files
 
 # Настраиваем логирование
@@ -32,6 +35,15 @@ app = FastAPI(title="PSI - Private Set Intersection")
 os.makedirs("templates", exist_ok=True)
 os.makedirs("static", exist_ok=True)
 
+# Хранилище предобработанных состояний отправителя
+sender_store = SenderStateStore()
+
+# Пул процессов и очередь задач PSI
+job_manager = JobManager()
+
+# Планировщик запросов получателей: совместная обработка запросов к одному состоянию
+query_scheduler = QueryScheduler()
+
 # Настраиваем статические файлы и шаблоны
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -46,8 +58,32 @@ class SetFileUpload:
         self.sender_file = sender_file
         self.receiver_file = receiver_file
 
-# Максимальный размер файла (в байтах) - 10MB
-MAX_FILE_SIZE = 10 * 1024 * 1024
+# Размер части загружаемого файла при потоковом разборе (в байтах) - 1MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Максимальный размер сериализованного запроса клиента (в байтах) - 64MB
+MAX_QUERY_SIZE = 64 * 1024 * 1024
+
+
+async def read_upload(upload: UploadFile, fmt: str, max_items: int):
+    """Потоковый разбор загруженного файла в массив uint64 без повторов"""
+    reader = SetReader(resolve_format(fmt, upload.filename), max_items)
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        reader.feed(chunk)
+    return reader.finish()
+
+def submit_job(func, *args):
+    """Ставит задачу в очередь; при заполненной очереди возвращает 429"""
+    try:
+        job = job_manager.submit(func, *args)
+    except QueueFullError as e:
+        return JSONResponse(status_code=429, content={"success": False, "error": str(e)})
+    return JSONResponse(status_code=202, content={"success": True, **job.info()})
+
+@app.on_event("shutdown")
+def shutdown_jobs():
+    job_manager.shutdown()
+    query_scheduler.shutdown()
 
 # Главная страница
 @app.get("/", response_class=HTMLResponse)
@@ -65,19 +101,8 @@ async def calculate_intersection(
         sender_set = [int(x.strip()) for x in sender_set.split(",")]
         receiver_set = [int(x.strip()) for x in receiver_set.split(",")]
         
-        # Запускаем PSI-протокол
-        srv_state = preprocess_sender(sender_set)
-        query_bytes, client_state = generate_query(receiver_set)
-        answer_bytes = process_query(pickle.loads(query_bytes), srv_state)
-        intersection = finalize_answer(answer_bytes, client_state)
-        
-        return {
-            "success": True,
-            "sender_size": len(sender_set),
-            "receiver_size": len(receiver_set),
-            "intersection_size": len(intersection),
-            "intersection": list(intersection)
-        }
+        # Ставим PSI-протокол в очередь задач
+        return submit_job(run_intersection, sender_set, receiver_set)
     except Exception as e:
         return {"success": False, "error": str(e)}
 
@@ -86,135 +111,54 @@ async def calculate_intersection(
 async def calculate_intersection_files(
     sender_file: UploadFile = File(...),
     receiver_file: UploadFile = File(...),
-    use_default_files: bool = Form(False)
+    use_default_files: bool = Form(False),
+    file_format: str = Form("auto")
 ):
+    from config import sender_size, sender_max_shards, receiver_size, receiver_max_batches
+    max_sender_size = sender_size * sender_max_shards
+    max_receiver_size = receiver_size * receiver_max_batches
+
     try:
-        # Если указано использовать файлы по умолчанию
-        if use_default_files:
-            logger.info("Используем файлы по умолчанию: sender.txt и receiver.txt")
-            try:
+        # Файлы разбираются по частям сразу в массивы uint64 без повторов;
+        # формат "auto" выбирается по расширению (.bin, .u64 - двоичный little-endian)
+        try:
+            if use_default_files:
+                logger.info("Используем файлы по умолчанию: sender.txt и receiver.txt")
                 # Проверяем, существуют ли файлы
                 if not os.path.exists("sender.txt") or not os.path.exists("receiver.txt"):
                     # Если нет, генерируем их
                     logger.info("Файлы по умолчанию не найдены, генерируем...")
                     generate_sets_to_files()
-                
-                # Читаем файлы
-                with open("sender.txt", "r") as f:
-                    sender_content = f.read().encode()
-                
-                with open("receiver.txt", "r") as f:
-                    receiver_content = f.read().encode()
-                
-                logger.debug(f"Файлы по умолчанию прочитаны: sender.txt ({len(sender_content)} байт), receiver.txt ({len(receiver_content)} байт)")
-            except Exception as e:
-                error_msg = str(e)
-                logger.error(f"Ошибка при чтении файлов по умолчанию: {error_msg}")
-                return JSONResponse(
-                    status_code=500,
-                    content={"success": False, "error": f"Ошибка при чтении файлов по умолчанию: {error_msg}"}
-                )
-        else:
-            # Проверяем размер файлов (если content_length доступен)
-            if sender_file.size and sender_file.size > MAX_FILE_SIZE:
-                return JSONResponse(
-                    status_code=413,
-                    content={"success": False, "error": f"Файл отправителя слишком большой. Максимальный размер: {MAX_FILE_SIZE} байт"}
-                )
-                
-            if receiver_file.size and receiver_file.size > MAX_FILE_SIZE:
-                return JSONResponse(
-                    status_code=413,
-                    content={"success": False, "error": f"Файл получателя слишком большой. Максимальный размер: {MAX_FILE_SIZE} байт"}
-                )
-                
-            # Читаем данные из файлов
-            sender_content = await sender_file.read()
-            receiver_content = await receiver_file.read()
-            
-            # Добавляем отладочную информацию
-            logger.debug(f"Sender file name: {sender_file.filename}, size: {len(sender_content)}")
-            logger.debug(f"Receiver file name: {receiver_file.filename}, size: {len(receiver_content)}")
-            
-            # Проверяем размер файлов
-            if len(sender_content) > MAX_FILE_SIZE or len(receiver_content) > MAX_FILE_SIZE:
-                return JSONResponse(
-                    status_code=413,
-                    content={"success": False, "error": f"Файл слишком большой. Максимальный размер: {MAX_FILE_SIZE} байт"}
-                )
-        
-        # Преобразуем содержимое файлов в списки целых чисел
-        try:
-            sender_set = [int(x.strip()) for x in sender_content.decode().split("\n") if x.strip()]
-            receiver_set = [int(x.strip()) for x in receiver_content.decode().split("\n") if x.strip()]
+                sender_set = read_set_file("sender.txt", max_items=max_sender_size)
+                receiver_set = read_set_file("receiver.txt", max_items=max_receiver_size)
+            else:
+                sender_set = await read_upload(sender_file, file_format, max_sender_size)
+                receiver_set = await read_upload(receiver_file, file_format, max_receiver_size)
+        except SetTooLargeError as e:
+            return JSONResponse(
+                status_code=413,
+                content={"success": False, "error": f"Множество слишком большое: {str(e)}"}
+            )
         except ValueError as e:
             return JSONResponse(
                 status_code=400,
-                content={"success": False, "error": f"Неверный формат данных в файлах. Убедитесь, что файлы содержат только целые числа (по одному в строке): {str(e)}"}
+                content={"success": False, "error": f"Неверный формат данных в файлах. Убедитесь, что файлы содержат только целые неотрицательные числа (по одному в строке) или 64-битные числа little-endian: {str(e)}"}
             )
-        
-        if not sender_set or not receiver_set:
+
+        if not sender_set.size or not receiver_set.size:
             return JSONResponse(
                 status_code=400,
                 content={"success": False, "error": "Один или оба файла пусты или не содержат целых чисел"}
             )
-            
+
         # Добавляем отладочную информацию
-        logger.debug(f"Sender set size: {len(sender_set)}")
-        logger.debug(f"Receiver set size: {len(receiver_set)}")
-        
-        # Добавляем проверку на слишком большие множества
-        if len(sender_set) > 100000 or len(receiver_set) > 100000:
-            return JSONResponse(
-                status_code=413,
-                content={"success": False, "error": "Множества слишком большие. Максимальный размер множества: 100,000 элементов"}
-            )
-        
-        # Дополнительно ограничиваем размер множеств для удобства обработки
-        # Если размеры больше, чем значения в config, ограничиваем их
-        from config import sender_size as max_sender_size, receiver_size as max_receiver_size
-        
-        if len(sender_set) > max_sender_size:
-            logger.warning(f"Ограничиваем размер множества отправителя с {len(sender_set)} до {max_sender_size}")
-            sender_set = sender_set[:max_sender_size]
-            
-        if len(receiver_set) > max_receiver_size:
-            logger.warning(f"Ограничиваем размер множества получателя с {len(receiver_set)} до {max_receiver_size}")
-            receiver_set = receiver_set[:max_receiver_size]
-        
-        # Запускаем PSI-протокол с таймаутом
-        try:
-            # Создаем задачу для вычисления PSI
-            logger.info("Начинаем вычисление PSI-протокола")
-            srv_state = preprocess_sender(sender_set)
-            query_bytes, client_state = generate_query(receiver_set)
-            answer_bytes = process_query(pickle.loads(query_bytes), srv_state)
-            intersection = finalize_answer(answer_bytes, client_state)
-            
-            # Добавляем отладочную информацию
-            logger.info(f"Intersection size: {len(intersection)}")
-            
-            result = {
-                "success": True,
-                "sender_size": len(sender_set),
-                "receiver_size": len(receiver_set),
-                "intersection_size": len(intersection),
-                "intersection": list(intersection)
-            }
-            
-            # Добавляем отладочную информацию
-            logger.info("Result successfully generated")
-            
-            return result
-        
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"Error in PSI computation: {error_msg}")
-            return JSONResponse(
-                status_code=500,
-                content={"success": False, "error": f"Ошибка при вычислении пересечения: {error_msg}"}
-            )
-            
+        logger.debug(f"Sender set size: {sender_set.size}")
+        logger.debug(f"Receiver set size: {receiver_set.size}")
+
+        # Ставим PSI-протокол в очередь задач; таймаут выполнения задает job_timeout
+        logger.info("Начинаем вычисление PSI-протокола")
+        return submit_job(run_intersection, sender_set, receiver_set)
+
     except Exception as e:
         error_msg = str(e)
         logger.error(f"Error in calculate_intersection_files: {error_msg}")
@@ -224,6 +168,22 @@ async def calculate_intersection_files(
             content={"success": False, "error": f"Неожиданная ошибка: {error_msg}"}
         )
 
+# Эндпоинт статуса задачи: результат появляется в поле result после завершения
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"success": False, "error": f"Задача {job_id} не найдена"})
+    return {"success": True, **job.info()}
+
+# Эндпоинт отмены задачи
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"success": False, "error": f"Задача {job_id} не найдена"})
+    return {"success": True, **job.info()}
+
 # Эндпоинт для генерации тестовых множеств
 @app.get("/generate-test-sets")
 async def generate_test_sets():
@@ -241,6 +201,104 @@ async def generate_test_sets():
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+# Эндпоинт отправителя: регистрация множества. Тело запроса - целые числа по одному в строке
+# или, при Content-Type: application/octet-stream, 64-битные числа little-endian
+@app.post("/sender/states")
+async def register_sender_state(request: Request):
+    from config import sender_size, sender_max_shards
+    max_sender_size = sender_size * sender_max_shards
+
+    fmt = BINARY if request.headers.get("content-type", "").startswith("application/octet-stream") else TEXT
+    reader = SetReader(fmt, max_items=max_sender_size)
+    try:
+        async for chunk in request.stream():
+            reader.feed(chunk)
+        sender_set = reader.finish()
+    except SetTooLargeError as e:
+        return JSONResponse(status_code=413, content={"success": False, "error": str(e)})
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "error": f"Неверный формат множества: {str(e)}"}
+        )
+    if not sender_set.size:
+        return JSONResponse(status_code=400, content={"success": False, "error": "Множество пусто"})
+
+    try:
+        state_id = await run_in_threadpool(sender_store.register, sender_set)
+    except Exception as e:
+        logger.error(f"Error in register_sender_state: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": f"Ошибка при предобработке множества: {str(e)}"}
+        )
+
+    return {"success": True, "state_id": state_id, "sender_size": int(sender_set.size)}
+
+# Эндпоинт со сведениями о состояниях отправителя в памяти
+@app.get("/sender/states")
+async def sender_states():
+    return {"success": True, **sender_store.stats(), **query_scheduler.stats()}
+
+def _release_after(chunks):
+    """Передает части потокового ответа и освобождает место в очереди планировщика"""
+    try:
+        yield from chunks
+    finally:
+        query_scheduler.release_stream()
+
+
+# Эндпоинт получателя: сериализованный запрос для состояния отправителя -> сериализованный ответ
+# (одновременные запросы к одному состоянию объединяет планировщик; stream=true - ответ передается
+# по частям по мере вычисления шифротекстов, без объединения, но в пределах той же очереди)
+@app.post("/sender/states/{state_id}/query")
+async def query_sender_state(state_id: str, request: Request, stream: bool = False):
+    query_bytes = await request.body()
+    if len(query_bytes) > MAX_QUERY_SIZE:
+        return JSONResponse(
+            status_code=413,
+            content={"success": False, "error": f"Запрос слишком большой. Максимальный размер: {MAX_QUERY_SIZE} байт"}
+        )
+
+    srv_state = None
+    if sender_store.is_valid_id(state_id):
+        srv_state = await run_in_threadpool(sender_store.get, state_id)
+    if srv_state is None:
+        return JSONResponse(
+            status_code=404,
+            content={"success": False, "error": f"Состояние отправителя {state_id} не найдено"}
+        )
+
+    try:
+        if stream:
+            # Потоковый запрос занимает место в очереди планировщика до конца передачи ответа;
+            # запрос проверяется сразу, ошибки возникают до начала ответа
+            query_scheduler.acquire_stream()
+            try:
+                answer = _release_after(await run_in_threadpool(process_query_stream, query_bytes, srv_state))
+            except BaseException:
+                query_scheduler.release_stream()
+                raise
+        else:
+            answer = await asyncio.wrap_future(query_scheduler.submit(state_id, srv_state, query_bytes))
+    except QueueFullError as e:
+        return JSONResponse(status_code=429, content={"success": False, "error": str(e)})
+    except UnknownContextError as e:
+        # Клиент повторяет запрос с полным контекстом
+        return JSONResponse(status_code=409, content={"success": False, "error": str(e), "unknown_context": True})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
+    except Exception as e:
+        logger.error(f"Error in query_sender_state: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": f"Ошибка при обработке запроса: {str(e)}"}
+        )
+
+    if stream:
+        return StreamingResponse(answer, media_type="application/octet-stream")
+    return Response(content=answer, media_type="application/octet-stream")
+
 # Запуск сервера
 if __name__ == "__main__":
     uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
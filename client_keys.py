@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+import tenseal as ts
+
+from config import poly_modulus_degree, plain_modulus, key_max_queries, key_max_age
+from wire_format import context_fingerprint
+
+logger = logging.getLogger("psi_api")
+
+
+def create_keys() -> dict:
+    """
+    Создает контекст BFV с новыми ключами и сериализует его публичную часть.
+    :return: {"priv_ctx", "public_ctx", "fingerprint", "known", "queries", "created"}
+    """
+    private_ctx = ts.context(
+        ts.SCHEME_TYPE.BFV,
+        poly_modulus_degree=poly_modulus_degree,
+        plain_modulus=plain_modulus
+    )
+    # Ключи Галуа серверу не нужны: вычисление идет только по слотам, без вращений
+    public_ctx = private_ctx.serialize(save_secret_key=False, save_galois_keys=False)
+    return {
+        "priv_ctx": private_ctx,
+        "public_ctx": public_ctx,
+        "fingerprint": context_fingerprint(public_ctx),
+        # Известен ли публичный контекст серверу (тогда в запросе передается только отпечаток)
+        "known": False,
+        "queries": 0,
+        "created": time.monotonic(),
+    }
+
+
+class KeyManager:
+    """
+    Ключи клиента, переиспользуемые между запросами.
+
+    Генерация ключей BFV и передача публичного контекста (основная часть размера
+    запроса) выполняются один раз на набор ключей. После того как сервер обработал
+    запрос с контекстом, следующие запросы передают только его отпечаток. Ключи
+    заменяются новыми после max_queries запросов или по истечении max_age секунд.
+    """
+
+    def __init__(self, max_queries: int = key_max_queries, max_age: float = key_max_age):
+        """
+        :param max_queries: количество запросов на один набор ключей (None - без ограничения)
+        :param max_age: время жизни набора ключей в секундах (None - без ограничения)
+        """
+        self.max_queries = max_queries
+        self.max_age = max_age
+        self._keys = None
+        self._lock = threading.Lock()
+
+    def _expired(self, keys) -> bool:
+        if self.max_queries is not None and keys["queries"] >= self.max_queries:
+            return True
+        return self.max_age is not None and time.monotonic() - keys["created"] > self.max_age
+
+    def acquire(self) -> dict:
+        """
+        Возвращает набор ключей для очередного запроса, при необходимости создавая новый.
+        """
+        with self._lock:
+            if self._keys is None or self._expired(self._keys):
+                self._keys = create_keys()
+                logger.info(f"Созданы ключи клиента {self._keys['fingerprint'].hex()[:12]}")
+            self._keys["queries"] += 1
+            return self._keys
+
+    def rotate(self):
+        """Принудительно заменяет ключи при следующем запросе"""
+        with self._lock:
+            self._keys = None
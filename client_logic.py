@@ -1,91 +1,266 @@
+from concurrent.futures import ProcessPoolExecutor
+
 from config import hash_seeds, output_bits, sigma_max, alpha, plain_modulus, \
-    number_of_hashes, poly_modulus_degree, ell
+    number_of_hashes, receiver_size, receiver_max_batches, client_workers, slot_segments
+import numpy as np
 import tenseal as ts
+import tenseal.sealapi as sealapi
 
-from utils import windowing
+from utils import query_exponents, pow_mod_batch
+from seal_io import decrypt_vectors, encode_vector, save_bytes
+from wire_format import protocol_params, check_params, encode_query, decode_query, decode_answer, \
+    AnswerReader
+from client_keys import create_keys
 from math import log2
-from hashing import CuckooHash, bin_capacity
-import pickle
+from hashing import CuckooHash, get_bin_capacity
+
 
+def build_cuckoo_tables(receiver_set, batch_size: int = receiver_size):
+    """
+    Разбивает множество получателя на таблицы кукушки (пакеты запроса).
+    Каждая таблица строится из batch_size очередных элементов; элементы из stash
+    переносятся в следующую таблицу, поэтому ни один элемент не теряется.
+    :param receiver_set: множество получателя
+    :param batch_size: количество новых элементов на таблицу
+    :return: список заполненных CuckooHash
+    """
+    pending = np.unique(np.asarray(receiver_set, dtype=np.uint64))
+    tables = []
+    while pending.size:
+        table = CuckooHash(hash_seeds, output_bits).build(pending[:batch_size])
+        tables.append(table)
+        pending = np.concatenate([np.array(table.stash, dtype=np.uint64), pending[batch_size:]])
+    return tables
 
-def generate_query(receiver_set):
-    """Генерация запроса на основе множества получателя"""
-    # Параметры оконного метода
-    base = 2 ** ell
-    minibin_capacity = bin_capacity // alpha
-    logB_ell = int(log2(minibin_capacity) / ell) + 1
 
-    # Инициализируем и заполняем хеш-таблицу Кукушки
-    cuckoo_hash = CuckooHash(hash_seeds, output_bits)
-    for item in receiver_set:
-        cuckoo_hash.insert(item)
+def generate_query(receiver_set, key_manager=None):
+    """
+    Генерация запроса на основе множества получателя.
+    :param receiver_set: множество получателя
+    :param key_manager: KeyManager для переиспользования ключей между запросами
+                        (None - новые ключи для каждого запроса)
+    :return: (запрос, состояние клиента)
+    :raises ValueError: если множество получателя пусто или требует больше receiver_max_batches таблиц
+    """
+    minibin_capacity = get_bin_capacity() // alpha
+
+    # Инициализируем и заполняем таблицы кукушки: по одной на каждые receiver_size элементов
+    cuckoo_tables = build_cuckoo_tables(receiver_set)
+    if not cuckoo_tables:
+        # Запрос без пакетов недопустим в формате сообщений: отклоняем до генерации ключей и шифрования
+        raise ValueError("Множество получателя пусто")
+    if len(cuckoo_tables) > receiver_max_batches:
+        raise ValueError(
+            f'Множество получателя требует {len(cuckoo_tables)} таблиц кукушки, '
+            f'допускается не больше {receiver_max_batches}'
+        )
 
     # Значение для заполнения пустых ячеек
     dummy_value = 2 ** (sigma_max - output_bits + (int(log2(number_of_hashes)) + 1))
 
-    # Заполняем пустые ячейки фиктивными значениями
-    for i in range(cuckoo_hash.num_bins):
-        if cuckoo_hash.data[i] is None:
-            cuckoo_hash.data[i] = dummy_value
+    # Контекст для гомоморфного шифрования: новый или переиспользуемый
+    keys = create_keys() if key_manager is None else key_manager.acquire()
+    private_ctx = keys["priv_ctx"]
 
-    # Применяем оконный метод к элементам хештаблицы
-    client_windows = [
-        windowing(item, minibin_capacity, plain_modulus)
-        for item in cuckoo_hash.data
-    ]
+    seal_context = private_ctx.seal_context().data
+    encoder = sealapi.BatchEncoder(seal_context)
+    # Запрос шифруется секретным ключом: симметричный шифротекст хранит вторую половину
+    # как seed генератора и сериализуется вдвое компактнее
+    encryptor = sealapi.Encryptor(seal_context, private_ctx.secret_key().data)
+    exponents = query_exponents(minibin_capacity)
 
-    # Создаем контекст для гомоморфного шифрования
-    private_ctx = ts.context(
-        ts.SCHEME_TYPE.BFV,
-        poly_modulus_degree=poly_modulus_degree,
-        plain_modulus=plain_modulus
-    )
-    public_ctx_serial = private_ctx.serialize(save_secret_key=False)
-
-    # Матрица для хранения зашифрованных значений
-    enc_query = [[None for _ in range(logB_ell)] for _ in range(base - 1)]
-    plain_vec = [0] * cuckoo_hash.num_bins 
-
-    # Шифруем каждый элемент после применения оконного метода
-    for j in range(logB_ell):
-        for i in range(base - 1):
-            if (i + 1) * (base ** j) - 1 < minibin_capacity:
-                for k in range(cuckoo_hash.num_bins):
-                    plain_vec[k] = client_windows[k][i][j]
-                enc_query[i][j] = ts.bfv_vector(private_ctx, plain_vec).serialize()
-
-    # Сериализуем запрос
-    query_bytes = pickle.dumps((public_ctx_serial, enc_query))
+    enc_batches = []
+    for cuckoo_hash in cuckoo_tables:
+        # Заполняем пустые ячейки фиктивными значениями
+        cuckoo_hash.data[cuckoo_hash.data == CuckooHash.EMPTY] = dummy_value
+
+        # Применяем оконный метод ко всем ячейкам сразу: строка - степень y из query_exponents.
+        # Таблица повторяется в каждом сегменте слотов: сервер упаковывает в сегменты разные блоки
+        client_windows = np.tile(pow_mod_batch(cuckoo_hash.data, exponents, plain_modulus), (1, slot_segments))
+
+        # Шифруем каждую степень по всем корзинам
+        enc_query = []
+        for window in client_windows:
+            enc_query.append(save_bytes(encryptor.encrypt_symmetric(encode_vector(encoder, window))))
+        enc_batches.append(enc_query)
+
+    # Сериализуем запрос: контекст, известный серверу, заменяется отпечатком
+    query_bytes = encode_query(protocol_params(minibin_capacity), exponents, keys["fingerprint"],
+                               None if keys["known"] else keys["public_ctx"], enc_batches)
 
     # Сохраняем состояние клиента для последующей обработки ответа
     client_state = {
         "priv_ctx": private_ctx,
-        "cuckoo_hash": cuckoo_hash,
-        "client_windows": client_windows,
+        "keys": keys,
+        "cuckoo_tables": cuckoo_tables,
         "receiver_set": receiver_set,
     }
 
     return query_bytes, client_state
 
 
-def finalize_answer(answer_bytes, client_state):
-    """Обработка ответа от сервера и формирование пересечения множеств"""
+def attach_context(query_bytes, client_state):
+    """
+    Повторно кодирует запрос с полным публичным контекстом, если сервер не знает
+    его отпечаток (например, вытеснил из кеша). Шифротексты не пересчитываются.
+    """
+    keys = client_state["keys"]
+    keys["known"] = False
+    query = decode_query(query_bytes)
+    return encode_query(query["params"], query["exponents"], keys["fingerprint"], keys["public_ctx"],
+                        query["batches"])
+
+
+_executors = {}
+
+
+def _get_executor(workers):
+    """Пул процессов для расшифровки (создается один раз на процесс)"""
+    if workers not in _executors:
+        _executors[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _executors[workers]
+
+
+def _decrypt_range(private_ctx_ser, ciphertexts, size):
+    """Исполнитель пула: расшифровка части шифротекстов ответа"""
+    return decrypt_vectors(ts.context_from(private_ctx_ser), ciphertexts, size)
+
+
+def _decrypt_all(private_ctx, ciphertexts, size, workers):
+    """
+    Расшифровывает шифротексты ответа, при workers > 1 - частями в пуле процессов
+    (TenSEAL удерживает GIL). Приватный контекст сериализуется один раз на ответ.
+    :return: массив np.uint64 формы (количество шифротекстов, size)
+    """
+    if workers <= 1 or len(ciphertexts) < 2:
+        return decrypt_vectors(private_ctx, ciphertexts, size)
+    private_ctx_ser = private_ctx.serialize(save_secret_key=True, save_galois_keys=False)
+    chunk = -(-len(ciphertexts) // workers)
+    executor = _get_executor(workers)
+    futures = [
+        executor.submit(_decrypt_range, private_ctx_ser, [bytes(ct) for ct in ciphertexts[i:i + chunk]], size)
+        for i in range(0, len(ciphertexts), chunk)
+    ]
+    return np.concatenate([future.result() for future in futures])
+
+
+def finalize_answer(answer_bytes, client_state, workers: int = client_workers):
+    """
+    Обработка ответа от сервера и формирование пересечения множеств.
+    Нули ищутся сразу по всем блокам пакета, а элементы берутся из таблицы кукушки
+    по номеру корзины без повторного хеширования.
+    :param answer_bytes: ответ сервера
+    :param client_state: состояние клиента из generate_query
+    :param workers: количество процессов для расшифровки
+    """
     private_ctx = client_state["priv_ctx"]
-    cuckoo_hash = client_state["cuckoo_hash"]
+    cuckoo_tables = client_state["cuckoo_tables"]
+
+    # Разбираем ответ сервера: по одному набору шифротекстов на таблицу кукушки
+    server_answer = decode_answer(answer_bytes)
+    check_params(server_answer["params"], protocol_params(get_bin_capacity() // alpha))
+    if len(server_answer["batches"]) != len(cuckoo_tables):
+        raise ValueError("Количество пакетов в ответе не совпадает с количеством таблиц кукушки")
 
-    # Десериализуем и расшифровываем ответ сервера
-    server_answer = pickle.loads(answer_bytes)
-    decrypted = [ts.bfv_vector_from(private_ctx, ct).decrypt() for ct in server_answer]
+    num_bins = cuckoo_tables[0].num_bins
+    ciphertexts = [ct for batch in server_answer["batches"] for ct in batch]
+    per_batch = len(ciphertexts) // len(cuckoo_tables)
+    if per_batch % -(-alpha // slot_segments):
+        raise ValueError("Количество шифротекстов пакета не кратно количеству групп блоков")
+    decrypted = _decrypt_all(private_ctx, ciphertexts, num_bins * slot_segments, workers)
+    decrypted = decrypted.reshape(len(ciphertexts), slot_segments, num_bins)
+
+    # Корзина входит в пересечение, если хотя бы один блок дал ноль
+    valid = _segment_mask(np.arange(per_batch))
+    zeros = np.stack([((decrypted[i * per_batch:(i + 1) * per_batch] == 0) & valid).any(axis=(0, 1))
+                      for i in range(len(cuckoo_tables))])
+    return _collect_intersection(zeros, client_state)
+
+
+def finalize_answer_stream(chunks, client_state, workers: int = client_workers):
+    """
+    Обработка ответа сервера, получаемого по частям (process_query_stream): шифротексты
+    расшифровываются по мере поступления, поэтому расшифровка идет параллельно с вычислением
+    и передачей остальных блоков на сервере. При workers > 1 поступившие шифротексты
+    передаются в пул процессов частями по ceil(количество / workers), и чтение ответа
+    продолжается, пока они расшифровываются.
+    :param chunks: итерируемая последовательность частей ответа (bytes)
+    :param client_state: состояние клиента из generate_query
+    :param workers: количество процессов для расшифровки
+    :return: пересечение множеств
+    """
+    private_ctx = client_state["priv_ctx"]
+    cuckoo_tables = client_state["cuckoo_tables"]
+    num_bins = cuckoo_tables[0].num_bins
+    size = num_bins * slot_segments
+    reader = AnswerReader()
+    zeros = None
+    buffered = []
+    pending = []
+    private_ctx_ser = None
+    chunk_blocks = 1
 
-    # Извлекаем нулевые значения и восстанавливаем элементы пересечения
+    def mark(blocks, decrypted):
+        batch_idx, block_idx, _ = zip(*blocks)
+        decrypted = decrypted.reshape(len(blocks), slot_segments, num_bins)
+        hits = ((decrypted == 0) & _segment_mask(np.array(block_idx))).any(axis=1)
+        np.logical_or.at(zeros, np.array(batch_idx), hits)
+
+    def submit(blocks):
+        ciphertexts = [bytes(ct) for _, _, ct in blocks]
+        pending.append((blocks, _get_executor(workers).submit(_decrypt_range, private_ctx_ser, ciphertexts, size)))
+
+    for chunk in chunks:
+        blocks = reader.feed(chunk)
+        if zeros is None and reader.params is not None:
+            # Заголовок получен: проверяем параметры до расшифровки первого блока
+            check_params(reader.params, protocol_params(get_bin_capacity() // alpha))
+            if reader.batches != len(cuckoo_tables):
+                raise ValueError("Количество пакетов в ответе не совпадает с количеством таблиц кукушки")
+            if (reader.count // reader.batches) % -(-alpha // slot_segments):
+                raise ValueError("Количество шифротекстов пакета не кратно количеству групп блоков")
+            zeros = np.zeros((len(cuckoo_tables), num_bins), dtype=bool)
+            if workers > 1 and reader.count > 1:
+                private_ctx_ser = private_ctx.serialize(save_secret_key=True, save_galois_keys=False)
+                chunk_blocks = -(-reader.count // workers)
+        if not blocks:
+            continue
+        if private_ctx_ser is None:
+            mark(blocks, decrypt_vectors(private_ctx, [ct for _, _, ct in blocks], size))
+            continue
+        buffered.extend(blocks)
+        while len(buffered) >= chunk_blocks:
+            submit(buffered[:chunk_blocks])
+            del buffered[:chunk_blocks]
+    reader.finish()
+    if buffered:
+        submit(buffered)
+    for blocks, future in pending:
+        mark(blocks, future.result())
+    return _collect_intersection(zeros, client_state)
+
+
+def _segment_mask(indices):
+    """
+    Маска сегментов слотов, содержащих блоки alpha, для шифротекстов с номерами indices в пакете:
+    сегменты последней группы шарда за пределами alpha не содержат блоков.
+    :return: массив bool формы (len(indices), slot_segments, 1)
+    """
+    groups = -(-alpha // slot_segments)
+    blocks = (indices % groups)[:, None] * slot_segments + np.arange(slot_segments)
+    return (blocks < alpha)[:, :, None]
+
+
+def _collect_intersection(zeros, client_state):
+    """
+    Элементы пересечения по корзинам с нулями: берутся из таблиц кукушки по номеру корзины
+    без повторного хеширования, фиктивные ячейки отбрасываются.
+    :param zeros: массив bool формы (количество таблиц кукушки, количество корзин)
+    """
     intersection = set()
-    for block_idx, plain_vec in enumerate(decrypted):
-        for bin_idx, val in enumerate(plain_vec):
-            if val == 0:
-                # Восстанавливаем исходный элемент из хеш-значения
-                packed = cuckoo_hash.data[bin_idx]
-                seed_idx = cuckoo_hash._extract_index(packed)
-                item = cuckoo_hash._reconstruct_item(packed, bin_idx, cuckoo_hash.hash_seeds[seed_idx])
-                intersection.add(item)
-                
-    return intersection
\ No newline at end of file
+    for cuckoo_hash, bin_zeros in zip(client_state["cuckoo_tables"], zeros):
+        intersection.update(cuckoo_hash.items[bin_zeros & cuckoo_hash.occupied].tolist())
+
+    # Сервер обработал запрос, значит контекст у него в кеше: дальше достаточно отпечатка
+    client_state["keys"]["known"] = True
+    return intersection
@@ -11,16 +11,45 @@ with open(config_path, 'r') as file:
 
 # Загрузка параметров из YAML
 sender_size = config['sender_size']
+sender_max_shards = config['sender_max_shards']
 receiver_size = config['receiver_size']
+receiver_max_batches = config['receiver_max_batches']
 intersection_size = config['intersection_size']
 hash_seeds = config['hash_seeds']
 output_bits = config['output_bits']
+bin_security_bits = config['bin_security_bits']
 plain_modulus = config['plain_modulus']
 poly_modulus_degree = config['poly_modulus_degree']
 alpha = config['alpha']
 ell = config['ell']
+slot_packing = config['slot_packing']
+evaluation_mode = config['evaluation_mode']
+ps_low_degree = config['ps_low_degree']
+sender_workers = config['sender_workers']
+server_workers = config['server_workers']
+client_workers = config['client_workers']
+wire_compression = config['wire_compression']
+key_max_queries = config['key_max_queries']
+key_max_age = config['key_max_age']
+tenseal_threads = config['tenseal_threads']
+answer_noise_margin = config['answer_noise_margin']
+plaintext_cache_size = config['plaintext_cache_size']
+context_cache_size = config['context_cache_size']
+query_batch_window = config['query_batch_window']
+query_batch_size = config['query_batch_size']
+query_workers = config['query_workers']
+query_queue_size = config['query_queue_size']
+state_dir = os.path.join(os.path.dirname(__file__), config['state_dir'])
+state_cache_size = config['state_cache_size']
+state_cache_bytes = config['state_cache_bytes']
+job_workers = config['job_workers']
+job_queue_size = config['job_queue_size']
+job_timeout = config['job_timeout']
+job_result_ttl = config['job_result_ttl']
 
 # Вычисляемые параметры
 number_of_hashes = len(hash_seeds)
 mask_of_power_of_2 = 2 ** output_bits - 1
-sigma_max = int(log2(plain_modulus)) + output_bits - (int(log2(number_of_hashes)) + 1)
\ No newline at end of file
+sigma_max = int(log2(plain_modulus)) + output_bits - (int(log2(number_of_hashes)) + 1)
+# Количество блоков alpha в одном шифротексте (сегментов слотов по 2 ** output_bits)
+slot_segments = max(1, poly_modulus_degree >> output_bits) if slot_packing else 1
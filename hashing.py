@@ -1,14 +1,19 @@
+import json
+import os
 import random
-from random import randint
+import tempfile
+import time
+from functools import lru_cache
 
 import mmh3
+import numpy as np
 
 import logging
 
 import math
-from math import log2, comb, ceil
+from math import log2, ceil
 
-from config import output_bits, number_of_hashes, sender_size
+from config import output_bits, number_of_hashes, sender_size, state_dir, bin_security_bits
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -21,31 +26,129 @@ logging.basicConfig(
 logger = logging.getLogger("psi_api")
 
 
-def calculate_bin_capacity(security_bits: int = 30) -> int:
+def calculate_bin_capacity(security_bits: int = 30, output_bits: int = output_bits,
+                           number_of_hashes: int = number_of_hashes, sender_size: int = sender_size) -> int:
     """
     Вычисляет bin_capacity на основе параметров безопасности и конфигурации хеширования.
 
+    Загрузка корзины - биномиальная величина X ~ Bin(d, 1/m), d = number_of_hashes * sender_size,
+    m = 2^output_bits. Ищется наименьшее i, при котором m * P(X > i) <= 2^-security_bits.
+    Хвост считается в логарифмах (lgamma и logaddexp), без точных больших чисел.
+
     :param security_bits: Требуемый уровень безопасности (по умолчанию 2^-30).
     :return: Значение bin_capacity.
     """
     m = 2 ** output_bits
     d = number_of_hashes * sender_size
+    log_p, log_q = -output_bits * math.log(2), math.log1p(-1 / m)
+    log_d_factorial = math.lgamma(d + 1)
 
-    md_1 = m ** (d - 1)
-    s = 0
-    S = m ** d
-    i = 0
-    power_of_m_1 = (m - 1) ** d
-    while True:
-        current_term = comb(d, i) * power_of_m_1
-        s += current_term
-        S -= current_term
-        if int(log2(md_1) - log2(S)) >= security_bits:
+    # Логарифмы вероятностей P(X = j) до j, за которым хвост заведомо пренебрежимо мал
+    threshold = -(security_bits + output_bits + 64) * math.log(2)
+    log_pmf = []
+    for j in range(d + 1):
+        log_pmf.append(log_d_factorial - math.lgamma(j + 1) - math.lgamma(d - j + 1)
+                       + j * log_p + (d - j) * log_q)
+        if j > d / m and log_pmf[-1] < threshold:
             break
-        i += 1
-        power_of_m_1 //= (m - 1)
 
-    return i - 1
+    # log P(X > i) для всех i: накопленный logaddexp с конца
+    log_tail = np.logaddexp.accumulate(np.array(log_pmf[::-1]))[::-1]
+    for i in range(len(log_pmf) - 1):
+        if -log_tail[i + 1] / math.log(2) - output_bits >= security_bits:
+            return i - 1
+    return len(log_pmf) - 2
+
+
+def _bin_capacity_cache_path() -> str:
+    return os.path.join(state_dir, "bin_capacity.json")
+
+
+@lru_cache(maxsize=None)
+def get_bin_capacity(security_bits: int = bin_security_bits) -> int:
+    """
+    bin_capacity для текущей конфигурации. Вычисляется при первом обращении, а не при импорте,
+    и сохраняется в файл state_dir/bin_capacity.json с ключом
+    (output_bits, number_of_hashes, sender_size, security_bits).
+    :param security_bits: Требуемый уровень безопасности (по умолчанию bin_security_bits из config.yaml).
+    """
+    key = f"{output_bits},{number_of_hashes},{sender_size},{security_bits}"
+    path = _bin_capacity_cache_path()
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if key in cache:
+        return cache[key]
+
+    value = calculate_bin_capacity(security_bits)
+    cache[key] = value
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить bin_capacity в {path}: {e}")
+    return value
+
+
+# Константы MurmurHash3_x86_32
+_MURMUR_C1 = np.uint32(0xcc9e2d51)
+_MURMUR_C2 = np.uint32(0x1b873593)
+
+
+def _rotl32(x: np.ndarray, r: int) -> np.ndarray:
+    """Циклический сдвиг влево массива uint32."""
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+
+def murmur3_32_batch(values, seed: int) -> np.ndarray:
+    """
+    Векторизованный аналог mmh3.hash(str(value), seed, signed=False) для массива чисел.
+
+    Числа кодируются десятичной строкой фиксированной ширины (20 байт, дополнение нулями),
+    после чего все блоки по 4 байта обрабатываются за один проход по массиву.
+    :param values: массив неотрицательных 64-битных чисел
+    :param seed: сид хеш-функции
+    :return: массив uint32 значений хеша
+    """
+    digits = np.asarray(values, dtype=np.uint64).ravel().astype('S20')
+    lengths = np.char.str_len(digits)
+    words = digits.view('<u4').reshape(-1, 5)
+    nblocks = lengths // 4
+
+    h = np.full(digits.size, seed, dtype=np.uint32)
+    for block in range(words.shape[1]):
+        k = _rotl32(words[:, block] * _MURMUR_C1, 15) * _MURMUR_C2
+        mixed = _rotl32(h ^ k, 13) * np.uint32(5) + np.uint32(0xe6546b64)
+        # Полные блоки перемешиваются полностью, хвост (дополненный нулями) только через xor
+        h = np.where(block < nblocks, mixed, np.where(block == nblocks, h ^ k, h))
+
+    h ^= lengths.astype(np.uint32)
+    h ^= h >> np.uint32(16)
+    h *= np.uint32(0x85ebca6b)
+    h ^= h >> np.uint32(13)
+    h *= np.uint32(0xc2b2ae35)
+    h ^= h >> np.uint32(16)
+    return h
+
+
+def hash_locations(items, seed: int, output_bits: int) -> np.ndarray:
+    """
+    Векторизованный расчет корзин для массива элементов (аналог _location).
+    :param items: массив неотрицательных 64-битных элементов
+    :param seed: сид хеш-функции
+    :param output_bits: количество бит индекса корзины
+    :return: массив индексов корзин (int64)
+    """
+    items = np.asarray(items, dtype=np.uint64).ravel()
+    item_left = items >> np.uint64(output_bits)
+    item_right = items & np.uint64((1 << output_bits) - 1)
+    hash_left = murmur3_32_batch(item_left, seed) >> np.uint32(32 - output_bits)
+    return (hash_left.astype(np.uint64) ^ item_right).astype(np.int64)
 
 
 class SimpleHash:
@@ -60,8 +163,9 @@ class SimpleHash:
         self.hash_seeds = hash_seed_list
         self.num_bins = 2 ** output_bits
         self.mask = (1 << output_bits) - 1
-        self.hashed_data = [[None for _ in range(bin_capacity)] for _ in range(self.num_bins)]
-        self.occurrences = [0] * self.num_bins
+        # Таблица фиксированной ширины: значимы только первые occurrences[i] ячеек корзины i
+        self.hashed_data = np.zeros((self.num_bins, bin_capacity), dtype=np.int64)
+        self.occurrences = np.zeros(self.num_bins, dtype=np.int64)
         self.failed = False
 
     def _combine_left_and_index(self, item: int, index: int) -> int:
@@ -108,13 +212,61 @@ class SimpleHash:
             self.failed = True
             logger.critical('Ошибка: превышена ёмкость корзины. Хеширование остановлено.')
 
+    def locate_many(self, items):
+        """
+        Векторизованный аналог _location и _combine_left_and_index для всех хеш-функций.
+        :param items: последовательность неотрицательных 64-битных элементов
+        :return: (корзины, закодированные значения) - массивы формы (len(items), число хеш-функций)
+        """
+        items = np.asarray(items, dtype=np.uint64).ravel()
+        num_hashes = len(self.hash_seeds)
+        locations = np.empty((items.size, num_hashes), dtype=np.int64)
+        for h_idx, seed in enumerate(self.hash_seeds):
+            locations[:, h_idx] = hash_locations(items, seed, self.output_bits)
+        item_left = (items >> np.uint64(self.output_bits)).astype(np.int64)
+        encoded = (item_left << self._log_num_hashes())[:, None] + np.arange(num_hashes)
+        return locations, encoded
+
+    def insert_many(self, items):
+        """
+        Пакетная вставка элементов всеми хеш-функциями.
+
+        Раскладка корзин совпадает с последовательными вызовами insert(item, h_idx)
+        для каждого item и каждого h_idx по порядку.
+        :param items: последовательность неотрицательных 64-битных элементов
+        """
+        locations, encoded = self.locate_many(items)
+        locations = locations.ravel()
+        encoded = encoded.ravel()
+
+        # Стабильная сортировка по корзине сохраняет порядок вставки внутри корзины
+        order = np.argsort(locations, kind='stable')
+        sorted_locations = locations[order]
+        counts = np.bincount(locations, minlength=self.num_bins)
+        starts = np.cumsum(counts) - counts
+        positions = (self.occurrences[sorted_locations]
+                     + np.arange(order.size) - starts[sorted_locations])
+
+        fits = positions < self.bin_capacity
+        self.hashed_data[sorted_locations[fits], positions[fits]] = encoded[order[fits]]
+        self.occurrences = np.minimum(self.occurrences + counts, self.bin_capacity)
+
+        if not fits.all():
+            self.failed = True
+            logger.critical(f'Ошибка: превышена ёмкость корзины, не вставлено элементов: '
+                            f'{int(np.count_nonzero(~fits))}.')
+
 
 class CuckooHash:
-    def __init__(self, hash_seeds, output_bits: int):
+    # Значение пустой ячейки таблицы
+    EMPTY = -1
+
+    def __init__(self, hash_seeds, output_bits: int, stash_size: int = 4, max_attempts: int = 8):
         """
         :param hash_seeds: список сидов для хеш-функций
         :param output_bits: количество бит (2^output_bits корзин)
-        :param num_hashes: количество используемых хеш-функций
+        :param stash_size: максимальное количество элементов, не поместившихся в таблицу
+        :param max_attempts: количество попыток построения таблицы в build
         """
         self.hash_seeds = hash_seeds
         self.output_bits = output_bits
@@ -122,11 +274,17 @@ class CuckooHash:
         self.num_bins = 2 ** output_bits
         self.mask = (1 << output_bits) - 1
         self.log_num_hashes = math.ceil(math.log2(self.num_hashes))
-        self.data = [None] * self.num_bins
+        self.data = np.full(self.num_bins, self.EMPTY, dtype=np.int64)
+        # Исходный элемент каждой корзины (значим там, где occupied) - для восстановления без хеширования
+        self.items = np.zeros(self.num_bins, dtype=np.uint64)
+        self.occupied = np.zeros(self.num_bins, dtype=bool)
         self.recursion_limit = int(8 * math.log2(self.num_bins))
-        self.insert_index = randint(0, self.num_hashes - 1)
-        self.depth = 0
+        self.stash_size = stash_size
+        self.max_attempts = max_attempts
+        self.stash = []
+        self.stats = {}
         self.failed = False
+        self._rng = random.Random(0)
 
     def _hash_location(self, seed, item):
         item_left = item >> self.output_bits
@@ -147,35 +305,137 @@ class CuckooHash:
         item_right = hashed_left ^ location
         return (item_left << self.output_bits) + item_right
 
-    def _random_index_excluding(self, bound, exclude):
-        value = randint(0, bound - 1)
-        while value == exclude:
-            value = randint(0, bound - 1)
-        return value
+    def _random_index_excluding(self, rng, exclude):
+        if self.num_hashes == 1:
+            return 0
+        value = rng.randrange(self.num_hashes - 1)
+        return value + 1 if value >= exclude else value
 
     def insert(self, item: int):
         """
-        Вставляет элемент в таблицу кукушки
+        Вставляет элемент в таблицу кукушки итеративным вытеснением.
+        Элемент, для которого не нашлось места, попадает в stash.
         :param item: число
         """
-        loc = self._hash_location(self.hash_seeds[self.insert_index], item)
-        current_value = self.data[loc]
-        self.data[loc] = self._combine_left_and_index(item, self.insert_index)
+        item = int(item)
+        excluded = None
+        for _ in range(self.recursion_limit + 1):
+            locations = [self._hash_location(seed, item) for seed in self.hash_seeds]
+            free = [h for h, loc in enumerate(locations) if self.data[loc] == self.EMPTY]
+            if free:
+                self.data[locations[free[0]]] = self._combine_left_and_index(item, free[0])
+                self.items[locations[free[0]]] = item
+                self.occupied[locations[free[0]]] = True
+                return
+            index = self._rng.randrange(self.num_hashes) if excluded is None \
+                else self._random_index_excluding(self._rng, excluded)
+            loc = locations[index]
+            current_value = int(self.data[loc])
+            self.data[loc] = self._combine_left_and_index(item, index)
+            self.items[loc] = item
+            excluded = self._extract_index(current_value)
+            item = self._reconstruct_item(current_value, loc, self.hash_seeds[excluded])
 
-        if current_value is None:
-            self.insert_index = randint(0, self.num_hashes - 1)
-            self.depth = 0
-        else:
-            old_index = self._extract_index(current_value)
-            self.insert_index = self._random_index_excluding(self.num_hashes, old_index)
-
-            if self.depth < self.recursion_limit:
-                self.depth += 1
-                kicked_item = self._reconstruct_item(
-                    current_value, loc, self.hash_seeds[old_index]
-                )
-                self.insert(kicked_item)
+        self.stash.append(item)
+        if len(self.stash) > self.stash_size:
+            self.failed = True
+
+    def _build_attempt(self, candidates, attempt):
+        """
+        Одна попытка размещения всех элементов с детерминированным генератором вытеснений.
+        :param candidates: список кандидатных корзин для каждого элемента
+        :param attempt: номер попытки (сид генератора)
+        :return: (ячейки с индексами элементов, индексы хеш-функций, stash, вытеснения, длиннейшая цепочка)
+        """
+        rng = random.Random(attempt)
+        slots = [-1] * self.num_bins
+        slot_hash = [0] * self.num_bins
+        stash = []
+        evictions = 0
+        longest_chain = 0
+
+        for item_idx in range(len(candidates)):
+            current = item_idx
+            excluded = None
+            for chain in range(self.recursion_limit + 1):
+                locations = candidates[current]
+                for h_idx, loc in enumerate(locations):
+                    if slots[loc] < 0:
+                        slots[loc] = current
+                        slot_hash[loc] = h_idx
+                        break
+                else:
+                    # Все кандидатные корзины заняты: вытесняем случайного соседа
+                    h_idx = rng.randrange(self.num_hashes) if excluded is None \
+                        else self._random_index_excluding(rng, excluded)
+                    loc = locations[h_idx]
+                    current, slots[loc] = slots[loc], current
+                    excluded, slot_hash[loc] = slot_hash[loc], h_idx
+                    evictions += 1
+                    continue
+                longest_chain = max(longest_chain, chain)
+                break
             else:
-                self.failed = True
+                longest_chain = self.recursion_limit
+                stash.append(current)
+                if len(stash) > self.stash_size:
+                    break
+
+        return slots, slot_hash, stash, evictions, longest_chain
+
+    def build(self, items):
+        """
+        Пакетное построение таблицы кукушки.
+
+        Кандидатные корзины всех элементов вычисляются одним векторизованным проходом,
+        вытеснение выполняется итеративно с ограничением длины цепочки. Попытка, после
+        которой stash не пуст, повторяется с новым сидом генератора вытеснений
+        (сиды хеш-функций общие с отправителем и не меняются).
+        :param items: последовательность неотрицательных 64-битных элементов
+        :return: self
+        """
+        start = time.perf_counter()
+        items = np.unique(np.asarray(items, dtype=np.uint64))
+        candidates = np.stack(
+            [hash_locations(items, seed, self.output_bits) for seed in self.hash_seeds], axis=1
+        ).tolist()
+
+        best = None
+        total_evictions = 0
+        for attempt in range(self.max_attempts):
+            result = self._build_attempt(candidates, attempt)
+            total_evictions += result[3]
+            if best is None or len(result[2]) < len(best[2]):
+                best = result
+            if not result[2]:
+                break
+
+        slots, slot_hash, stash, _, longest_chain = best
+        if len(stash) > self.stash_size:
+            self.failed = True
+            raise RuntimeError(
+                f'Не удалось построить таблицу кукушки за {self.max_attempts} попыток: '
+                f'{len(stash)} элементов не поместились'
+            )
+
+        slots = np.array(slots, dtype=np.int64)
+        occupied = slots >= 0
+        item_left = (items[slots[occupied]] >> np.uint64(self.output_bits)).astype(np.int64)
+        self.data = np.full(self.num_bins, self.EMPTY, dtype=np.int64)
+        self.data[occupied] = (item_left << self.log_num_hashes) + np.array(slot_hash)[occupied]
+        self.items = np.zeros(self.num_bins, dtype=np.uint64)
+        self.items[occupied] = items[slots[occupied]]
+        self.occupied = occupied
+        self.stash = [int(items[idx]) for idx in stash]
+        self.failed = False
 
-bin_capacity = calculate_bin_capacity()
+        self.stats = {
+            "items": int(items.size),
+            "attempts": attempt + 1,
+            "evictions": total_evictions,
+            "longest_chain": longest_chain,
+            "stash": len(self.stash),
+            "build_time": time.perf_counter() - start,
+        }
+        logger.info(f'Таблица кукушки построена: {self.stats}')
+        return self
@@ -0,0 +1,260 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+
+from config import job_workers, job_queue_size, job_timeout, job_result_ttl
+from client_keys import KeyManager
+from client_logic import generate_query, finalize_answer
+from server_logic import process_query
+from sender_store import SenderStateStore
+
+logger = logging.getLogger("psi_api")
+
+# Состояния задачи
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMEOUT = "timeout"
+
+FINISHED = (DONE, FAILED, CANCELLED, TIMEOUT)
+
+
+class QueueFullError(RuntimeError):
+    """Очередь задач заполнена, новая задача не принята"""
+
+
+def _worker_main(conn):
+    """Цикл процесса-исполнителя: получает (функция, аргументы), возвращает результат или ошибку"""
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((DONE, func(*args)))
+        except Exception as e:
+            conn.send((FAILED, f"{type(e).__name__}: {e}"))
+
+
+class Job:
+    """Задача пула: состояние и результат или ошибка"""
+
+    def __init__(self, func, args):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.cancel_requested = False
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+
+    def info(self) -> dict:
+        """Описание задачи для API"""
+        info = {"job_id": self.id, "status": self.status}
+        if self.status == DONE:
+            info["result"] = self.result
+        elif self.status in FINISHED:
+            info["error"] = self.error
+        return info
+
+
+class JobManager:
+    """
+    Ограниченный пул процессов для тяжелых вычислений PSI с очередью задач.
+
+    Каждый исполнитель - отдельный процесс, которым управляет поток-диспетчер в
+    процессе сервера, поэтому цикл событий не блокируется вычислениями. Отмена
+    выполняющейся задачи и превышение таймаута завершают процесс-исполнитель, после
+    чего он перезапускается. Если в очереди уже queue_size задач, новая отклоняется.
+    Процессы запускаются при первой задаче.
+    """
+
+    def __init__(self, workers: int = job_workers, queue_size: int = job_queue_size,
+                 timeout: float = job_timeout, result_ttl: float = job_result_ttl):
+        """
+        :param workers: количество процессов-исполнителей
+        :param queue_size: максимальное количество задач, ожидающих исполнителя
+        :param timeout: максимальное время выполнения задачи в секундах (None - без ограничения)
+        :param result_ttl: время хранения завершенных задач в секундах
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._slots = []
+        self._processes = {}
+        self._closed = False
+        # spawn: процесс сервера многопоточный, fork в нем небезопасен
+        self._mp = multiprocessing.get_context("spawn")
+
+    def _spawn(self, slot: int):
+        parent_conn, child_conn = self._mp.Pipe()
+        process = self._mp.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        self._processes[slot] = process
+        return process, parent_conn
+
+    def _start(self):
+        for slot in range(self.workers):
+            thread = threading.Thread(target=self._run_slot, args=(slot,), daemon=True)
+            thread.start()
+            self._slots.append(thread)
+
+    def _run_slot(self, slot: int):
+        process, conn = self._spawn(slot)
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            with self._lock:
+                self._queued -= 1
+                if job.status != QUEUED:
+                    continue
+                job.status = RUNNING
+                job.started = time.monotonic()
+
+            status, value = self._execute(job, conn)
+            if status in (CANCELLED, TIMEOUT) or (status == FAILED and not process.is_alive()):
+                # Прерываем вычисление вместе с процессом и запускаем новый исполнитель
+                process.terminate()
+                process.join()
+                conn.close()
+                if not self._closed:
+                    process, conn = self._spawn(slot)
+            self._finish(job, status, value)
+
+        process.terminate()
+        process.join()
+
+    def _execute(self, job: Job, conn):
+        deadline = None if self.timeout is None else job.started + self.timeout
+        try:
+            conn.send((job.func, job.args))
+            while True:
+                if conn.poll(0.1):
+                    return conn.recv()
+                if job.cancel_requested:
+                    return CANCELLED, "Задача отменена"
+                if deadline is not None and time.monotonic() > deadline:
+                    return TIMEOUT, f"Превышено время выполнения задачи ({self.timeout} с)"
+        except (EOFError, OSError):
+            return FAILED, "Процесс-исполнитель аварийно завершился"
+
+    def _finish(self, job: Job, status: str, value):
+        with self._lock:
+            job.status = status
+            job.finished = time.monotonic()
+            if status == DONE:
+                job.result = value
+            else:
+                job.error = value
+            job.func = job.args = None
+        logger.info(f"Задача {job.id[:12]} завершена: {status}")
+
+    def _purge(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and now - job.finished > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, func, *args) -> Job:
+        """
+        Ставит задачу в очередь.
+        :param func: функция верхнего уровня модуля (передается в процесс-исполнитель)
+        :raises QueueFullError: если очередь заполнена
+        """
+        job = Job(func, args)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Пул задач остановлен")
+            self._purge()
+            if self._queued >= self.queue_size:
+                raise QueueFullError(f"Очередь задач заполнена ({self.queue_size}), повторите запрос позже")
+            if not self._slots:
+                self._start()
+            self._jobs[job.id] = job
+            self._queued += 1
+        self._queue.put(job)
+        logger.info(f"Задача {job.id[:12]} поставлена в очередь")
+        return job
+
+    def get(self, job_id: str):
+        """Возвращает задачу по идентификатору или None"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str):
+        """
+        Отменяет задачу: ожидающая снимается с очереди, выполняющаяся прерывается
+        вместе с процессом-исполнителем.
+        :return: задача или None, если она не найдена
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return job
+            job.cancel_requested = True
+            if job.status != QUEUED:
+                return job
+            job.status = CANCELLED
+            job.error = "Задача отменена"
+            job.finished = time.monotonic()
+            job.func = job.args = None
+        return job
+
+    def shutdown(self):
+        """Останавливает процессы-исполнители"""
+        with self._lock:
+            self._closed = True
+            jobs = list(self._jobs)
+        for job_id in jobs:
+            self.cancel(job_id)
+        for _ in self._slots:
+            self._queue.put(None)
+        for process in list(self._processes.values()):
+            process.terminate()
+
+
+# Задачи PSI, выполняемые в процессах-исполнителях
+
+_sender_store = None
+_key_manager = None
+
+
+def run_intersection(sender_set, receiver_set) -> dict:
+    """
+    Полный прогон протокола для веб-интерфейса: обе стороны в одном процессе-исполнителе.
+    Хранилище состояний и ключи получателя у каждого исполнителя свои, каталог на диске общий.
+    """
+    global _sender_store, _key_manager
+    if _sender_store is None:
+        _sender_store = SenderStateStore()
+        _key_manager = KeyManager()
+
+    srv_state = _sender_store.get_or_build(sender_set)
+    query_bytes, client_state = generate_query(receiver_set, _key_manager)
+    answer_bytes = process_query(query_bytes, srv_state)
+    intersection = finalize_answer(answer_bytes, client_state)
+    logger.info(f"Intersection size: {len(intersection)}")
+
+    return {
+        "success": True,
+        "sender_size": len(sender_set),
+        "receiver_size": len(receiver_set),
+        "intersection_size": len(intersection),
+        "intersection": list(intersection)
+    }
@@ -1,7 +1,6 @@
 from data_generator import generate_sets_to_files
 from client_logic   import generate_query, finalize_answer
 from server_logic   import preprocess_sender, process_query
-import pickle
 
 # 1. сгенерируем данные
 generate_sets_to_files()
@@ -15,7 +14,7 @@ srv_state = preprocess_sender(sender_set)
 query_bytes, client_state = generate_query(receiver_set)
 
 # 4. «обмен» байтами
-answer_bytes = process_query(pickle.loads(query_bytes), srv_state)
+answer_bytes = process_query(query_bytes, srv_state)
 
 # 5. клиент завершает
 intersection = finalize_answer(answer_bytes, client_state)
@@ -0,0 +1,93 @@
+import json
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+from client_keys import KeyManager
+from client_logic import generate_query, finalize_answer, finalize_answer_stream, attach_context
+
+
+# Размер части ответа при потоковом чтении
+CHUNK_SIZE = 1 << 16
+
+
+class ServerError(RuntimeError):
+    """Ошибка, возвращенная сервером"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Ошибка сервера {status}: {message}")
+        self.status = status
+
+
+class PSIClient:
+    """
+    Клиент протокола PSI поверх HTTP-эндпоинтов api.py.
+    Отправитель регистрирует множество и получает идентификатор состояния,
+    получатель отправляет запрос для этого идентификатора и локально расшифровывает ответ.
+    Ключи получателя переиспользуются между запросами (KeyManager).
+    """
+
+    def __init__(self, base_url: str = "http://localhost:8000", timeout: float = 600, key_manager=None):
+        """
+        :param base_url: адрес сервера
+        :param timeout: таймаут HTTP-запроса в секундах
+        :param key_manager: KeyManager с политикой смены ключей (по умолчанию - из config.yaml)
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.key_manager = KeyManager() if key_manager is None else key_manager
+
+    def _post(self, path: str, data: bytes, content_type: str, consume=None):
+        """
+        :param consume: функция, получающая итератор частей ответа по мере их поступления
+                        (None - ответ читается целиком и возвращается как bytes)
+        """
+        request = urllib.request.Request(
+            self.base_url + path, data=data, method="POST", headers={"Content-Type": content_type}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                if consume is None:
+                    return response.read()
+                return consume(iter(lambda: response.read1(CHUNK_SIZE), b""))
+        except urllib.error.HTTPError as e:
+            body = e.read()
+            try:
+                message = json.loads(body)["error"]
+            except (ValueError, KeyError):
+                message = body.decode(errors="replace")
+            raise ServerError(e.code, message) from e
+
+    def register_sender(self, sender_set) -> str:
+        """
+        Регистрирует множество отправителя на сервере (с предобработкой при первом обращении).
+        :param sender_set: множество отправителя
+        :return: идентификатор состояния
+        """
+        body = np.asarray(sender_set, dtype=np.uint64).astype("<u8").tobytes()
+        return json.loads(self._post("/sender/states", body, "application/octet-stream"))["state_id"]
+
+    def intersect(self, state_id: str, receiver_set, stream: bool = False) -> set:
+        """
+        Вычисляет пересечение множества получателя с зарегистрированным множеством отправителя.
+        Ключи и таблица кукушки не покидают клиента.
+        :param state_id: идентификатор состояния отправителя
+        :param receiver_set: множество получателя
+        :param stream: получать ответ по частям и расшифровывать шифротексты по мере поступления
+        :return: множество элементов пересечения
+        """
+        path = f"/sender/states/{state_id}/query"
+        query_bytes, client_state = generate_query(receiver_set, self.key_manager)
+        consume = None
+        if stream:
+            path += "?stream=true"
+            consume = lambda chunks: finalize_answer_stream(chunks, client_state)
+        try:
+            answer = self._post(path, query_bytes, "application/octet-stream", consume)
+        except ServerError as e:
+            # Сервер не знает контекст по отпечатку: повторяем запрос с полным контекстом
+            if e.status != 409:
+                raise
+            answer = self._post(path, attach_context(query_bytes, client_state), "application/octet-stream", consume)
+        return answer if stream else finalize_answer(answer, client_state)
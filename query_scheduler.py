@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from config import query_batch_window, query_batch_size, query_workers, query_queue_size
+from jobs import QueueFullError
+from server_logic import process_queries
+
+logger = logging.getLogger("psi_api")
+
+
+class QueryScheduler:
+    """
+    Планировщик запросов получателей к состояниям отправителя.
+
+    Запросы к одному состоянию, пришедшие в течение window секунд после первого из них,
+    объединяются в группу (до batch_size запросов) и обрабатываются process_queries одним
+    проходом по блокам. Группы разных состояний выбираются по кругу: остаток большой группы
+    встает в конец очереди, поэтому одно состояние не задерживает остальные. Потоковые запросы
+    (stream) не объединяются, но занимают место в той же очереди, пока передается их ответ:
+    если запросов, ожидающих обработки, и потоковых запросов уже queue_size, новый отклоняется.
+    Потоки запускаются при первом запросе.
+    """
+
+    def __init__(self, workers: int = query_workers, window: float = query_batch_window,
+                 batch_size: int = query_batch_size, queue_size: int = query_queue_size):
+        """
+        :param workers: количество потоков, обрабатывающих группы
+        :param window: окно сбора запросов в группу в секундах
+        :param batch_size: максимальное количество запросов в группе
+        :param queue_size: максимальное количество запросов, ожидающих обработки, вместе с потоковыми
+        """
+        self.workers = workers
+        self.window = window
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        # Ключ состояния -> {"state", "queries": deque((запрос, Future)), "since"}, в порядке очереди
+        self._groups = OrderedDict()
+        self._queued = 0
+        self._streaming = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = False
+
+    def submit(self, state_key: str, sender_state, query_bytes) -> Future:
+        """
+        Ставит запрос в очередь состояния отправителя.
+        :param state_key: идентификатор состояния (запросы с одним ключом объединяются)
+        :param sender_state: состояние отправителя
+        :param query_bytes: запрос в формате wire_format
+        :return: Future с ответом в формате wire_format или исключением process_query
+        :raises QueueFullError: если очередь заполнена
+        """
+        future = Future()
+        with self._cond:
+            self._check_admission()
+            if not self._threads:
+                self._start()
+            group = self._groups.get(state_key)
+            if group is None:
+                group = self._groups[state_key] = {"state": sender_state, "queries": deque(),
+                                                   "since": time.monotonic()}
+            group["queries"].append((query_bytes, future))
+            self._queued += 1
+            self._cond.notify()
+        return future
+
+    def acquire_stream(self):
+        """
+        Занимает место в очереди для потокового запроса; после передачи ответа (или ошибки)
+        место освобождается release_stream.
+        :raises QueueFullError: если очередь заполнена
+        """
+        with self._cond:
+            self._check_admission()
+            self._streaming += 1
+
+    def release_stream(self):
+        """Освобождает место, занятое acquire_stream"""
+        with self._cond:
+            self._streaming -= 1
+
+    def _check_admission(self):
+        """Проверка перед приемом запроса (вызывается под self._cond)"""
+        if self._closed:
+            raise RuntimeError("Планировщик запросов остановлен")
+        if self._queued + self._streaming >= self.queue_size:
+            raise QueueFullError(f"Очередь запросов заполнена ({self.queue_size}), повторите запрос позже")
+
+    def stats(self) -> dict:
+        """Количество ожидающих запросов, состояний с непустой очередью и потоковых запросов"""
+        with self._cond:
+            return {"queued_queries": self._queued, "queued_states": len(self._groups),
+                    "streaming_queries": self._streaming}
+
+    def _start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _take(self):
+        """
+        Ожидает первую по очереди готовую группу: набравшую batch_size запросов
+        или ожидающую дольше окна.
+        :return: (ключ состояния, состояние, список (запрос, Future)) или None после остановки
+        """
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                timeout = None
+                for state_key, group in self._groups.items():
+                    queries = group["queries"]
+                    ready_at = group["since"] + self.window
+                    if len(queries) < self.batch_size and now < ready_at:
+                        timeout = ready_at - now if timeout is None else min(timeout, ready_at - now)
+                        continue
+                    taken = [queries.popleft() for _ in range(min(self.batch_size, len(queries)))]
+                    self._queued -= len(taken)
+                    # Остаток уже отстоял окно и сразу готов, но обрабатывается после других состояний
+                    del self._groups[state_key]
+                    if queries:
+                        self._groups[state_key] = group
+                    return state_key, group["state"], taken
+                self._cond.wait(timeout)
+            return None
+
+    def _run(self):
+        while (item := self._take()) is not None:
+            state_key, sender_state, taken = item
+            started = time.monotonic()
+            answers = self._process([query_bytes for query_bytes, _ in taken], sender_state)
+            logger.info(f"Группа из {len(taken)} запросов к состоянию {state_key[:12]} обработана "
+                        f"за {time.monotonic() - started:.3f} с")
+            for (_, future), answer in zip(taken, answers):
+                if isinstance(answer, Exception):
+                    future.set_exception(answer)
+                else:
+                    future.set_result(answer)
+
+    @staticmethod
+    def _process(queries, sender_state):
+        """
+        Обрабатывает группу; ошибки отдельных запросов process_queries возвращает сам, а при
+        сбое всей группы запросы обрабатываются по одному, чтобы ошибка не досталась всем.
+        """
+        try:
+            return process_queries(queries, sender_state)
+        except Exception as e:
+            if len(queries) == 1:
+                return [e]
+            logger.error(f"Ошибка при обработке группы запросов, обрабатываем по одному: {e}")
+            return [QueryScheduler._process([query_bytes], sender_state)[0] for query_bytes in queries]
+
+    def shutdown(self):
+        """Останавливает потоки; ожидающие запросы завершаются ошибкой"""
+        with self._cond:
+            self._closed = True
+            pending = [future for group in self._groups.values() for _, future in group["queries"]]
+            self._groups.clear()
+            self._queued = 0
+            self._cond.notify_all()
+        for future in pending:
+            future.set_exception(RuntimeError("Планировщик запросов остановлен"))
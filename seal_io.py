@@ -0,0 +1,81 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import tenseal.sealapi as sealapi
+
+
+@contextmanager
+def _scratch_path():
+    """
+    Временный путь для сохранения и загрузки объектов SEAL, которые в привязках TenSEAL
+    сериализуются только через файл. На Linux используется файл в памяти (memfd).
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("seal")
+        try:
+            yield fd, f"/proc/self/fd/{fd}"
+        finally:
+            os.close(fd)
+    else:
+        fd, path = tempfile.mkstemp(prefix="seal-")
+        try:
+            yield fd, path
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+
+def save_bytes(seal_object) -> bytes:
+    """
+    Сериализует объект SEAL (Ciphertext, Plaintext, SerializableCiphertext) в байты.
+    """
+    with _scratch_path() as (fd, path):
+        seal_object.save(path)
+        return os.pread(fd, os.fstat(fd).st_size, 0)
+
+
+def load_ciphertext(seal_context, data) -> sealapi.Ciphertext:
+    """
+    Загружает шифротекст SEAL из байтов.
+    :param seal_context: SEALContext, для которого создан шифротекст
+    :param data: байты (или memoryview), полученные save_bytes
+    """
+    ciphertext = sealapi.Ciphertext(seal_context)
+    with _scratch_path() as (fd, path):
+        os.pwrite(fd, data, 0)
+        ciphertext.load(seal_context, path)
+    return ciphertext
+
+
+def encode_vector(encoder, values) -> sealapi.Plaintext:
+    """
+    Кодирует вектор целых чисел в слоты открытого текста BFV (остальные слоты - нули).
+    Массив NumPy передается в кодировщик без преобразования в список.
+    """
+    plaintext = sealapi.Plaintext()
+    if isinstance(values, np.ndarray):
+        encoder.encode(np.ascontiguousarray(values, dtype=np.uint64), plaintext)
+    else:
+        encoder.encode(list(values), plaintext)
+    return plaintext
+
+
+def decrypt_vectors(context, ciphertexts, size: int) -> np.ndarray:
+    """
+    Расшифровывает набор сериализованных шифротекстов SEAL одним Decryptor и BatchEncoder.
+    :param context: приватный контекст TenSEAL
+    :param ciphertexts: байты шифротекстов
+    :param size: количество значимых слотов
+    :return: массив np.uint64 формы (количество шифротекстов, size)
+    """
+    seal_context = context.seal_context().data
+    decryptor = sealapi.Decryptor(seal_context, context.secret_key().data)
+    encoder = sealapi.BatchEncoder(seal_context)
+    result = np.empty((len(ciphertexts), size), dtype=np.uint64)
+    plaintext = sealapi.Plaintext()
+    for row, data in enumerate(ciphertexts):
+        decryptor.decrypt(load_ciphertext(seal_context, data), plaintext)
+        result[row] = encoder.decode_uint64(plaintext)[:size]
+    return result
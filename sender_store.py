@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from config import state_dir, state_cache_size, state_cache_bytes
+from server_logic import preprocess_sharded, sender_params, state_shards
+
+logger = logging.getLogger("psi_api")
+
+
+def set_digest(sender_set, params=None) -> str:
+    """
+    Вычисляет дайджест содержимого множества отправителя вместе с параметрами конфигурации.
+    Порядок элементов и повторы не влияют на результат.
+    :param sender_set: последовательность неотрицательных 64-битных элементов
+    :param params: параметры состояния (по умолчанию текущие sender_params())
+    :return: шестнадцатеричная строка SHA-256
+    """
+    if params is None:
+        params = sender_params()
+    items = np.unique(np.asarray(sender_set, dtype=np.uint64))
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(items.astype('<u8').tobytes())
+    return digest.hexdigest()
+
+
+class SenderStateStore:
+    """
+    Хранилище предобработанных состояний отправителя.
+
+    Каждое состояние сохраняется в отдельный каталог <directory>/<digest>: массивы NumPy
+    в формате .npy (загружаются через mmap), остальные поля - в meta.json. Шарды
+    шардированного состояния сохраняются в подкаталоги shard-<номер> в том же формате.
+    Перед диском стоит LRU-кеш в памяти процесса, ограниченный количеством состояний
+    и суммарным размером их массивов. Вытесненное состояние остается на диске и
+    загружается снова при следующем обращении по тому же идентификатору (дайджесту).
+    """
+
+    META_FILE = "meta.json"
+
+    def __init__(self, directory: str = state_dir, cache_size: int = state_cache_size,
+                 cache_bytes: int = state_cache_bytes):
+        """
+        :param directory: каталог для хранения состояний
+        :param cache_size: максимальное количество состояний в памяти
+        :param cache_bytes: максимальный суммарный размер состояний в памяти (None - без ограничения)
+        """
+        self.directory = directory
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self._used_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    @staticmethod
+    def state_size(state: dict) -> int:
+        """Размер массивов состояния (всех шардов) в байтах"""
+        return sum(v.nbytes for shard in state_shards(state) for v in shard.values() if isinstance(v, np.ndarray))
+
+    def _remember(self, digest: str, state: dict):
+        size = self.state_size(state)
+        with self._lock:
+            self._used_bytes += size - self._sizes.get(digest, 0)
+            self._sizes[digest] = size
+            self._cache[digest] = state
+            self._cache.move_to_end(digest)
+            # Последнее добавленное состояние не вытесняется, даже если оно больше лимита
+            while len(self._cache) > 1 and (
+                    len(self._cache) > self.cache_size
+                    or (self.cache_bytes is not None and self._used_bytes > self.cache_bytes)):
+                evicted, _ = self._cache.popitem(last=False)
+                self._used_bytes -= self._sizes.pop(evicted)
+                logger.info(f"Состояние отправителя {evicted[:12]} вытеснено из памяти")
+
+    def stats(self) -> dict:
+        """Состояние кеша: идентификаторы в памяти и занятый объем"""
+        with self._lock:
+            return {
+                "states": list(self._cache),
+                "used_bytes": self._used_bytes,
+                "cache_size": self.cache_size,
+                "cache_bytes": self.cache_bytes,
+            }
+
+    def _load_dir(self, path: str, digest: str):
+        meta_path = os.path.join(path, self.META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        state = dict(meta["fields"])
+        for key in meta["arrays"]:
+            state[key] = np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r")
+        if meta.get("shards"):
+            state["shards"] = [self._load_dir(os.path.join(path, f"shard-{i}"), f"{digest}-{i}")
+                               for i in range(meta["shards"])]
+        state["digest"] = digest
+        return state
+
+    def _load(self, digest: str):
+        state = self._load_dir(self._path(digest), digest)
+        if state is not None and state["params"] != sender_params():
+            # Состояние построено при других параметрах конфигурации: считаем его отсутствующим
+            logger.warning(f"Состояние отправителя {digest[:12]} построено с другими параметрами, пропускаем")
+            return None
+        return state
+
+    def _save_dir(self, path: str, state: dict):
+        shards = state.get("shards", [])
+        fields = {k: v for k, v in state.items()
+                  if not isinstance(v, np.ndarray) and k not in ("digest", "shards")}
+        arrays = [k for k, v in state.items() if isinstance(v, np.ndarray)]
+        for key in arrays:
+            np.save(os.path.join(path, f"{key}.npy"), state[key])
+        for i, shard in enumerate(shards):
+            shard_path = os.path.join(path, f"shard-{i}")
+            os.mkdir(shard_path)
+            self._save_dir(shard_path, shard)
+        # meta.json записывается последним: по нему определяется, что состояние полное
+        with open(os.path.join(path, self.META_FILE), "w") as f:
+            json.dump({"fields": fields, "arrays": arrays, "shards": len(shards)}, f)
+
+    def get(self, digest: str):
+        """
+        Возвращает состояние по дайджесту: из памяти, иначе с диска, иначе None.
+        Состояние на диске, построенное с другими параметрами (sender_params), не загружается.
+        :param digest: дайджест множества отправителя
+        """
+        with self._lock:
+            state = self._cache.get(digest)
+            if state is not None:
+                self._cache.move_to_end(digest)
+                return state
+
+        state = self._load(digest)
+        if state is not None:
+            self._remember(digest, state)
+        return state
+
+    def put(self, digest: str, state: dict) -> dict:
+        """
+        Сохраняет состояние на диск (атомарно) и кладет его в кеш.
+        :param digest: дайджест множества отправителя
+        :param state: результат preprocess_sender или preprocess_sharded
+        :return: состояние, загруженное с диска через mmap
+        """
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            self._save_dir(tmp_path, state)
+            os.rename(tmp_path, self._path(digest))
+        except OSError:
+            # Состояние уже сохранено параллельным процессом
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(os.path.join(self._path(digest), self.META_FILE)):
+                raise
+
+        loaded = self._load(digest)
+        self._remember(digest, loaded)
+        return loaded
+
+    def get_or_build(self, sender_set) -> dict:
+        """
+        Возвращает состояние для множества отправителя, выполняя предобработку только при промахе.
+        :param sender_set: множество отправителя
+        """
+        digest = set_digest(sender_set)
+        state = self.get(digest)
+        if state is not None:
+            logger.info(f"Состояние отправителя {digest[:12]} найдено в хранилище")
+            return state
+
+        logger.info(f"Состояние отправителя {digest[:12]} не найдено, выполняем предобработку")
+        return self.put(digest, preprocess_sharded(sender_set))
+
+    def register(self, sender_set) -> str:
+        """
+        Регистрирует множество отправителя и возвращает идентификатор его состояния.
+        :param sender_set: множество отправителя
+        :return: идентификатор состояния (дайджест множества)
+        """
+        return self.get_or_build(sender_set)["digest"]
+
+    @staticmethod
+    def is_valid_id(state_id: str) -> bool:
+        """Проверяет, что идентификатор имеет вид дайджеста (и не выходит за пределы каталога)"""
+        return len(state_id) == 64 and all(c in "0123456789abcdef" for c in state_id)
@@ -1,101 +1,931 @@
 from math import log2
 
-import pickle
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 import tenseal as ts
+import tenseal.sealapi as sealapi
 
-from config import hash_seeds, output_bits, number_of_hashes, sigma_max, alpha, plain_modulus, ell
-from hashing import SimpleHash, bin_capacity
-from utils import coeffs_from_roots, power_reconstruct
+from config import hash_seeds, output_bits, number_of_hashes, sigma_max, alpha, plain_modulus, \
+    sender_workers, server_workers, tenseal_threads, plaintext_cache_size, evaluation_mode, receiver_max_batches, \
+    sender_size, sender_max_shards, context_cache_size, slot_segments, poly_modulus_degree, answer_noise_margin
+from hashing import SimpleHash, get_bin_capacity
+from utils import coeffs_from_roots_batch, coeffs_dtype, compute_powers, query_exponents, power_targets, \
+    ps_parameters
+from seal_io import save_bytes, load_ciphertext, encode_vector
+from wire_format import protocol_params, check_params, context_fingerprint, decode_query, iter_answer
 
 import numpy as np
 
 
-def preprocess_sender(sender_set):
-    """Предварительная обработка множества отправителя"""
+def sender_params():
+    """Параметры конфигурации, от которых зависит состояние отправителя"""
+    return {
+        "hash_seeds": list(hash_seeds),
+        "output_bits": output_bits,
+        "bin_capacity": get_bin_capacity(),
+        "alpha": alpha,
+        "plain_modulus": plain_modulus,
+        "sigma_max": sigma_max,
+    }
+
+
+def _dummy_value():
+    """Значение для заполнения пустых ячеек таблицы отправителя"""
+    return 2 ** (sigma_max - output_bits + (int(log2(number_of_hashes)) + 1)) + 1
+
+
+def _writable(array):
+    """Возвращает массив, доступный для записи (копия для mmap-массивов только для чтения)"""
+    return array if array.flags.writeable else np.array(array)
+
+
+def _interpolate_bins(table, occurrences, poly_coeffs):
+    """
+    Заполняет пустые ячейки диапазона корзин фиктивными значениями и записывает
+    коэффициенты полиномов его миникорзин в poly_coeffs (на месте).
+    """
+    empty = np.arange(table.shape[1]) >= occurrences[:, None]
+    table[empty] = _dummy_value()
+
+    minibin_capacity = get_bin_capacity() // alpha
+    roots = table[:, :alpha * minibin_capacity].reshape(len(table), alpha, minibin_capacity)
+    poly_coeffs[...] = coeffs_from_roots_batch(roots, plain_modulus).reshape(len(table), -1)
+
+
+def _interpolate_shard(table_name, occurrences_name, coeffs_name, start, stop):
+    """
+    Обработка диапазона корзин [start, stop) в процессе-исполнителе.
+    Таблица, заполненность и матрица коэффициентов передаются через разделяемую память.
+    """
+    num_bins = 2 ** output_bits
+    minibin_capacity = get_bin_capacity() // alpha
+    blocks = [shared_memory.SharedMemory(name=name)
+              for name in (table_name, occurrences_name, coeffs_name)]
+    try:
+        table = np.ndarray((num_bins, get_bin_capacity()), dtype=np.int64, buffer=blocks[0].buf)
+        occurrences = np.ndarray(num_bins, dtype=np.int64, buffer=blocks[1].buf)
+        poly_coeffs = np.ndarray((num_bins, alpha * (minibin_capacity + 1)),
+                                 dtype=coeffs_dtype(plain_modulus), buffer=blocks[2].buf)
+        _interpolate_bins(table[start:stop], occurrences[start:stop], poly_coeffs[start:stop])
+        del table, occurrences, poly_coeffs
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _interpolate_parallel(simple_hash, poly_coeffs, workers):
+    """
+    Распределяет корзины таблицы по пулу процессов. Каждый исполнитель пишет
+    коэффициенты своего диапазона корзин прямо в общую матрицу в разделяемой памяти.
+    Таблица и заполненность копируются в разделяемую память, а таблица и матрица
+    коэффициентов - обратно в массивы состояния: это по одному memcpy на массив
+    (при параметрах по умолчанию около 5 МБ, единицы миллисекунд). Пул процессов общий
+    с вычислением блоков (_get_executor) и создается один раз на процесс.
+    """
+    arrays = [simple_hash.hashed_data, simple_hash.occurrences, poly_coeffs]
+    blocks = [shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) for array in arrays]
+    try:
+        views = [np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+                 for array, block in zip(arrays, blocks)]
+        views[0][...] = simple_hash.hashed_data
+        views[1][...] = simple_hash.occurrences
+
+        num_bins = len(simple_hash.hashed_data)
+        bounds = np.linspace(0, num_bins, workers + 1).astype(int)
+        executor = _get_executor(workers)
+        futures = [executor.submit(_interpolate_shard, *(block.name for block in blocks), int(start), int(stop))
+                   for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        for future in futures:
+            future.result()
+
+        simple_hash.hashed_data[...] = views[0]
+        poly_coeffs[...] = views[2]
+        del views
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def preprocess_sender(sender_set, workers=None):
+    """
+    Предварительная обработка множества отправителя
+    :param sender_set: множество отправителя
+    :param workers: количество процессов для обработки корзин (по умолчанию sender_workers из config.yaml)
+    """
+    workers = sender_workers if workers is None else workers
+
     # Инициализируем хеш таблицу и заполняем элементами
-    simple_hash = SimpleHash(hash_seeds, output_bits, bin_capacity)
-    for item in sender_set:
-        for h_idx in range(number_of_hashes):
-            simple_hash.insert(item, h_idx)
-
-    # Значение для заполнения пустых ячеек
-    dummy_value = 2 ** (sigma_max - output_bits + (int(log2(number_of_hashes)) + 1)) + 1
-
-    # Заполняем пустые ячейки фиктивными значениями
-    for bin_idx in range(2 ** output_bits):
-        for pos in range(bin_capacity):
-            if simple_hash.hashed_data[bin_idx][pos] is None:
-                simple_hash.hashed_data[bin_idx][pos] = dummy_value
-
-    # Разделяем корзины на миникорзины и вычисляем коэффициенты полиномов
-    poly_coeffs = []
-    minibin_capacity = bin_capacity // alpha
-    for bin_idx in range(2 ** output_bits):
-        bin_coeffs = []
-        for mini_idx in range(alpha):
-            # Получаем элементы текущей миникорзины
-            roots = [simple_hash.hashed_data[bin_idx][minibin_capacity * mini_idx + r] 
-                    for r in range(minibin_capacity)]
-            # Вычисляем коэффициенты полинома с корнями в элементах миникорзины
-            bin_coeffs += coeffs_from_roots(roots, plain_modulus).tolist()
-        poly_coeffs.append(bin_coeffs)
+    simple_hash = SimpleHash(hash_seeds, output_bits, get_bin_capacity())
+    simple_hash.insert_many(sender_set)
+
+    # Корзины независимы: заполняем пустые ячейки фиктивными значениями, разделяем корзины
+    # на миникорзины и вычисляем коэффициенты полиномов (последовательно или пулом процессов)
+    minibin_capacity = get_bin_capacity() // alpha
+    poly_coeffs = np.empty((2 ** output_bits, alpha * (minibin_capacity + 1)),
+                           dtype=coeffs_dtype(plain_modulus))
+    if workers > 1:
+        _interpolate_parallel(simple_hash, poly_coeffs, workers)
+    else:
+        _interpolate_bins(simple_hash.hashed_data, simple_hash.occurrences, poly_coeffs)
 
     return {
         "poly_coeffs": poly_coeffs,
-        "minibin_capacity": minibin_capacity
+        "minibin_capacity": minibin_capacity,
+        "table": simple_hash.hashed_data,
+        "occurrences": simple_hash.occurrences,
+        "params": sender_params(),
+    }
+
+
+def preprocess_sharded(sender_set, shard_size: int = sender_size, workers=None):
+    """
+    Предварительная обработка множества отправителя, превышающего sender_size.
+    Множество делится на шарды не больше shard_size элементов, у каждого свои SimpleHash
+    и матрица коэффициентов, поэтому bin_capacity и степень полиномов не растут.
+    Множество, помещающееся в один шард, обрабатывается обычным preprocess_sender.
+    :param sender_set: множество отправителя
+    :param shard_size: максимальное количество элементов в шарде
+    :param workers: количество процессов для обработки корзин каждого шарда
+    :return: состояние preprocess_sender или {"shards": [состояния шардов], "params"}
+    """
+    items = np.unique(np.asarray(sender_set, dtype=np.uint64))
+    if items.size > shard_size * sender_max_shards:
+        raise ValueError(f"Множество отправителя больше {shard_size * sender_max_shards} элементов")
+    if items.size <= shard_size:
+        return preprocess_sender(items, workers)
+
+    # Шарды - равные по размеру участки отсортированного множества
+    num_shards = -(-items.size // shard_size)
+    return {
+        "shards": [preprocess_sender(shard, workers) for shard in np.array_split(items, num_shards)],
+        "params": sender_params(),
     }
 
 
-def process_query(query_serialized_ctx, sender_state):
-    """Обработка запроса от клиента"""
-    poly_coeffs = sender_state["poly_coeffs"]
+def state_shards(sender_state):
+    """Список состояний шардов (для нешардированного состояния - оно само)"""
+    return sender_state["shards"] if "shards" in sender_state else [sender_state]
+
+
+def _find_in_bins(table, occurrences, locations, encoded):
+    """
+    Ищет закодированные значения в занятой части соответствующих корзин.
+    :return: позиция значения в корзине или -1, если значение отсутствует
+    """
+    rows = table[locations]
+    matches = (rows == encoded[..., None]) & (np.arange(table.shape[1]) < occurrences[locations][..., None])
+    return np.where(matches.any(axis=-1), matches.argmax(axis=-1), -1)
+
+
+def update_sender(sender_state, added=(), removed=()):
+    """
+    Инкрементальное обновление состояния отправителя.
+
+    Затронутые корзины находятся через те же хеш-функции, что и в SimpleHash; пересчитываются
+    только коэффициенты изменившихся миникорзин. Удаление переносит последний элемент корзины
+    на место удаленного. Массивы состояния изменяются на месте, если они доступны для записи.
+    :param sender_state: результат preprocess_sender
+    :param added: элементы, добавляемые в множество
+    :param removed: элементы, удаляемые из множества
+    :return: обновленное состояние отправителя
+    :raises ValueError: если после обновления какая-либо корзина переполнится
+    """
+    if "shards" in sender_state:
+        raise ValueError("Обновление шардированного состояния не поддерживается, выполните preprocess_sharded")
     minibin_capacity = sender_state["minibin_capacity"]
+    capacity = alpha * minibin_capacity
+    simple_hash = SimpleHash(hash_seeds, output_bits, get_bin_capacity())
+    table = sender_state["table"]
+    occurrences = sender_state["occurrences"]
+
+    removed = np.unique(np.asarray(removed, dtype=np.uint64))
+    added = np.setdiff1d(np.asarray(added, dtype=np.uint64), removed)
+
+    # Удаляются только присутствующие элементы, добавляются только отсутствующие
+    rem_locations, rem_encoded = simple_hash.locate_many(removed)
+    present = (_find_in_bins(table, occurrences, rem_locations, rem_encoded) >= 0).all(axis=1)
+    rem_locations, rem_encoded = rem_locations[present], rem_encoded[present]
+    add_locations, add_encoded = simple_hash.locate_many(added)
+    absent = (_find_in_bins(table, occurrences, add_locations, add_encoded) < 0).all(axis=1)
+    add_locations, add_encoded = add_locations[absent], add_encoded[absent]
+
+    # Проверяем переполнение до изменения состояния
+    new_occurrences = (occurrences
+                       - np.bincount(rem_locations.ravel(), minlength=len(occurrences))
+                       + np.bincount(add_locations.ravel(), minlength=len(occurrences)))
+    overflow = np.flatnonzero(new_occurrences > capacity)
+    if overflow.size:
+        raise ValueError(
+            f'Переполнение корзин отправителя при обновлении: {overflow[:10].tolist()} '
+            f'(ёмкость {capacity})'
+        )
+
+    table = _writable(table)
+    occurrences = _writable(occurrences)
+    poly_coeffs = _writable(sender_state["poly_coeffs"])
+    dummy_value = _dummy_value()
+    touched = set()
+
+    for loc, value in zip(rem_locations.ravel().tolist(), rem_encoded.ravel().tolist()):
+        last = int(occurrences[loc]) - 1
+        pos = int(np.flatnonzero(table[loc, :last + 1] == value)[0])
+        table[loc, pos] = table[loc, last]
+        table[loc, last] = dummy_value
+        occurrences[loc] = last
+        touched.update({(loc, pos // minibin_capacity), (loc, last // minibin_capacity)})
+
+    for loc, value in zip(add_locations.ravel().tolist(), add_encoded.ravel().tolist()):
+        pos = int(occurrences[loc])
+        table[loc, pos] = value
+        occurrences[loc] = pos + 1
+        touched.add((loc, pos // minibin_capacity))
+
+    # Пересчитываем коэффициенты только изменившихся миникорзин
+    touched = np.array([pair for pair in touched if pair[1] < alpha], dtype=np.int64).reshape(-1, 2)
+    if touched.size:
+        bins, minibins = touched[:, 0], touched[:, 1]
+        root_cols = minibins[:, None] * minibin_capacity + np.arange(minibin_capacity)
+        coeff_cols = minibins[:, None] * (minibin_capacity + 1) + np.arange(minibin_capacity + 1)
+        poly_coeffs[bins[:, None], coeff_cols] = coeffs_from_roots_batch(
+            table[bins[:, None], root_cols], plain_modulus
+        )
+
+    updated = {key: value for key, value in sender_state.items() if key != "digest"}
+    updated.update(table=table, occurrences=occurrences, poly_coeffs=poly_coeffs,
+                   revision=sender_state.get("revision", 0) + 1)
+    return updated
+
+
+def process_query(query_bytes, sender_state, workers=None):
+    """
+    Обработка запроса от клиента. Все пакеты запроса (таблицы кукушки) вычисляются
+    против всех шардов одного состояния отправителя: при workers > 1 блоки пакета
+    всех шардов отправляются в пул, как только для него восстановлены степени y,
+    и вычисляются параллельно с подготовкой следующего пакета.
+    :param query_bytes: запрос в формате wire_format (контекст или его отпечаток, шифротексты степеней y пакетов)
+    :param sender_state: результат preprocess_sender или preprocess_sharded
+    :param workers: количество процессов для вычисления блоков (по умолчанию server_workers из config.yaml)
+    :return: ответ в формате wire_format
+    :raises UnknownContextError: если передан только отпечаток неизвестного серверу контекста
+    """
+    return b"".join(process_query_stream(query_bytes, sender_state, workers))
+
+
+def process_query_stream(query_bytes, sender_state, workers=None):
+    """
+    Потоковый вариант process_query: запрос проверяется и контекст загружается сразу,
+    поэтому ошибки возникают до начала ответа, а шифротексты ответа выдаются по одному
+    по мере вычисления - передача и расшифровка на клиенте идут параллельно с вычислением.
+    Параметры те же, что у process_query.
+    :return: генератор частей ответа в формате wire_format
+    """
+    workers = server_workers if workers is None else workers
+    shards = state_shards(sender_state)
+    minibin_capacity = shards[0]["minibin_capacity"]
+    params = protocol_params(minibin_capacity)
+    query, ctx, public_ctx_ser = _open_query(query_bytes, params, minibin_capacity)
+
+    # Ответ пакета - группы блоков всех шардов подряд; клиент ищет нули во всех
+    count = len(query["batches"]) * len(shards) * -(-alpha // slot_segments)
+    blocks = _answer_blocks(query, shards, ctx, public_ctx_ser, minibin_capacity, workers)
+    return iter_answer(params, len(query["batches"]), count, blocks)
+
+
+def process_queries(queries, sender_state, workers=None):
+    """
+    Совместная обработка нескольких запросов к одному состоянию отправителя.
+    Степени y восстанавливаются для каждого запроса отдельно, а полиномы миникорзин
+    вычисляются одним проходом по блокам: открытые тексты блока и подготовка цикла
+    используются для всех запросов подряд, а при workers > 1 каждая задача пула
+    получает диапазон блоков сразу для всех запросов.
+    :param queries: запросы в формате wire_format
+    :param sender_state: результат preprocess_sender или preprocess_sharded
+    :param workers: количество процессов для вычисления блоков (по умолчанию server_workers из config.yaml)
+    :return: список той же длины: ответ в формате wire_format или исключение для некорректного запроса
+    """
+    workers = server_workers if workers is None else workers
+    shards = state_shards(sender_state)
+    minibin_capacity = shards[0]["minibin_capacity"]
+    params = protocol_params(minibin_capacity)
+
+    # Некорректный запрос или неизвестный контекст не мешают остальным запросам группы
+    answers = [None] * len(queries)
+    batches = {}
+    requests = []
+    for i, query_bytes in enumerate(queries):
+        try:
+            query, ctx, public_ctx_ser = _open_query(query_bytes, params, minibin_capacity)
+            powers = [_batch_powers(ctx, query["exponents"], batch, minibin_capacity) for batch in query["batches"]]
+        except Exception as e:
+            answers[i] = e
+            continue
+        batches[i] = len(powers)
+        requests.extend((i, query["fingerprint"], ctx, public_ctx_ser, enc_powers) for enc_powers in powers)
+    if not requests:
+        return answers
+
+    # results[пакет запроса][шард] - шифротексты групп блоков по порядку или исключение
+    results = [[[] for _ in shards] for _ in requests]
+    pending = []
+    for s, (shard, cache_key) in enumerate(zip(shards, _plaintext_keys(shards))):
+        if workers > 1:
+            shard_requests = [(fingerprint, public_ctx_ser, enc_powers)
+                              for _, fingerprint, _, public_ctx_ser, enc_powers in requests]
+            pending.append((s, _submit_parallel(shard_requests, shard["poly_coeffs"], minibin_capacity, workers,
+                                                cache_key)))
+            continue
+        loaded = [(ctx, enc_powers) for _, _, ctx, _, enc_powers in requests]
+        for r, blocks in enumerate(_evaluate_range(loaded, shard["poly_coeffs"], cache_key, 0, alpha,
+                                                   minibin_capacity)):
+            results[r][s] = blocks
+    for s, futures in pending:
+        for future in futures:
+            for r, blocks in enumerate(future.result()):
+                if isinstance(blocks, Exception):
+                    results[r][s] = blocks
+                elif not isinstance(results[r][s], Exception):
+                    results[r][s].extend(blocks)
+
+    # Собираем ответы: пакеты запроса идут в requests подряд
+    count_per_batch = len(shards) * -(-alpha // slot_segments)
+    offset = 0
+    for i, count in batches.items():
+        query_results = [shard_blocks for r in range(offset, offset + count) for shard_blocks in results[r]]
+        offset += count
+        errors = [shard_blocks for shard_blocks in query_results if isinstance(shard_blocks, Exception)]
+        if errors:
+            answers[i] = errors[0]
+            continue
+        blocks = (block for shard_blocks in query_results for block in shard_blocks)
+        answers[i] = b"".join(iter_answer(params, count, count * count_per_batch, blocks))
+    return answers
+
+
+def _open_query(query_bytes, params, minibin_capacity):
+    """
+    Разбор и проверка запроса, загрузка публичного контекста клиента.
+    :return: (запрос decode_query, контекст TenSEAL, сериализованный контекст)
+    :raises ValueError: если запрос построен для других параметров
+    :raises UnknownContextError: если передан только отпечаток неизвестного серверу контекста
+    """
+    query = decode_query(query_bytes)
+    check_params(query["params"], params)
+    if sorted(query["exponents"]) != sorted(query_exponents(minibin_capacity)):
+        raise ValueError("Некорректный запрос: набор степеней не соответствует параметрам")
+    if len(query["batches"]) > receiver_max_batches:
+        raise ValueError(f"Некорректный запрос: больше {receiver_max_batches} пакетов")
+
+    # Контекст берем из кеша по отпечатку, десериализуем только новый
+    ctx, public_ctx_ser = context_cache.get(query["fingerprint"], query["context"])
+    return query, ctx, public_ctx_ser
+
+
+def _batch_powers(ctx, exponents, batch, minibin_capacity):
+    """
+    Восстанавливает недостающие степени y пакета одним графом умножений.
+    :return: словарь {показатель: шифротекст SEAL} для power_targets
+    """
+    seal_context = ctx.seal_context().data
+    evaluator = sealapi.Evaluator(seal_context)
+    relin_keys = ctx.relin_keys().data
+
+    def multiply(a, b):
+        result = sealapi.Ciphertext(seal_context)
+        evaluator.multiply(a, b, result)
+        evaluator.relinearize_inplace(result, relin_keys)
+        return result
+
+    targets = power_targets(minibin_capacity)
+    available = {exp: load_ciphertext(seal_context, ct) for exp, ct in zip(exponents, batch)}
+    if any(ct.parms_id() != seal_context.first_parms_id() or ct.is_ntt_form() for ct in available.values()):
+        raise ValueError("Некорректный запрос: шифротексты должны быть на верхнем уровне модуля вне NTT")
+    powers = compute_powers(available, targets, multiply=multiply)
+    return {k: powers[k] for k in targets}
+
+
+def _answer_blocks(query, shards, ctx, public_ctx_ser, minibin_capacity, workers):
+    """
+    Генератор сериализованных шифротекстов ответа в порядке пакетов и шардов.
+    При workers > 1 готовые результаты выдаются, не дожидаясь подготовки следующих пакетов.
+    """
+    seal_context = ctx.seal_context().data
+    cache_keys = _plaintext_keys(shards)
+    pending = deque()
+    for batch in query["batches"]:
+        enc_powers = _batch_powers(ctx, query["exponents"], batch, minibin_capacity)
+
+        # Вычисляем полиномы миникорзин: блоки и шарды независимы
+        for shard, cache_key in zip(shards, cache_keys):
+            poly_coeffs = shard["poly_coeffs"]
+            if workers > 1:
+                request = (query["fingerprint"], public_ctx_ser, enc_powers)
+                pending.extend(_submit_parallel([request], poly_coeffs, minibin_capacity, workers, cache_key))
+            else:
+                plaintexts = plaintext_cache.get(cache_key, poly_coeffs, seal_context, 0, alpha, minibin_capacity)
+                for (result,) in _evaluate_blocks([(ctx, enc_powers)], plaintexts, minibin_capacity):
+                    if isinstance(result, Exception):
+                        raise result
+                    yield save_bytes(result)
+
+        while pending and pending[0].done():
+            yield from _single_result(pending.popleft())
+
+    while pending:
+        yield from _single_result(pending.popleft())
+
+
+def _single_result(future):
+    """Шифротексты единственного запроса задачи пула (ошибка вычисления пробрасывается)"""
+    (blocks,) = future.result()
+    if isinstance(blocks, Exception):
+        raise blocks
+    return blocks
+
+
+def _plaintext_keys(shards):
+    """
+    Ключи кеша открытых текстов для шардов состояния: (ключ состояния, ключ шарда).
+    Ключ состояния - ключи всех шардов, поэтому он меняется после update_sender любого шарда.
+    """
+    shard_keys = [_state_cache_key(shard) for shard in shards]
+    return [(tuple(shard_keys), shard_key) for shard_key in shard_keys]
+
+
+def _state_cache_key(sender_state):
+    """
+    Ключ состояния отправителя для кеша открытых текстов: дайджест из хранилища
+    или идентичность массива коэффициентов, плюс номер ревизии после update_sender.
+    """
+    revision = sender_state.get("revision", 0)
+    if sender_state.get("digest") is not None:
+        return ("digest", sender_state["digest"], revision)
+    return ("id", id(sender_state["poly_coeffs"]), revision)
+
+
+def _pack_segments(block_coeffs, minibin_capacity, segments=slot_segments):
+    """
+    Размещает коэффициенты соседних блоков рядом в слотах: блок g * segments + s занимает
+    сегмент s открытого текста группы g. Недостающие блоки последней группы - нули.
+    :return: массив формы (группы, minibin_capacity + 1, segments * количество корзин)
+    """
+    num_bins = block_coeffs.shape[0]
+    blocks = block_coeffs.shape[1] // (minibin_capacity + 1)
+    groups = -(-blocks // segments)
+    padded = np.zeros((num_bins, groups * segments * (minibin_capacity + 1)), dtype=block_coeffs.dtype)
+    padded[:, :block_coeffs.shape[1]] = block_coeffs
+    packed = padded.reshape(num_bins, groups, segments, minibin_capacity + 1).transpose(1, 3, 2, 0)
+    return np.ascontiguousarray(packed).reshape(groups, minibin_capacity + 1, segments * num_bins)
+
+
+def _encode_blocks(block_coeffs, seal_context, minibin_capacity):
+    """
+    Кодирование коэффициентов всех блоков матрицы block_coeffs в открытые тексты BFV.
+    При slot_segments > 1 в один открытый текст упаковываются slot_segments соседних блоков.
+    Для каждой группы блоков - список по столбцам: элемент j соответствует коэффициенту при y^(m-j).
+    В режиме naive старший коэффициент (всегда 1) не кодируется и остается None.
+    Столбцы, на которые умножаются степени _ntt_exponents, переводятся в NTT-представление
+    один раз: умножение на них в NTT сводится к поэлементному произведению.
+    """
+    encoder = sealapi.BatchEncoder(seal_context)
+    evaluator = sealapi.Evaluator(seal_context)
+    parms_id = seal_context.first_parms_id()
+    ntt_columns = {minibin_capacity - exp for exp in _ntt_exponents(minibin_capacity)}
+    first_column = 1 if evaluation_mode == "naive" else 0
+    packed = _pack_segments(block_coeffs, minibin_capacity)
+    plaintexts = []
+    for group in packed:
+        columns = [None] * first_column
+        for j in range(first_column, minibin_capacity + 1):
+            plaintext = encode_vector(encoder, group[j])
+            if j in ntt_columns:
+                evaluator.transform_to_ntt_inplace(plaintext, parms_id)
+            columns.append(plaintext)
+        plaintexts.append(columns)
+    return plaintexts
+
+
+def _ntt_exponents(minibin_capacity):
+    """
+    Степени y, которые умножаются только на открытые тексты: naive - y^1..y^(m-1),
+    paterson_stockmeyer - малые степени y^1..y^(L-1). Для них и для соответствующих
+    столбцов коэффициентов вычисления идут в NTT-представлении.
+    """
+    if evaluation_mode == "paterson_stockmeyer":
+        return range(1, min(ps_parameters(minibin_capacity)[0], minibin_capacity + 1))
+    return range(1, minibin_capacity)
+
+
+class UnknownContextError(LookupError):
+    """Запрос передал только отпечаток контекста, которого нет в кеше сервера"""
+
+
+class UncachedPlaintextsError(LookupError):
+    """Открытых текстов нет в кеше исполнителя, а коэффициенты для их кодирования не переданы"""
+
+
+class ContextCache:
+    """
+    Ограниченный LRU-кеш десериализованных публичных контекстов клиентов по отпечатку.
+    Клиент, переиспользующий ключи, передает контекст один раз, а в следующих запросах -
+    только отпечаток; ts.context_from выполняется один раз на набор ключей.
+    """
+
+    def __init__(self, max_entries: int = context_cache_size):
+        """
+        :param max_entries: максимальное количество контекстов в памяти
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint: bytes, public_ctx=None):
+        """
+        Возвращает контекст по отпечатку, десериализуя переданный контекст при промахе.
+        :param fingerprint: отпечаток публичного контекста
+        :param public_ctx: сериализованный публичный контекст или None
+        :return: (контекст TenSEAL, сериализованный публичный контекст)
+        :raises ValueError: если отпечаток не соответствует переданному контексту
+        :raises UnknownContextError: если контекст не передан и отсутствует в кеше
+        """
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is not None:
+                self._entries.move_to_end(fingerprint)
+        if entry is not None:
+            return entry
+        if public_ctx is None:
+            raise UnknownContextError("Контекст с указанным отпечатком неизвестен серверу, передайте контекст")
+
+        public_ctx = bytes(public_ctx)
+        if context_fingerprint(public_ctx) != fingerprint:
+            raise ValueError("Некорректный запрос: отпечаток не соответствует контексту")
+        entry = (ts.context_from(public_ctx, n_threads=tenseal_threads), public_ctx)
+        with self._lock:
+            self._entries[fingerprint] = entry
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+context_cache = ContextCache()
+
+
+class PlaintextCache:
+    """
+    Ограниченный LRU-кеш закодированных коэффициентов полиномов по состояниям отправителя.
+    Запись - одно состояние со всеми шардами (ключ - ключи всех шардов, _plaintext_keys),
+    внутри - открытые тексты по шардам, parms_id контекста и диапазонам блоков. Так
+    шардированное состояние занимает одну запись и не вытесняет само себя.
+    """
+
+    def __init__(self, max_entries: int = plaintext_cache_size):
+        """
+        :param max_entries: максимальное количество состояний, открытые тексты которых хранятся в памяти
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key, block_coeffs, seal_context, start, stop, minibin_capacity):
+        """
+        Возвращает открытые тексты блоков [start, stop), кодируя их только при промахе.
+        :param cache_key: (ключ состояния, ключ шарда) из _plaintext_keys или None, если кешировать нельзя
+        :param block_coeffs: столбцы матрицы коэффициентов блоков [start, stop) или None, если кодировать
+                             нельзя (исполнитель получает коэффициенты только после промаха)
+        :param seal_context: SEALContext запроса
+        :raises UncachedPlaintextsError: при промахе без block_coeffs
+        """
+        if cache_key is None:
+            return _encode_blocks(block_coeffs, seal_context, minibin_capacity)
+
+        state_key, shard_key = cache_key
+        slot_count = sealapi.BatchEncoder(seal_context).slot_count()
+        # NTT-представление зависит от модулей контекста, поэтому в ключе и parms_id
+        key = shard_key + (slot_count, plain_modulus, tuple(seal_context.first_parms_id()), evaluation_mode,
+                           slot_segments, start, stop)
+        with self._lock:
+            entry = self._entries.get(state_key, {}).get(key)
+            # Для ключа по id проверяем, что массив тот же самый (id мог быть переиспользован)
+            if entry is not None and (shard_key[0] == "digest" or entry[0] is block_coeffs):
+                self._entries.move_to_end(state_key)
+                return entry[1]
+        if block_coeffs is None:
+            raise UncachedPlaintextsError("Открытые тексты не закодированы, нужны коэффициенты блоков")
+
+        plaintexts = _encode_blocks(block_coeffs, seal_context, minibin_capacity)
+        with self._lock:
+            self._entries.setdefault(state_key, {})[key] = (block_coeffs, plaintexts)
+            self._entries.move_to_end(state_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return plaintexts
+
+
+plaintext_cache = PlaintextCache()
+
+
+def _evaluate_naive(enc_powers, block_plaintexts, evaluator, minibin_capacity):
+    """
+    Прямое вычисление полинома блока: y^m + sum c_j * y^(m-j) + c_m.
+    Произведения на коэффициенты накапливаются в NTT-представлении (степени y^1..y^(m-1)
+    переданы в NTT), обратное преобразование - одно на блок.
+    """
+    accumulator = None
+    term = sealapi.Ciphertext()
+    for j in range(1, minibin_capacity):
+        plaintext = block_plaintexts[j]
+        if plaintext.is_zero():
+            continue
+        if accumulator is None:
+            accumulator = sealapi.Ciphertext()
+            evaluator.multiply_plain(enc_powers[minibin_capacity - j], plaintext, accumulator)
+        else:
+            evaluator.multiply_plain(enc_powers[minibin_capacity - j], plaintext, term)
+            evaluator.add_inplace(accumulator, term)
+
+    # Старший коэффициент равен 1: добавляем y^m и свободный член
+    result = sealapi.Ciphertext()
+    evaluator.add_plain(enc_powers[minibin_capacity], block_plaintexts[minibin_capacity], result)
+    if accumulator is not None:
+        evaluator.transform_from_ntt_inplace(accumulator)
+        evaluator.add_inplace(result, accumulator)
+    return result
+
+
+def _evaluate_paterson_stockmeyer(enc_powers, block_plaintexts, evaluator, relin_keys, minibin_capacity):
+    """
+    Вычисление полинома блока по схеме Патерсона-Стокмейера:
+    p(y) = sum_g y^(g*L) * q_g(y), где q_g вычисляется малыми степенями y^1..y^(L-1)
+    умножением на открытые тексты, а произведение на y^(g*L) - одно умножение шифротекстов.
+    """
+    low, giant = ps_parameters(minibin_capacity)
+    result = None
+    constant_0 = None
+
+    for g in range(giant + 1):
+        inner = None
+        for i in range(1, low):
+            exponent = g * low + i
+            if exponent > minibin_capacity:
+                break
+            plaintext = block_plaintexts[minibin_capacity - exponent]
+            if plaintext.is_zero():
+                continue
+            term = sealapi.Ciphertext()
+            evaluator.multiply_plain(enc_powers[i], plaintext, term)
+            if inner is None:
+                inner = term
+            else:
+                evaluator.add_inplace(inner, term)
+        if inner is not None:
+            # Малые степени и их коэффициенты - в NTT-представлении
+            evaluator.transform_from_ntt_inplace(inner)
+
+        constant = block_plaintexts[minibin_capacity - g * low]
+        if g == 0:
+            # Свободный член добавляется в конце, когда появится шифротекст
+            group, constant_0 = inner, constant
+        elif inner is None:
+            if constant.is_zero():
+                continue
+            group = sealapi.Ciphertext()
+            evaluator.multiply_plain(enc_powers[g * low], constant, group)
+        else:
+            evaluator.add_plain_inplace(inner, constant)
+            group = sealapi.Ciphertext()
+            evaluator.multiply(inner, enc_powers[g * low], group)
+            evaluator.relinearize_inplace(group, relin_keys)
+
+        if group is not None:
+            if result is None:
+                result = group
+            else:
+                evaluator.add_inplace(result, group)
+
+    # Старший коэффициент равен 1, поэтому result всегда содержит шифротекст
+    evaluator.add_plain_inplace(result, constant_0)
+    return result
+
+
+def _evaluate_blocks(requests, plaintexts, minibin_capacity):
+    """
+    Вычисление полиномов миникорзин для набора блоков. Внешний цикл - по блокам,
+    поэтому открытые тексты блока используются для всех запросов подряд. Ошибка
+    вычисления запроса не прерывает остальные: вместо его шифротекстов выдается исключение.
+    :param requests: список (публичный контекст TenSEAL, словарь {показатель: шифротекст SEAL степени y});
+                     открытые тексты должны быть закодированы для parms_id их контекстов
+    :param plaintexts: закодированные коэффициенты групп блоков (_encode_blocks)
+    :param minibin_capacity: степень полиномов
+    :return: генератор списков шифротекстов SEAL или исключений (по одному на запрос) для каждой группы блоков
+    """
+    setups = []
+    ntt_exponents = _ntt_exponents(minibin_capacity)
+    for ctx, enc_powers in requests:
+        try:
+            seal_context = ctx.seal_context().data
+            evaluator = sealapi.Evaluator(seal_context)
+            relin_keys = ctx.relin_keys().data if evaluation_mode == "paterson_stockmeyer" else None
+            # Степени, умножаемые только на открытые тексты, переводятся в NTT один раз для всех блоков
+            powers = dict(enc_powers)
+            for exp in ntt_exponents:
+                powers[exp] = sealapi.Ciphertext(seal_context)
+                evaluator.transform_to_ntt(enc_powers[exp], powers[exp])
+            # Клиенту нужна только проверка слотов на ноль: ответ передается на меньшем модуле
+            setups.append((powers, evaluator, relin_keys, _answer_parms_id(seal_context)))
+        except Exception as e:
+            setups.append(e)
+
+    for block_plaintexts in plaintexts:
+        results = []
+        for i, setup in enumerate(setups):
+            if isinstance(setup, Exception):
+                results.append(setup)
+                continue
+            enc_powers, evaluator, relin_keys, target = setup
+            try:
+                if relin_keys is not None:
+                    result = _evaluate_paterson_stockmeyer(enc_powers, block_plaintexts, evaluator, relin_keys,
+                                                           minibin_capacity)
+                else:
+                    result = _evaluate_naive(enc_powers, block_plaintexts, evaluator, minibin_capacity)
+                if target is not None and result.parms_id() != target:
+                    evaluator.mod_switch_to_inplace(result, target)
+            except Exception as e:
+                setups[i] = result = e
+            results.append(result)
+        yield results
+
+
+def _evaluate_range(requests, block_coeffs, cache_key, start, stop, minibin_capacity):
+    """
+    Вычисление блоков [start, stop) для нескольких запросов. Запросы группируются по parms_id
+    контекста: закодированные открытые тексты (в NTT) зависят от модулей контекста, поэтому
+    для каждой группы берутся свои.
+    :param requests: список (публичный контекст TenSEAL, словарь {показатель: шифротекст SEAL степени y})
+    :return: для каждого запроса - список сериализованных шифротекстов групп блоков или исключение
+    """
+    by_parms_id = {}
+    for r, (ctx, _) in enumerate(requests):
+        by_parms_id.setdefault(tuple(ctx.seal_context().data.first_parms_id()), []).append(r)
+
+    results = [[] for _ in requests]
+    for indices in by_parms_id.values():
+        seal_context = requests[indices[0]][0].seal_context().data
+        plaintexts = plaintext_cache.get(cache_key, block_coeffs, seal_context, start, stop, minibin_capacity)
+        for group in _evaluate_blocks([requests[r] for r in indices], plaintexts, minibin_capacity):
+            for r, result in zip(indices, group):
+                if isinstance(result, Exception):
+                    results[r] = result
+                elif not isinstance(results[r], Exception):
+                    results[r].append(save_bytes(result))
+    return results
+
+
+def _answer_parms_id(seal_context):
+    """
+    Уровень цепочки модулей для ответов: наименьший, на котором после переключения модуля
+    остается answer_noise_margin бит бюджета шума. Шум округления при переключении
+    оценивается как log2(plain_modulus) + log2(poly_modulus_degree) / 2 + 1 бит.
+    :return: parms_id уровня или None, если переключение отключено или невозможно
+    """
+    if answer_noise_margin is None:
+        return None
+    required = log2(plain_modulus) + log2(poly_modulus_degree) / 2 + 1 + answer_noise_margin
+    target = None
+    context_data = seal_context.first_context_data()
+    while context_data is not None:
+        if context_data.total_coeff_modulus_bit_count() >= required:
+            target = context_data.parms_id()
+        context_data = context_data.next_context_data()
+    return target
+
+
+def _evaluate_block_range(requests, contexts, block_coeffs, minibin_capacity, start, stop, cache_key):
+    """
+    Вычисление диапазона блоков в процессе-исполнителе по сериализованным степеням.
+    Контекст десериализуется один раз на набор ключей клиента (кеш исполнителя по отпечатку).
+    :param requests: список (отпечаток контекста, сериализованные степени y)
+    :param contexts: словарь {отпечаток: сериализованный контекст} или None - только из кеша исполнителя
+    :param block_coeffs: столбцы коэффициентов блоков [start, stop) или None - только из кеша исполнителя
+    :return: для каждого запроса - список шифротекстов групп блоков или исключение
+    :raises UnknownContextError: если contexts не переданы, а контекста нет в кеше исполнителя
+    :raises UncachedPlaintextsError: если block_coeffs не переданы, а открытых текстов нет в кеше исполнителя
+    """
+    if contexts is None:
+        # Проверяем кеш до вычислений: при промахе задача сразу повторяется с контекстами
+        for fingerprint, _ in requests:
+            context_cache.get(fingerprint)
+    results = [None] * len(requests)
+    loaded = {}
+    for r, (fingerprint, powers_serial) in enumerate(requests):
+        try:
+            ctx, _ = context_cache.get(fingerprint, None if contexts is None else contexts.get(fingerprint))
+            seal_context = ctx.seal_context().data
+            loaded[r] = (ctx, {exp: load_ciphertext(seal_context, power) for exp, power in powers_serial.items()})
+        except Exception as e:
+            results[r] = e
+    if loaded:
+        evaluated = _evaluate_range(list(loaded.values()), block_coeffs, cache_key, start, stop, minibin_capacity)
+        for r, blocks in zip(loaded, evaluated):
+            results[r] = blocks
+    return results
+
+
+class _BlockTask:
+    """
+    Задача пула по диапазону блоков с интерфейсом Future (done, result). Публичные контексты
+    (несколько МБ) и коэффициенты блоков не передаются с каждой задачей: исполнитель берет
+    контексты из своего кеша по отпечатку, а открытые тексты - из кеша по дайджесту состояния.
+    При промахе задача повторяется с недостающими данными сразу по завершении, не дожидаясь result.
+    """
+
+    def __init__(self, executor, requests, contexts, block_coeffs, minibin_capacity, start, stop, cache_key):
+        self._executor = executor
+        self._requests = requests
+        self._contexts = contexts
+        self._block_coeffs = block_coeffs
+        self._args = (minibin_capacity, start, stop, cache_key)
+        self._send_contexts = False
+        # Без дайджеста исполнитель не кеширует открытые тексты: коэффициенты нужны всегда
+        self._send_coeffs = cache_key is None
+        self._result = Future()
+        self._submit()
+
+    def _submit(self):
+        contexts = self._contexts if self._send_contexts else None
+        block_coeffs = np.ascontiguousarray(self._block_coeffs) if self._send_coeffs else None
+        try:
+            future = self._executor.submit(_evaluate_block_range, self._requests, contexts, block_coeffs,
+                                           *self._args)
+        except Exception as e:
+            self._result.set_exception(e)
+            return
+        future.add_done_callback(self._finish)
+
+    def _finish(self, future):
+        try:
+            self._result.set_result(future.result())
+            return
+        except UnknownContextError as e:
+            if self._send_contexts:
+                self._result.set_exception(e)
+                return
+            self._send_contexts = True
+        except UncachedPlaintextsError as e:
+            if self._send_coeffs:
+                self._result.set_exception(e)
+                return
+            self._send_coeffs = True
+        except Exception as e:
+            self._result.set_exception(e)
+            return
+        self._submit()
+
+    def done(self):
+        return self._result.done()
+
+    def result(self):
+        return self._result.result()
+
+
+_executors = {}
+
+
+def _get_executor(workers):
+    """Пул процессов для предобработки и вычисления блоков (создается один раз на процесс)"""
+    if workers not in _executors:
+        _executors[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _executors[workers]
+
 
-    # Распаковываем контекст и зашифрованный запрос
-    public_ctx_ser, enc_query_serial = query_serialized_ctx
-    ctx = ts.context_from(public_ctx_ser)
-
-    # Параметры оконного метода
-    base = 2 ** ell
-    logB_ell = int(log2(minibin_capacity) / ell) + 1
-
-    # Восстанавливаем матрицу шифротекстов
-    enc_query = [[None for _ in range(logB_ell)] for _ in range(base - 1)]
-    for i in range(base - 1):
-        for j in range(logB_ell):
-            if enc_query_serial[i][j] is not None:
-                enc_query[i][j] = ts.bfv_vector_from(ctx, enc_query_serial[i][j])
-
-    # Собираем все степени y
-    all_enc_powers = [None] * minibin_capacity
-    for i in range(base - 1):
-        for j in range(logB_ell):
-            exp = (i + 1) * base ** j - 1
-            if exp < minibin_capacity:
-                all_enc_powers[exp] = enc_query[i][j]
-
-    # Восстанавливаем недостающие степени
-    for k in range(minibin_capacity):
-        if all_enc_powers[k] is None:
-            all_enc_powers[k] = power_reconstruct(enc_query, k + 1)
-
-    # Переворачиваем для соответствия порядку в Tenseal
-    all_enc_powers = all_enc_powers[::-1]
-
-    # Вычисляем скалярные произведения с коэффициентами полиномов
-    transposed_coeffs = np.transpose(poly_coeffs).tolist()
-    server_answers = []
-
-    for block in range(alpha):
-        # Начинаем с коэффициента при старшей степени
-        result = all_enc_powers[0]
-        for j in range(1, minibin_capacity):
-            coeff = transposed_coeffs[(minibin_capacity + 1) * block + j]
-            result = result + coeff * all_enc_powers[j]
-        
-        # Добавляем свободный член полинома
-        result = result + transposed_coeffs[(minibin_capacity + 1) * block + minibin_capacity]
-        server_answers.append(result.serialize())
-
-    return pickle.dumps(server_answers)
\ No newline at end of file
+def _submit_parallel(requests, poly_coeffs, minibin_capacity, workers, cache_key):
+    """
+    Распределяет блоки alpha по пулу процессов группами по slot_segments (одна группа -
+    один шифротекст). TenSEAL удерживает GIL во время гомоморфных операций, поэтому
+    используются процессы, а не потоки; степени y сериализуются один раз и передаются
+    каждому исполнителю, контексты и коэффициенты - только исполнителям, у которых их еще нет
+    в кеше (_BlockTask). Открытые тексты кешируются в исполнителях, только если состояние
+    имеет дайджест (id массива между процессами не сохраняется).
+    :param requests: список (отпечаток контекста, сериализованный контекст, словарь степеней y)
+    :return: список задач _BlockTask по диапазонам блоков; результат - для каждого запроса шифротексты
+             групп по порядку или исключение
+    """
+    contexts = {fingerprint: public_ctx_ser for fingerprint, public_ctx_ser, _ in requests}
+    requests = [(fingerprint, {exp: save_bytes(power) for exp, power in enc_powers.items()})
+                for fingerprint, _, enc_powers in requests]
+    worker_key = cache_key if all(shard_key[0] == "digest" for shard_key in cache_key[0]) else None
+    groups = -(-alpha // slot_segments)
+    bounds = np.minimum(np.linspace(0, groups, min(workers, groups) + 1).astype(int) * slot_segments, alpha)
+    executor = _get_executor(workers)
+    return [
+        _BlockTask(
+            executor, requests, contexts, poly_coeffs[:, start * (minibin_capacity + 1):stop * (minibin_capacity + 1)],
+            minibin_capacity, int(start), int(stop), worker_key,
+        )
+        for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+    ]
@@ -0,0 +1,142 @@
+import warnings
+
+import numpy as np
+
+# Форматы файлов множеств
+TEXT = "text"  # десятичные числа, разделенные переводами строк, пробелами или запятыми
+BINARY = "binary"  # последовательность 64-битных беззнаковых чисел little-endian
+
+BINARY_EXTENSIONS = (".bin", ".u64")
+
+_SEPARATORS = b" \t\r\n,"
+_UINT64_MAX = 2 ** 64 - 1
+
+
+class SetTooLargeError(ValueError):
+    """Количество различных элементов превышает допустимое"""
+
+
+def resolve_format(fmt: str, filename: str = None) -> str:
+    """
+    Определяет формат файла: явно заданный или по расширению имени файла (для fmt="auto").
+    """
+    if fmt == "auto":
+        return BINARY if filename and filename.lower().endswith(BINARY_EXTENSIONS) else TEXT
+    if fmt not in (TEXT, BINARY):
+        raise ValueError(f"Неизвестный формат множества: {fmt}")
+    return fmt
+
+
+def parse_decimal(data: bytes) -> np.ndarray:
+    """
+    Разбор десятичных чисел средствами NumPy без создания Python-объектов на каждый элемент.
+    :param data: текст, содержащий только полные числа и разделители
+    :return: массив np.uint64
+    """
+    invalid = data.translate(None, b"0123456789" + _SEPARATORS)
+    if invalid:
+        raise ValueError(f"Недопустимый символ {invalid[:1]!r}: ожидаются неотрицательные целые числа")
+    if not data.strip(_SEPARATORS):
+        return np.empty(0, dtype=np.uint64)
+
+    # После проверки символов fromstring не встречает некорректных данных
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        values = np.fromstring(data.replace(b",", b" "), dtype=np.uint64, sep=" ")
+
+    # fromstring насыщает переполнение до 2^64 - 1: такие значения перепроверяем точно
+    if (values == np.uint64(_UINT64_MAX)).any():
+        if any(int(token) > _UINT64_MAX for token in data.replace(b",", b" ").split()):
+            raise ValueError("Число не помещается в 64 бита")
+    return values
+
+
+class SetReader:
+    """
+    Потоковый разбор множества по частям сразу в массив np.uint64 с удалением повторов.
+
+    Разобранные части накапливаются и периодически объединяются с уже собранными
+    уникальными элементами, поэтому пиковая память пропорциональна итоговому массиву
+    (плюс одна часть входных данных), а не копиям всего текста.
+    """
+
+    def __init__(self, fmt: str = TEXT, max_items: int = None, merge_threshold: int = 1 << 20):
+        """
+        :param fmt: формат данных (TEXT или BINARY)
+        :param max_items: максимальное количество различных элементов (None - без ограничения)
+        :param merge_threshold: минимальное количество накопленных элементов для объединения
+        """
+        self.fmt = resolve_format(fmt)
+        self.max_items = max_items
+        self.merge_threshold = merge_threshold
+        self.bytes_read = 0
+        self._items = np.empty(0, dtype=np.uint64)
+        self._pending = []
+        self._pending_count = 0
+        self._tail = b""
+
+    def _merge(self):
+        if self._pending:
+            self._items = np.unique(np.concatenate([self._items] + self._pending))
+            self._pending = []
+            self._pending_count = 0
+        if self.max_items is not None and self._items.size > self.max_items:
+            raise SetTooLargeError(f"Множество содержит больше {self.max_items} различных элементов")
+
+    def _add(self, values: np.ndarray):
+        if values.size:
+            self._pending.append(values)
+            self._pending_count += values.size
+            if self._pending_count >= max(self._items.size, self.merge_threshold):
+                self._merge()
+
+    def feed(self, chunk: bytes):
+        """
+        Добавляет очередную часть данных. Неполный последний элемент сохраняется до следующей части.
+        """
+        self.bytes_read += len(chunk)
+        data = self._tail + bytes(chunk) if self._tail else bytes(chunk)
+
+        if self.fmt == BINARY:
+            complete = len(data) - len(data) % 8
+            self._tail = data[complete:]
+            self._add(np.frombuffer(data, dtype="<u8", count=complete // 8).astype(np.uint64))
+            return
+
+        complete = max(data.rfind(separator) for separator in _SEPARATORS) + 1
+        self._tail = data[complete:]
+        # Незавершенный элемент длиннее любого 64-битного числа - ошибка, а не буферизация
+        if len(self._tail) > len(str(_UINT64_MAX)):
+            raise ValueError("Число не помещается в 64 бита")
+        self._add(parse_decimal(data[:complete]))
+
+    def finish(self) -> np.ndarray:
+        """
+        Завершает разбор.
+        :return: отсортированный массив различных элементов np.uint64
+        :raises ValueError: при неполном элементе в конце двоичных данных
+        :raises SetTooLargeError: при превышении max_items
+        """
+        if self._tail:
+            if self.fmt == BINARY:
+                raise ValueError("Размер двоичных данных не кратен 8 байтам")
+            self._add(parse_decimal(self._tail))
+            self._tail = b""
+        self._merge()
+        return self._items
+
+
+def read_set_file(path: str, fmt: str = "auto", max_items: int = None, chunk_size: int = 1 << 20) -> np.ndarray:
+    """
+    Читает множество из файла по частям.
+    :param path: путь к файлу
+    :param fmt: формат (TEXT, BINARY или "auto" - по расширению)
+    :param max_items: максимальное количество различных элементов
+    :param chunk_size: размер читаемой части в байтах
+    :return: отсортированный массив различных элементов np.uint64
+    """
+    reader = SetReader(resolve_format(fmt, path), max_items)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            reader.feed(chunk)
+    return reader.finish()
@@ -32,16 +32,11 @@ document.addEventListener('DOMContentLoaded', function() {
             formData.append('sender_set', senderSet);
             formData.append('receiver_set', receiverSet);
             
-            const response = await fetch('/calculate-intersection', {
-                method: 'POST',
-                body: formData
-            });
-            
-            const result = await response.json();
+            const result = await runJob('/calculate-intersection', formData);
             displayResult(result);
         } catch (error) {
             console.error('Ошибка:', error);
-            showAlert('Произошла ошибка при вычислении пересечения');
+            showAlert(`Произошла ошибка при вычислении пересечения: ${error.message}`);
         } finally {
             toggleLoading(false);
         }
@@ -64,17 +59,11 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
             
-            // Проверка размера файла (10MB максимум)
-            const MAX_FILE_SIZE = 10 * 1024 * 1024;
-            if (senderFile.size > MAX_FILE_SIZE || receiverFile.size > MAX_FILE_SIZE) {
-                showError('Файл слишком большой. Максимальный размер файла: 10MB.');
-                return;
-            }
-            
-            // Проверка формата файла
-            if (!senderFile.name.endsWith('.txt') && !senderFile.name.endsWith('.csv') ||
-                !receiverFile.name.endsWith('.txt') && !receiverFile.name.endsWith('.csv')) {
-                showError('Пожалуйста, загрузите файлы в формате TXT или CSV.');
+            // Проверка формата файла (размер проверяет сервер по количеству элементов)
+            const allowed = ['.txt', '.csv', '.bin', '.u64'];
+            const isAllowed = file => allowed.some(ext => file.name.toLowerCase().endsWith(ext));
+            if (!isAllowed(senderFile) || !isAllowed(receiverFile)) {
+                showError('Пожалуйста, загрузите файлы в формате TXT, CSV или двоичном (BIN, U64).');
                 return;
             }
         }
@@ -98,18 +87,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 formData.append('use_default_files', 'true');
             }
             
-            const response = await fetch('/calculate-intersection-files', {
-                method: 'POST',
-                body: formData
-            });
-            
-            // Проверяем статус ответа
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.error || `Ошибка сервера: ${response.status}`);
-            }
-            
-            const result = await response.json();
+            const result = await runJob('/calculate-intersection-files', formData);
             
             if (!result.success) {
                 throw new Error(result.error || 'Неизвестная ошибка при обработке данных');
@@ -186,6 +164,35 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     // Вспомогательные функции
+
+    // Ставит задачу PSI в очередь и опрашивает ее статус до завершения
+    async function runJob(url, formData) {
+        const response = await fetch(url, {
+            method: 'POST',
+            body: formData
+        });
+        let job = await response.json();
+
+        // Проверяем статус ответа (429 - очередь задач заполнена)
+        if (!response.ok || !job.success) {
+            throw new Error(job.error || `Ошибка сервера: ${response.status}`);
+        }
+
+        while (job.status === 'queued' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 500));
+            const statusResponse = await fetch(`/jobs/${job.job_id}`);
+            job = await statusResponse.json();
+            if (!statusResponse.ok) {
+                throw new Error(job.error || `Ошибка сервера: ${statusResponse.status}`);
+            }
+        }
+
+        if (job.status !== 'done') {
+            throw new Error(job.error || `Задача завершилась со статусом ${job.status}`);
+        }
+        return job.result;
+    }
+
     function toggleLoading(show, message = 'Вычисление пересечения множеств...') {
         loading.style.display = show ? 'block' : 'none';
         
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+import client_logic
+import server_logic
+import utils
+import wire_format
+from client_logic import generate_query, finalize_answer, finalize_answer_stream
+from config import receiver_size
+from server_logic import preprocess_sender, process_query, process_query_stream, process_queries
+
+MODES = ["naive", "paterson_stockmeyer"]
+
+
+@pytest.fixture(params=[32, 4, 1], ids=lambda value: f"alpha{value}")
+def small_alpha(request, monkeypatch):
+    """Меньше миникорзин - выше степень полиномов (alpha 4 и 1 - minibin_capacity 11 и 44)"""
+    for module in (server_logic, client_logic, wire_format):
+        monkeypatch.setattr(module, "alpha", request.param)
+    return request.param
+
+
+def _set_mode(monkeypatch, mode):
+    for module in (server_logic, utils, wire_format):
+        monkeypatch.setattr(module, "evaluation_mode", mode)
+
+
+def _intersect(sender_state, receiver_set):
+    query, client_state = generate_query(receiver_set)
+    answer = process_query(query, sender_state, workers=1)
+    return finalize_answer(answer, client_state)
+
+
+def test_paterson_stockmeyer_matches_naive(small_alpha, monkeypatch):
+    rng = np.random.default_rng(small_alpha)
+    sender_set = np.unique(rng.integers(0, 2 ** 40, size=2000, dtype=np.uint64))
+    receiver_set = np.concatenate([sender_set[:50], rng.integers(2 ** 41, 2 ** 42, size=150, dtype=np.uint64)])
+    expected = set(sender_set[:50].tolist())
+    sender_state = preprocess_sender(sender_set)
+
+    results = {}
+    for mode in MODES:
+        _set_mode(monkeypatch, mode)
+        results[mode] = _intersect(sender_state, receiver_set.tolist())
+    assert results["naive"] == results["paterson_stockmeyer"] == expected
+
+
+@pytest.mark.parametrize("degree", [1, 2, 5, 11, 22, 44, 100])
+def test_paterson_stockmeyer_power_plan(degree):
+    sources = tuple(utils.query_exponents(degree, "paterson_stockmeyer"))
+    targets = tuple(utils.power_targets(degree, "paterson_stockmeyer"))
+    low, giant = utils.ps_parameters(degree)
+    assert set(targets) == set(range(1, min(low - 1, degree) + 1)) | {low * g for g in range(1, giant + 1)}
+    steps, _ = utils.plan_powers(sources, targets)
+    assert len(steps) == len(set(targets) - set(sources))
+
+
+@pytest.mark.parametrize("base_value", [2, 4, 8])
+def test_paterson_stockmeyer_query_keeps_plan_depth(base_value):
+    for degree in range(1, 120):
+        low, giant = utils.ps_parameters(degree)
+        full = set(utils.window_exponents(low - 1, base_value)) | \
+            {low * e for e in utils.window_exponents(giant, base_value)}
+        sources = utils.query_exponents(degree, "paterson_stockmeyer", base_value)
+        assert set(sources) <= full
+        targets = tuple(utils.power_targets(degree, "paterson_stockmeyer"))
+        depths = [utils.plan_powers(tuple(sorted(exponents)), targets)[1] for exponents in (full, sources)]
+        assert max(depths[1][k] for k in targets) == max(depths[0][k] for k in targets)
+
+
+def test_paterson_stockmeyer_query_drops_redundant_giant_steps():
+    # y^20 получается как y^10 * y^10 без увеличения глубины: запрос не больше, чем в naive
+    assert utils.query_exponents(22, "paterson_stockmeyer", 2) == [1, 2, 4, 5, 10]
+    assert len(utils.query_exponents(22, "naive", 2)) == 5
+
+
+def test_receiver_set_split_across_batches():
+    rng = np.random.default_rng(5)
+    sender_set = np.unique(rng.integers(0, 2 ** 40, size=2000, dtype=np.uint64))
+    receiver_set = np.concatenate([sender_set[::20], rng.integers(2 ** 41, 2 ** 42, size=2 * receiver_size,
+                                                                   dtype=np.uint64)])
+    assert _intersect(preprocess_sender(sender_set), receiver_set.tolist()) == set(sender_set[::20].tolist())
+
+
+def test_empty_receiver_set_rejected():
+    with pytest.raises(ValueError):
+        generate_query([])
+
+
+@pytest.mark.parametrize("server_workers, client_workers", [(1, 1), (2, 2)])
+def test_streamed_answer_matches(server_workers, client_workers):
+    rng = np.random.default_rng(9)
+    sender_set = np.unique(rng.integers(0, 2 ** 40, size=2000, dtype=np.uint64))
+    receiver_set = np.concatenate([sender_set[:30], rng.integers(2 ** 41, 2 ** 42, size=100, dtype=np.uint64)])
+    query, client_state = generate_query(receiver_set.tolist())
+    chunks = process_query_stream(query, preprocess_sender(sender_set), workers=server_workers)
+    assert finalize_answer_stream(chunks, client_state, workers=client_workers) == set(sender_set[:30].tolist())
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batched_queries_isolate_failures(workers):
+    rng = np.random.default_rng(11)
+    sender_set = np.unique(rng.integers(0, 2 ** 40, size=2000, dtype=np.uint64))
+    sender_state = preprocess_sender(sender_set)
+    receiver_sets = [np.concatenate([sender_set[i::50], rng.integers(2 ** 41, 2 ** 42, size=50, dtype=np.uint64)])
+                     for i in range(2)]
+    queries = [generate_query(receiver_set.tolist()) for receiver_set in receiver_sets]
+
+    answers = process_queries([queries[0][0], b"garbage", queries[1][0]], sender_state, workers=workers)
+    assert isinstance(answers[1], ValueError)
+    for (_, client_state), answer, receiver_set in zip(queries, answers[::2], receiver_sets):
+        assert finalize_answer(answer, client_state) == set(receiver_set[:-50].tolist())
@@ -0,0 +1,138 @@
+from math import comb, log2
+
+import numpy as np
+import pytest
+
+from hashing import SimpleHash, CuckooHash, murmur3_32_batch, hash_locations, calculate_bin_capacity
+
+import mmh3
+
+HASH_SEEDS = [31, 33, 34]
+
+
+def _items(count, seed=1):
+    rng = np.random.default_rng(seed)
+    return np.unique(rng.integers(0, 2 ** 63, size=count, dtype=np.uint64))
+
+
+def test_murmur3_batch_matches_mmh3():
+    items = np.concatenate([np.array([0, 1, 9, 10, 99, 2 ** 32, 2 ** 64 - 1], dtype=np.uint64), _items(500)])
+    for seed in HASH_SEEDS:
+        expected = [mmh3.hash(str(item), seed, signed=False) for item in items.tolist()]
+        assert murmur3_32_batch(items, seed).tolist() == expected
+
+
+@pytest.mark.parametrize("output_bits", [4, 8])
+def test_hash_locations_match_simple_hash(output_bits):
+    items = _items(300)
+    simple_hash = SimpleHash(HASH_SEEDS, output_bits, 1)
+    for seed in HASH_SEEDS:
+        expected = [simple_hash._location(seed, item) for item in items.tolist()]
+        assert hash_locations(items, seed, output_bits).tolist() == expected
+
+
+@pytest.mark.parametrize("output_bits, bin_capacity, count", [
+    (8, 32, 1000),
+    (6, 8, 300),  # часть корзин переполняется
+])
+def test_insert_many_matches_sequential_insert(output_bits, bin_capacity, count):
+    items = _items(count)
+    sequential = SimpleHash(HASH_SEEDS, output_bits, bin_capacity)
+    for item in items.tolist():
+        for h_idx in range(len(HASH_SEEDS)):
+            sequential.insert(item, h_idx)
+
+    batched = SimpleHash(HASH_SEEDS, output_bits, bin_capacity)
+    batched.insert_many(items[:count // 3])
+    batched.insert_many(items[count // 3:])
+
+    np.testing.assert_array_equal(batched.occurrences, sequential.occurrences)
+    np.testing.assert_array_equal(batched.hashed_data, sequential.hashed_data)
+    assert batched.failed == sequential.failed
+
+
+def _placed_items(cuckoo_hash):
+    """Элементы, восстановленные из занятых ячеек таблицы кукушки, с проверкой их корзин"""
+    placed = []
+    for loc in np.flatnonzero(cuckoo_hash.data != CuckooHash.EMPTY).tolist():
+        value = int(cuckoo_hash.data[loc])
+        seed = cuckoo_hash.hash_seeds[cuckoo_hash._extract_index(value)]
+        item = cuckoo_hash._reconstruct_item(value, loc, seed)
+        assert cuckoo_hash._hash_location(seed, item) == loc
+        placed.append(item)
+    return placed
+
+
+@pytest.mark.parametrize("count, seed, stash_size", [
+    (1000, 1, 4),  # заполнение около 25%
+    (225, 0, 1),
+    (228, 0, 1),  # несколько попыток
+    (231, 0, 1),  # все попытки, один элемент в stash
+])
+def test_cuckoo_build_places_or_stashes_every_item(count, seed, stash_size):
+    output_bits = 12 if count == 1000 else 8
+    items = _items(count, seed)
+    cuckoo_hash = CuckooHash(HASH_SEEDS, output_bits, stash_size=stash_size).build(items)
+
+    placed = _placed_items(cuckoo_hash)
+    assert len(placed) == len(set(placed))
+    assert len(cuckoo_hash.stash) <= stash_size
+    assert sorted(placed + cuckoo_hash.stash) == items.tolist()
+    assert cuckoo_hash.stats["items"] == items.size
+
+    # items хранит исходный элемент каждой занятой ячейки
+    occupied = np.flatnonzero(cuckoo_hash.data != CuckooHash.EMPTY)
+    assert cuckoo_hash.items[occupied].tolist() == placed
+    assert sorted(cuckoo_hash.items[occupied].tolist() + cuckoo_hash.stash) == items.tolist()
+
+
+@pytest.mark.parametrize("count, seed", [(228, 0), (231, 0)])
+def test_cuckoo_build_deterministic_across_retries(count, seed):
+    items = _items(count, seed)
+    first = CuckooHash(HASH_SEEDS, 8, stash_size=1).build(items)
+    assert first.stats["attempts"] > 1
+    # Порядок и повторы входных элементов не влияют на результат
+    second = CuckooHash(HASH_SEEDS, 8, stash_size=1).build(np.concatenate([items[::-1], items[:10]]))
+    np.testing.assert_array_equal(first.data, second.data)
+    assert first.stash == second.stash
+    assert first.stats["attempts"] == second.stats["attempts"]
+
+
+def test_cuckoo_build_fails_when_items_do_not_fit():
+    cuckoo_hash = CuckooHash(HASH_SEEDS, 4, stash_size=1)
+    with pytest.raises(RuntimeError):
+        cuckoo_hash.build(_items(40))
+    assert cuckoo_hash.failed
+
+
+def _exact_bin_capacity(security_bits, output_bits, number_of_hashes, sender_size):
+    """Исходный расчет bin_capacity на точных больших числах"""
+    m = 2 ** output_bits
+    d = number_of_hashes * sender_size
+
+    md_1 = m ** (d - 1)
+    S = m ** d
+    i = 0
+    power_of_m_1 = (m - 1) ** d
+    while True:
+        S -= comb(d, i) * power_of_m_1
+        if int(log2(md_1) - log2(S)) >= security_bits:
+            break
+        i += 1
+        power_of_m_1 //= (m - 1)
+
+    return i - 1
+
+
+@pytest.mark.parametrize("output_bits", [4, 6, 8])
+@pytest.mark.parametrize("sender_size", [16, 100, 512])
+@pytest.mark.parametrize("security_bits", [10, 20, 30, 40])
+def test_bin_capacity_matches_exact(security_bits, output_bits, sender_size):
+    assert calculate_bin_capacity(security_bits, output_bits, 3, sender_size) == \
+           _exact_bin_capacity(security_bits, output_bits, 3, sender_size)
+
+
+@pytest.mark.parametrize("number_of_hashes", [1, 2, 3])
+def test_bin_capacity_matches_exact_number_of_hashes(number_of_hashes):
+    assert calculate_bin_capacity(30, 7, number_of_hashes, 1000) == \
+           _exact_bin_capacity(30, 7, number_of_hashes, 1000)
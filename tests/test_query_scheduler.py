@@ -0,0 +1,26 @@
+import pytest
+
+from jobs import QueueFullError
+from query_scheduler import QueryScheduler
+
+
+@pytest.fixture
+def scheduler():
+    # Окно больше времени теста: запросы остаются в очереди до shutdown
+    scheduler = QueryScheduler(workers=1, window=60, batch_size=10, queue_size=2)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def test_streams_share_query_admission(scheduler):
+    scheduler.acquire_stream()
+    scheduler.submit("state", None, b"query")
+    assert scheduler.stats() == {"queued_queries": 1, "queued_states": 1, "streaming_queries": 1}
+    with pytest.raises(QueueFullError):
+        scheduler.acquire_stream()
+    with pytest.raises(QueueFullError):
+        scheduler.submit("state", None, b"query")
+
+    scheduler.release_stream()
+    scheduler.acquire_stream()
+    assert scheduler.stats()["streaming_queries"] == 1
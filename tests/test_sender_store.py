@@ -0,0 +1,25 @@
+import numpy as np
+
+import sender_store
+from sender_store import SenderStateStore, set_digest
+
+
+def _sender_set():
+    return np.unique(np.random.default_rng(3).integers(0, 2 ** 40, size=500, dtype=np.uint64))
+
+
+def test_state_reloaded_from_disk(tmp_path):
+    sender_set = _sender_set()
+    digest = SenderStateStore(str(tmp_path)).register(sender_set)
+    assert digest == set_digest(sender_set)
+
+    state = SenderStateStore(str(tmp_path)).get(digest)
+    assert state["digest"] == digest
+    assert isinstance(state["poly_coeffs"], np.memmap)
+
+
+def test_state_with_other_params_is_a_miss(tmp_path, monkeypatch):
+    digest = SenderStateStore(str(tmp_path)).register(_sender_set())
+    params = sender_store.sender_params()
+    monkeypatch.setattr(sender_store, "sender_params", lambda: dict(params, alpha=params["alpha"] + 1))
+    assert SenderStateStore(str(tmp_path)).get(digest) is None
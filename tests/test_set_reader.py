@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from set_reader import SetReader, SetTooLargeError, TEXT, BINARY, parse_decimal, read_set_file, resolve_format
+
+UINT64_MAX = 2 ** 64 - 1
+
+
+def _values(count=5000, seed=3):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 2 ** 63, size=count, dtype=np.uint64)
+    # Повторы и крайние значения
+    return np.concatenate([values, values[:count // 10], np.array([0, 1, UINT64_MAX], dtype=np.uint64)])
+
+
+def _text(values):
+    separators = [b"\n", b" ", b",", b"\r\n", b"\t", b", "]
+    return b"".join(str(value).encode() + separators[i % len(separators)] for i, value in enumerate(values.tolist()))
+
+
+def _read(fmt, data, step, **kwargs):
+    reader = SetReader(fmt, **kwargs)
+    for offset in range(0, len(data), step):
+        reader.feed(data[offset:offset + step])
+    return reader.finish()
+
+
+@pytest.mark.parametrize("step", [1, 3, 8, 13, 4096, 1 << 30])
+def test_text_chunk_boundaries(step):
+    values = _values(500)
+    result = _read(TEXT, _text(values), step, merge_threshold=64)
+    assert result.dtype == np.uint64
+    np.testing.assert_array_equal(result, np.unique(values))
+
+
+@pytest.mark.parametrize("step", [1, 5, 8, 13, 4096])
+def test_binary_chunk_boundaries(step):
+    values = _values(500)
+    result = _read(BINARY, values.astype("<u8").tobytes(), step, merge_threshold=64)
+    np.testing.assert_array_equal(result, np.unique(values))
+
+
+def test_text_without_trailing_separator():
+    assert _read(TEXT, b"5 3\n5,18446744073709551615", 4).tolist() == [3, 5, UINT64_MAX]
+    assert _read(TEXT, b"", 1).size == 0
+    assert _read(TEXT, b" \n,\n", 1).size == 0
+
+
+@pytest.mark.parametrize("data", [
+    b"18446744073709551616",
+    b"1 99999999999999999999\n",
+    b"123456789012345678901234567890",
+])
+@pytest.mark.parametrize("step", [1, 7, 1 << 20])
+def test_saturated_values_rejected(data, step):
+    # fromstring насыщает переполнение до 2^64 - 1: такие числа не должны превращаться в UINT64_MAX
+    with pytest.raises(ValueError):
+        _read(TEXT, data, step)
+
+
+@pytest.mark.parametrize("data", [b"1 -2", b"1.5", b"0x10", b"12a"])
+def test_invalid_text_rejected(data):
+    with pytest.raises(ValueError):
+        _read(TEXT, data, 2)
+
+
+def test_binary_tail_rejected():
+    with pytest.raises(ValueError):
+        _read(BINARY, b"\1" * 12, 4)
+
+
+def test_dedup_and_max_items():
+    values = np.array([7, 3, 7, 7, 3, 1], dtype=np.uint64)
+    assert _read(TEXT, _text(np.tile(values, 100)), 5, max_items=3, merge_threshold=4).tolist() == [1, 3, 7]
+    with pytest.raises(SetTooLargeError):
+        _read(TEXT, _text(np.arange(10, dtype=np.uint64)), 5, max_items=9, merge_threshold=4)
+
+
+def test_parse_decimal_and_formats(tmp_path):
+    assert parse_decimal(b"1,2 3\n").tolist() == [1, 2, 3]
+    assert resolve_format("auto", "set.bin") == BINARY and resolve_format("auto", "set.txt") == TEXT
+    with pytest.raises(ValueError):
+        resolve_format("csv")
+
+    values = _values(300)
+    (tmp_path / "set.txt").write_bytes(_text(values))
+    (tmp_path / "set.u64").write_bytes(values.astype("<u8").tobytes())
+    for name in ("set.txt", "set.u64"):
+        np.testing.assert_array_equal(read_set_file(str(tmp_path / name), chunk_size=100), np.unique(values))
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+from config import hash_seeds, output_bits, alpha, plain_modulus
+from hashing import SimpleHash
+from server_logic import preprocess_sender, update_sender
+from utils import coeffs_from_roots_batch
+
+SET_SIZE = 3000
+
+
+@pytest.fixture
+def sender_set():
+    rng = np.random.default_rng(2024)
+    return np.unique(rng.integers(0, 2 ** 40, size=SET_SIZE, dtype=np.uint64))
+
+
+def _snapshot(state):
+    return {key: np.array(state[key]) for key in ("table", "occurrences", "poly_coeffs")}
+
+
+def _bins(state):
+    """Содержимое корзин без учета порядка элементов"""
+    return [sorted(row[:count].tolist()) for row, count in zip(state["table"], state["occurrences"])]
+
+
+def _check_coeffs(state):
+    """Коэффициенты совпадают с пересчитанными по всей таблице состояния"""
+    minibin_capacity = state["minibin_capacity"]
+    table = state["table"]
+    roots = table[:, :alpha * minibin_capacity].reshape(len(table), alpha, minibin_capacity)
+    expected = coeffs_from_roots_batch(roots, plain_modulus).reshape(len(table), -1)
+    np.testing.assert_array_equal(state["poly_coeffs"], expected)
+
+
+def _new_items(sender_set, count, seed=7):
+    rng = np.random.default_rng(seed)
+    return np.setdiff1d(rng.integers(0, 2 ** 40, size=count, dtype=np.uint64), sender_set)
+
+
+@pytest.mark.parametrize("workers", [2, 3])
+def test_parallel_preprocess_matches_sequential(sender_set, workers):
+    expected = _snapshot(preprocess_sender(sender_set, workers=1))
+    for _ in range(2):  # второй вызов - в уже созданном пуле
+        state = preprocess_sender(sender_set, workers=workers)
+        for key, value in expected.items():
+            np.testing.assert_array_equal(state[key], value)
+
+
+def test_update_matches_fresh_preprocess(sender_set):
+    state = preprocess_sender(sender_set)
+    added = _new_items(sender_set, 200)
+    removed = sender_set[::15]
+
+    updated = update_sender(state, added=added, removed=removed)
+
+    expected = preprocess_sender(np.union1d(np.setdiff1d(sender_set, removed), added))
+    np.testing.assert_array_equal(updated["occurrences"], expected["occurrences"])
+    assert _bins(updated) == _bins(expected)
+    _check_coeffs(updated)
+    # Новая ревизия: закодированные коэффициенты прежнего состояния не переиспользуются
+    assert updated["revision"] == state.get("revision", 0) + 1
+
+
+def test_add_remove_round_trip(sender_set):
+    state = preprocess_sender(sender_set)
+    original = _snapshot(state)
+    added = _new_items(sender_set, 300)
+
+    updated = update_sender(state, added=added)
+    assert int(updated["occurrences"].sum()) == int(original["occurrences"].sum()) + len(hash_seeds) * added.size
+    _check_coeffs(updated)
+
+    # Добавленные элементы лежат в конце корзин: после удаления состояние восстанавливается точно
+    restored = update_sender(updated, removed=added)
+    for key, value in original.items():
+        np.testing.assert_array_equal(restored[key], value)
+
+
+def test_remove_add_round_trip(sender_set):
+    state = preprocess_sender(sender_set)
+    original_bins = _bins(state)
+    original_occurrences = np.array(state["occurrences"])
+    removed = sender_set[1::7]
+
+    updated = update_sender(state, removed=removed)
+    assert int(updated["occurrences"].sum()) == int(original_occurrences.sum()) - len(hash_seeds) * removed.size
+    _check_coeffs(updated)
+
+    # Удаление переставляет элементы корзин: сравниваем содержимое и коэффициенты
+    restored = update_sender(updated, added=removed)
+    np.testing.assert_array_equal(restored["occurrences"], original_occurrences)
+    assert _bins(restored) == original_bins
+    _check_coeffs(restored)
+
+
+def test_present_and_absent_items_ignored(sender_set):
+    state = preprocess_sender(sender_set)
+    original = _snapshot(state)
+
+    updated = update_sender(state, added=sender_set[:100], removed=_new_items(sender_set, 100))
+    for key, value in original.items():
+        np.testing.assert_array_equal(updated[key], value)
+
+
+def test_overflow_leaves_state_unchanged(sender_set):
+    state = preprocess_sender(sender_set)
+    original = _snapshot(state)
+    capacity = alpha * state["minibin_capacity"]
+
+    # Элементы, попадающие в одну корзину, пока она не переполнится
+    simple_hash = SimpleHash(hash_seeds, output_bits, state["table"].shape[1])
+    candidates = _new_items(sender_set, 1 << 20, seed=11)
+    locations, _ = simple_hash.locate_many(candidates)
+    target = int(locations[0, 0])
+    hits = (locations == target).sum(axis=1)
+    chosen = np.flatnonzero(hits)[:capacity + 1]
+    assert hits[chosen].sum() + state["occurrences"][target] > capacity
+
+    with pytest.raises(ValueError):
+        update_sender(state, added=candidates[chosen])
+    for key, value in original.items():
+        np.testing.assert_array_equal(state[key], value)
+
+
+def test_sharded_state_rejected():
+    with pytest.raises(ValueError):
+        update_sender({"shards": [], "params": {}}, added=[1])
@@ -0,0 +1,122 @@
+from math import ceil, log2
+
+import numpy as np
+import pytest
+
+from utils import mul_mod, pow_mod_batch, coeffs_from_roots_batch, coeffs_from_roots, plan_powers, compute_powers
+
+MODULI = [
+    65537,
+    1000112129,
+    2 ** 32,
+    2 ** 32 + 15,
+    2 ** 40 - 87,
+    2 ** 47 - 115,
+    2 ** 61 - 1,
+]
+
+
+def _expand(roots, modulus):
+    """Коэффициенты prod(x - root) в целых числах Python, от старшей степени к младшей"""
+    coefficients = [1]
+    for root in roots:
+        shifted = coefficients + [0]
+        for i, c in enumerate(coefficients):
+            shifted[i + 1] -= c * root
+        coefficients = shifted
+    return [c % modulus for c in coefficients]
+
+
+@pytest.mark.parametrize("modulus", MODULI)
+def test_mul_mod_matches_python_ints(modulus):
+    rng = np.random.default_rng(modulus % 1000)
+    a = rng.integers(0, modulus, size=1000, dtype=np.uint64)
+    b = rng.integers(0, modulus, size=1000, dtype=np.uint64)
+    a[:2] = b[:2] = modulus - 1
+    expected = [x * y % modulus for x, y in zip(a.tolist(), b.tolist())]
+    assert mul_mod(a, b, modulus).tolist() == expected
+
+
+@pytest.mark.parametrize("modulus", MODULI)
+def test_pow_mod_batch_matches_pow(modulus):
+    rng = np.random.default_rng(modulus % 997)
+    # Значения ячеек таблицы кукушки - до 2^64, в том числе больше модуля
+    values = rng.integers(0, 2 ** 63, size=200, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    values[:3] = [0, 1, modulus - 1]
+    exponents = [1, 2, 3, 4, 8, 12, 16, 31, 64, 1000]
+    result = pow_mod_batch(values, exponents, modulus)
+    assert result.shape == (len(exponents), values.size)
+    for row, exponent in enumerate(exponents):
+        assert result[row].tolist() == [pow(value, exponent, modulus) for value in values.tolist()]
+
+
+@pytest.mark.parametrize("modulus", MODULI)
+@pytest.mark.parametrize("degree", [1, 2, 7, 16])
+def test_coeffs_from_roots_batch_matches_python_ints(modulus, degree):
+    rng = np.random.default_rng(degree)
+    # Корни - закодированные элементы таблицы отправителя, в том числе больше модуля
+    roots = rng.integers(0, 2 ** 62, size=(5, 3, degree), dtype=np.int64)
+    coefficients = coeffs_from_roots_batch(roots, modulus)
+    assert coefficients.shape == (5, 3, degree + 1)
+    for index in np.ndindex(5, 3):
+        assert coefficients[index].tolist() == _expand(roots[index].tolist(), modulus)
+
+
+def test_coeffs_from_roots_vanish_at_roots():
+    modulus = 1000112129
+    roots = [3, 17, 17, 123456789]
+    coefficients = coeffs_from_roots(roots, modulus).tolist()
+    for root in roots:
+        assert sum(c * pow(root, len(roots) - i, modulus) for i, c in enumerate(coefficients)) % modulus == 0
+
+
+def _windowed(degree, base_value):
+    """Степени, которые клиент отправляет в оконном методе: (i + 1) * base^j <= degree"""
+    return tuple(sorted((i + 1) * base_value ** j for j in range(degree.bit_length())
+                        for i in range(base_value - 1) if (i + 1) * base_value ** j <= degree))
+
+
+def _nonzero_digits(exponent, base_value):
+    """Количество оконных степеней в разложении exponent по основанию"""
+    digits = 0
+    while exponent:
+        digits += exponent % base_value > 0
+        exponent //= base_value
+    return digits
+
+
+@pytest.mark.parametrize("ell", [1, 2, 3])
+@pytest.mark.parametrize("degree", [1, 2, 5, 11, 22, 44, 100])
+def test_plan_powers_steps_and_depth(ell, degree):
+    base_value = 2 ** ell
+    sources = _windowed(degree, base_value)
+    targets = tuple(range(1, degree + 1))
+    steps, depths = plan_powers(sources, targets)
+
+    # Каждый шаг использует уже доступные степени, каждая степень вычисляется один раз
+    depth = dict.fromkeys(sources, 0)
+    for k, a, b in steps:
+        assert k == a + b and k not in depth
+        assert a in depth and b in depth
+        depth[k] = max(depth[a], depth[b]) + 1
+    assert set(targets) <= set(depth)
+    assert all(depths[k] == depth[k] for k in depths)
+
+    # Общий граф не глубже и не дороже произведения оконных степеней деревом для каждой степени отдельно
+    digits = {k: _nonzero_digits(k, base_value) for k in targets}
+    for k in targets:
+        assert depth[k] <= ceil(log2(digits[k]))
+    assert len(steps) <= sum(digits[k] - 1 for k in targets)
+    # Промежуточные степени - только требуемые: одно умножение на каждую недостающую степень
+    assert len(steps) == len(set(targets) - set(sources))
+
+
+def test_plan_powers_unreachable():
+    with pytest.raises(ValueError):
+        plan_powers((2,), (3,))
+
+
+def test_compute_powers_values():
+    sources = _windowed(22, 4)
+    powers = compute_powers({k: 3 ** k for k in sources}, range(1, 23))
+    assert all(powers[k] == 3 ** k for k in range(1, 23))
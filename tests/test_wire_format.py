@@ -0,0 +1,179 @@
+import struct
+
+import pytest
+
+import wire_format
+from wire_format import protocol_params, check_params, encode_query, decode_query, encode_answer, \
+    decode_answer, iter_answer, AnswerReader, MAGIC_COMPRESSED, FINGERPRINT_SIZE
+
+PARAMS = protocol_params(3)
+FINGERPRINT = bytes(range(FINGERPRINT_SIZE))
+EXPONENTS = [1, 2, 4]
+CONTEXT = b"public context"
+QUERY_BATCHES = [[b"ct-1-1", b"ct-1-2", b"ct-1-4"], [b"ct-2-1", b"", b"ct-2-4" * 100]]
+ANSWER_BATCHES = [[b"answer-1-%d" % i for i in range(4)], [b"answer-2-%d" % i * 50 for i in range(4)]]
+
+
+@pytest.fixture(params=[0, 6], ids=["plain", "zlib"])
+def compression(request, monkeypatch):
+    monkeypatch.setattr(wire_format, "wire_compression", request.param)
+    return request.param
+
+
+def _answer_blocks(batches):
+    return [(b, i, block) for b, batch in enumerate(batches) for i, block in enumerate(batch)]
+
+
+def _patch_header(data, **fields):
+    """Переписывает поля заголовка несжатого сообщения"""
+    names = ["magic", "version", "type", "mode", "bits", "degree", "modulus", "alpha", "capacity", "segments",
+             "batches", "count"]
+    values = dict(zip(names, wire_format._HEADER.unpack_from(data)))
+    values.update(fields)
+    return wire_format._HEADER.pack(*(values[name] for name in names)) + data[wire_format._HEADER.size:]
+
+
+def test_query_round_trip(compression):
+    for context in (CONTEXT, None):
+        data = encode_query(PARAMS, EXPONENTS, FINGERPRINT, context, QUERY_BATCHES)
+        assert data.startswith(MAGIC_COMPRESSED) == bool(compression)
+        query = decode_query(data)
+        check_params(query["params"], PARAMS)
+        assert query["exponents"] == EXPONENTS
+        assert query["fingerprint"] == FINGERPRINT
+        assert (None if query["context"] is None else bytes(query["context"])) == context
+        assert [[bytes(ct) for ct in batch] for batch in query["batches"]] == QUERY_BATCHES
+
+
+def test_query_fingerprint_size_checked():
+    with pytest.raises(ValueError):
+        encode_query(PARAMS, EXPONENTS, FINGERPRINT[:-1], CONTEXT, QUERY_BATCHES)
+
+
+def test_answer_round_trip(compression):
+    answer = decode_answer(encode_answer(PARAMS, ANSWER_BATCHES))
+    check_params(answer["params"], PARAMS)
+    assert [[bytes(ct) for ct in batch] for batch in answer["batches"]] == ANSWER_BATCHES
+
+
+def test_iter_answer_matches_encode_answer(compression):
+    count = sum(len(batch) for batch in ANSWER_BATCHES)
+    blocks = [block for batch in ANSWER_BATCHES for block in batch]
+    streamed = b"".join(iter_answer(PARAMS, len(ANSWER_BATCHES), count, iter(blocks)))
+    if not compression:
+        assert streamed == encode_answer(PARAMS, ANSWER_BATCHES)
+    answer = decode_answer(streamed)
+    assert [[bytes(ct) for ct in batch] for batch in answer["batches"]] == ANSWER_BATCHES
+
+
+def test_iter_answer_rejects_wrong_block_count():
+    with pytest.raises(RuntimeError):
+        b"".join(iter_answer(PARAMS, 1, 3, iter([b"a", b"b"])))
+
+
+def test_check_params_mismatch():
+    with pytest.raises(ValueError):
+        check_params(PARAMS, protocol_params(4))
+
+
+@pytest.mark.parametrize("decode, data", [
+    (decode_query, encode_query(PARAMS, EXPONENTS, FINGERPRINT, CONTEXT, QUERY_BATCHES)),
+    (decode_answer, encode_answer(PARAMS, ANSWER_BATCHES)),
+], ids=["query", "answer"])
+def test_truncated_and_padded_messages_rejected(decode, data):
+    for size in range(len(data)):
+        with pytest.raises(ValueError):
+            decode(data[:size])
+    with pytest.raises(ValueError):
+        decode(data + b"\0")
+
+
+def test_truncated_compressed_message_rejected(monkeypatch):
+    monkeypatch.setattr(wire_format, "wire_compression", 6)
+    data = encode_answer(PARAMS, ANSWER_BATCHES)
+    for size in range(len(MAGIC_COMPRESSED), len(data)):
+        with pytest.raises(ValueError):
+            decode_answer(data[:size])
+
+
+@pytest.mark.parametrize("fields", [
+    {"count": wire_format.MAX_BLOCKS + 1},
+    {"count": 0xFFFFFFFF},
+    {"count": 9},
+    {"batches": 0},
+    {"batches": 3},
+    {"segments": 0},
+    {"mode": 7},
+    {"magic": b"XXX"},
+    {"version": wire_format.VERSION + 1},
+    {"type": wire_format.QUERY},
+], ids=lambda fields: ",".join(fields))
+def test_invalid_answer_header_rejected(fields):
+    data = _patch_header(encode_answer(PARAMS, ANSWER_BATCHES), **fields)
+    with pytest.raises(ValueError):
+        decode_answer(data)
+    reader = AnswerReader()
+    with pytest.raises(ValueError):
+        reader.feed(data)
+        reader.finish()
+
+
+@pytest.mark.parametrize("fields", [
+    {"count": 0},
+    {"count": wire_format.MAX_BLOCKS + 1},
+    {"count": 0xFFFFFFFF},
+    {"batches": 0},
+    {"batches": 4},
+], ids=lambda fields: ",".join(f"{key}={value}" for key, value in fields.items()))
+def test_invalid_query_header_rejected(fields):
+    data = _patch_header(encode_query(PARAMS, EXPONENTS, FINGERPRINT, CONTEXT, QUERY_BATCHES), **fields)
+    with pytest.raises(ValueError):
+        decode_query(data)
+
+
+def test_oversize_block_length_rejected():
+    data = encode_answer(PARAMS, [[b"abc"]])
+    offset = wire_format._HEADER.size
+    data = data[:offset] + struct.pack("<I", 0xFFFFFFFF) + data[offset + 4:]
+    with pytest.raises(ValueError):
+        decode_answer(data)
+    reader = AnswerReader()
+    reader.feed(data)
+    with pytest.raises(ValueError):
+        reader.finish()
+
+
+def test_decompressed_size_limited(monkeypatch):
+    monkeypatch.setattr(wire_format, "wire_compression", 9)
+    data = encode_answer(PARAMS, [[b"\0" * 100000]])
+    monkeypatch.setattr(wire_format, "MAX_MESSAGE_SIZE", 1000)
+    with pytest.raises(ValueError):
+        decode_answer(data)
+    with pytest.raises(ValueError):
+        AnswerReader().feed(data)
+
+
+@pytest.mark.parametrize("step", [1, 7, 1 << 20])
+def test_answer_reader_streams_blocks(compression, step):
+    count = sum(len(batch) for batch in ANSWER_BATCHES)
+    blocks = [block for batch in ANSWER_BATCHES for block in batch]
+    data = b"".join(iter_answer(PARAMS, len(ANSWER_BATCHES), count, iter(blocks)))
+    reader = AnswerReader()
+    received = []
+    for offset in range(0, len(data), step):
+        received.extend(reader.feed(data[offset:offset + step]))
+    reader.finish()
+    assert reader.params == PARAMS and reader.batches == len(ANSWER_BATCHES)
+    assert received == _answer_blocks(ANSWER_BATCHES)
+
+
+def test_answer_reader_rejects_truncation_and_trailing_data(compression):
+    data = encode_answer(PARAMS, ANSWER_BATCHES)
+    for size in range(len(data)):
+        reader = AnswerReader()
+        with pytest.raises(ValueError):
+            reader.feed(data[:size])
+            reader.finish()
+    if not compression:
+        with pytest.raises(ValueError):
+            AnswerReader().feed(data + b"\0")
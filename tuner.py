@@ -0,0 +1,406 @@
+import argparse
+import os
+import re
+import statistics
+import time
+from functools import lru_cache
+from math import ceil, log2
+
+import numpy as np
+import tenseal as ts
+import tenseal.sealapi as sealapi
+
+from config import plain_modulus, number_of_hashes, answer_noise_margin, sender_max_shards, receiver_max_batches
+from hashing import calculate_bin_capacity
+from seal_io import save_bytes, load_ciphertext
+from utils import query_exponents, power_targets, plan_powers, ps_parameters
+
+# Перебираемые значения параметров
+DEGREES = (4096, 8192, 16384, 32768)
+OUTPUT_BITS = range(10, 16)
+ELLS = (1, 2, 3, 4)
+MODES = ("naive", "paterson_stockmeyer")
+MAX_BATCHES = 64
+
+# Время операций (мс) и отношение размера сериализованного шифротекста к числу битов коэффициентов,
+# измеренные на одном ядре эталонной машины (32768 - экстраполяция: при plain_modulus по умолчанию
+# пакетное кодирование для нее недоступно). calibrate() заменяет их измерениями на локальной машине.
+#   encrypt - кодирование, симметричное шифрование и сериализация степени y (клиент)
+#   load - загрузка шифротекста запроса (сервер), mul - умножение шифротекстов с релинеаризацией,
+#   mul_plain/add - умножение на открытый текст и сложение, save - переключение модуля и сериализация
+#   ответа, decrypt - загрузка, расшифровка и декодирование ответа (клиент)
+REFERENCE_COSTS = {
+    4096: {"encrypt": 1.57, "load": 0.38, "mul": 3.55, "mul_plain": 0.47, "add": 0.02, "save": 0.62,
+           "decrypt": 0.51, "overhead": 1.26},
+    8192: {"encrypt": 3.75, "load": 1.3, "mul": 15.0, "mul_plain": 2.11, "add": 0.06, "save": 1.55,
+           "decrypt": 0.94, "overhead": 1.17},
+    16384: {"encrypt": 12.7, "load": 5.27, "mul": 74.8, "mul_plain": 9.15, "add": 0.23, "save": 5.98,
+            "decrypt": 1.7, "overhead": 1.14},
+    32768: {"encrypt": 48.0, "load": 20.0, "mul": 525.0, "mul_plain": 34.0, "add": 0.85, "save": 22.0,
+            "decrypt": 3.4, "overhead": 1.14},
+}
+
+# Модель шума BFV (биты бюджета): свежий шифротекст имеет около Q - log2(t) - FRESH_NOISE бит,
+# умножение шифротекстов расходует log2(t) + log2(n) / 2 + MUL_NOISE бит, умножение на
+# открытый текст - log2(t) + log2(n) / 2 + PLAIN_NOISE бит (сверено с invariant_noise_budget)
+FRESH_NOISE = 5
+MUL_NOISE = 6
+PLAIN_NOISE = -1
+
+
+def supports_batching(degree: int, modulus: int = plain_modulus) -> bool:
+    """Пакетное кодирование BFV требует plain_modulus = 1 (mod 2 * poly_modulus_degree)"""
+    return (modulus - 1) % (2 * degree) == 0
+
+
+def data_modulus_bits(degree: int) -> list:
+    """
+    Размеры простых модулей цепочки данных BFV для контекста TenSEAL по умолчанию
+    (CoeffModulus.BFVDefault без специального модуля ключей).
+    """
+    return [m.bit_count() for m in sealapi.CoeffModulus.BFVDefault(degree, sealapi.SEC_LEVEL_TYPE.TC128)[:-1]]
+
+
+def noise_budget(degree: int, depth: int, minibin_capacity: int, mode: str, modulus: int = plain_modulus) -> float:
+    """
+    Оценка бюджета шума ответа (бит) до переключения модуля.
+    :param depth: мультипликативная глубина восстановления степеней y
+    """
+    t_bits = log2(modulus)
+    fresh = sum(data_modulus_bits(degree)) - t_bits - FRESH_NOISE
+    mul = t_bits + log2(degree) / 2 + MUL_NOISE
+    plain = t_bits + log2(degree) / 2 + PLAIN_NOISE
+    if mode == "paterson_stockmeyer":
+        depth += 1
+    return fresh - depth * mul - plain - log2(minibin_capacity + 1)
+
+
+def answer_modulus_bits(degree: int, modulus: int = plain_modulus, margin=answer_noise_margin) -> int:
+    """
+    Количество битов модуля ответа после переключения модуля (как _answer_parms_id в server_logic).
+    """
+    primes = data_modulus_bits(degree)
+    if margin is None:
+        return sum(primes)
+    required = log2(modulus) + log2(degree) / 2 + 1 + margin
+    levels = [sum(primes[:k]) for k in range(1, len(primes) + 1)]
+    return min((bits for bits in levels if bits >= required), default=sum(primes))
+
+
+def _median_ms(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate(degrees=DEGREES, repeats: int = 5, modulus: int = plain_modulus) -> dict:
+    """
+    Измеряет время операций и размеры шифротекстов на локальной машине.
+    :return: словарь того же вида, что REFERENCE_COSTS, для степеней с пакетным кодированием
+    """
+    costs = {}
+    for degree in degrees:
+        if not supports_batching(degree, modulus):
+            continue
+        ctx = ts.context(ts.SCHEME_TYPE.BFV, poly_modulus_degree=degree, plain_modulus=modulus)
+        seal_context = ctx.seal_context().data
+        encoder = sealapi.BatchEncoder(seal_context)
+        evaluator = sealapi.Evaluator(seal_context)
+        encryptor = sealapi.Encryptor(seal_context, ctx.secret_key().data)
+        decryptor = sealapi.Decryptor(seal_context, ctx.secret_key().data)
+        relin_keys = ctx.relin_keys().data
+
+        values = np.random.randint(0, modulus, degree).astype(np.uint64)
+        plaintext = sealapi.Plaintext()
+        encoder.encode(values, plaintext)
+
+        def encrypt():
+            encoder.encode(values, plaintext)
+            return save_bytes(encryptor.encrypt_symmetric(plaintext))
+
+        query_ct = encrypt()
+        ciphertext = load_ciphertext(seal_context, query_ct)
+        result = sealapi.Ciphertext(seal_context)
+
+        def mul():
+            evaluator.multiply(ciphertext, ciphertext, result)
+            evaluator.relinearize_inplace(result, relin_keys)
+
+        def save():
+            answer = sealapi.Ciphertext()
+            evaluator.mod_switch_to(ciphertext, seal_context.last_parms_id(), answer)
+            return save_bytes(answer)
+
+        answer_ct = save()
+
+        def decrypt():
+            decryptor.decrypt(load_ciphertext(seal_context, answer_ct), plaintext)
+            return encoder.decode_uint64(plaintext)
+
+        product = sealapi.Ciphertext()
+        costs[degree] = {
+            "encrypt": _median_ms(encrypt, repeats),
+            "load": _median_ms(lambda: load_ciphertext(seal_context, query_ct), repeats),
+            "mul": _median_ms(mul, repeats),
+            "mul_plain": _median_ms(lambda: evaluator.multiply_plain(ciphertext, plaintext, product), repeats),
+            "add": _median_ms(lambda: evaluator.add_inplace(result, ciphertext), repeats),
+            "save": _median_ms(save, repeats),
+            "decrypt": _median_ms(decrypt, repeats),
+            # Ответ на последнем уровне: 2 полинома по модулю первого простого числа
+            "overhead": len(answer_ct) / (2 * degree * data_modulus_bits(degree)[0] / 8),
+        }
+    return costs
+
+
+def _max_digits(bound: int, base_value: int) -> int:
+    """Наибольшее количество ненулевых цифр по основанию base_value среди чисел 1..bound"""
+    best, prefix = 0, 0
+    digits = []
+    while bound:
+        digits.append(bound % base_value)
+        bound //= base_value
+    for position in range(len(digits) - 1, -1, -1):
+        if digits[position]:
+            # Цифра меньше текущей, дальше все цифры ненулевые
+            lower = prefix + (digits[position] > 1) + position
+            best = max(best, lower)
+            prefix += 1
+    return max(best, prefix)
+
+
+def window_depth(minibin_capacity: int, mode: str, ell: int) -> int:
+    """
+    Мультипликативная глубина восстановления степеней y из оконных степеней: степень из
+    d ненулевых цифр по основанию 2 ** ell собирается за ceil(log2(d)) умножений.
+    Совпадает с глубиной плана plan_powers и вычисляется без него.
+    """
+    base_value = 2 ** ell
+    if mode == "paterson_stockmeyer":
+        low, giant = ps_parameters(minibin_capacity)
+        digits = max(_max_digits(min(low - 1, minibin_capacity), base_value), _max_digits(giant, base_value))
+    else:
+        digits = _max_digits(minibin_capacity, base_value)
+    return ceil(log2(digits)) if digits > 1 else 0
+
+
+@lru_cache(maxsize=None)
+def _query_plan(minibin_capacity: int, mode: str, ell: int):
+    """
+    Степени запроса и оценка снизу количества умножений: по одному на каждую требуемую
+    степень, которой нет в запросе (точное число дает plan_powers, см. refine).
+    """
+    exponents = tuple(query_exponents(minibin_capacity, mode, 2 ** ell))
+    missing = set(power_targets(minibin_capacity, mode)) - set(exponents)
+    return exponents, len(missing)
+
+
+def refine(params: dict) -> dict:
+    """
+    Уточняет количество умножений шифротекстов по плану plan_powers (квадратичен по степени
+    полинома, поэтому выполняется только для лучших наборов).
+    """
+    m, mode = params["minibin_capacity"], params["evaluation_mode"]
+    steps, _ = plan_powers(tuple(query_exponents(m, mode, 2 ** params["ell"])), tuple(power_targets(m, mode)))
+    return dict(params, power_multiplications=len(steps))
+
+
+def candidates(sender_total: int, receiver_total: int, security_bits: int = 30, max_load: float = 0.4,
+               noise_margin: float = 10, modulus: int = plain_modulus):
+    """
+    Перебирает корректные наборы параметров.
+    Отбрасываются наборы без пакетного кодирования, с корзинами, не помещающимися в слоты,
+    с alpha * minibin_capacity < bin_capacity (элементы корзины не попали бы в миникорзины)
+    и с бюджетом шума ответа меньше noise_margin бит.
+    :param sender_total: размер множества отправителя
+    :param receiver_total: размер множества получателя
+    :param security_bits: уровень безопасности для bin_capacity (bin_security_bits)
+    :param max_load: доля заполнения таблицы кукушки получателя
+    :param noise_margin: запас бюджета шума в битах на погрешность модели
+    """
+    shard_sizes = sorted({min(2 ** k, sender_total) for k in range(12, max(12, ceil(log2(sender_total))) + 1)})
+    for shard_size in shard_sizes:
+        shards = ceil(sender_total / shard_size)
+        for bits in OUTPUT_BITS:
+            table_size = int(max_load * 2 ** bits)
+            batches = ceil(receiver_total / table_size)
+            if batches > MAX_BATCHES:
+                continue
+            bin_capacity = calculate_bin_capacity(security_bits, bits, number_of_hashes, shard_size)
+            alphas = [a for a in range(1, bin_capacity + 1) if bin_capacity % a == 0 and a <= 0xFFFF]
+            for degree in DEGREES:
+                if degree < 2 ** bits or not supports_batching(degree, modulus):
+                    continue
+                for alpha in alphas:
+                    minibin_capacity = bin_capacity // alpha
+                    for mode in MODES:
+                        previous = None
+                        for ell in ELLS:
+                            # Бюджет шума проверяется до дорогого планирования умножений
+                            depth = window_depth(minibin_capacity, mode, ell)
+                            budget = noise_budget(degree, depth, minibin_capacity, mode, modulus)
+                            if budget < noise_margin:
+                                continue
+                            # Большее основание окна не меняет запрос для малой степени
+                            exponents, multiplications = _query_plan(minibin_capacity, mode, ell)
+                            if exponents == previous:
+                                continue
+                            previous = exponents
+                            yield {
+                                "sender_size": shard_size,
+                                "sender_max_shards": max(shards, sender_max_shards),
+                                "receiver_size": min(table_size, receiver_total),
+                                "receiver_max_batches": max(batches, receiver_max_batches),
+                                "shards": shards,
+                                "batches": batches,
+                                "output_bits": bits,
+                                "bin_security_bits": security_bits,
+                                "poly_modulus_degree": degree,
+                                "alpha": alpha,
+                                "ell": ell,
+                                "evaluation_mode": mode,
+                                "slot_packing": True,
+                                "bin_capacity": bin_capacity,
+                                "minibin_capacity": minibin_capacity,
+                                "query_ciphertexts": len(exponents),
+                                "power_multiplications": multiplications,
+                                "depth": depth,
+                                "noise_budget": budget,
+                            }
+
+
+def estimate(params: dict, costs: dict, bandwidth: float = 12.5e6, server_weight: float = 1,
+             client_weight: float = 1, modulus: int = plain_modulus) -> dict:
+    """
+    Оценка стоимости одного запроса: время сервера и клиента и объем передаваемых данных.
+    :param costs: время операций по степеням (REFERENCE_COSTS или calibrate())
+    :param bandwidth: пропускная способность канала в байтах в секунду
+    :param server_weight: вес времени сервера в итоговой задержке
+    :param client_weight: вес времени клиента в итоговой задержке
+    :return: {"server", "client", "query_bytes", "answer_bytes", "latency"}, время в секундах
+    """
+    degree = params["poly_modulus_degree"]
+    cost = costs[degree]
+    m = params["minibin_capacity"]
+    batches = params["batches"]
+    segments = max(1, degree >> params["output_bits"])
+    groups = ceil(params["alpha"] / segments)
+    answers = batches * params["shards"] * groups
+
+    per_group = m * (cost["mul_plain"] + cost["add"]) + cost["save"]
+    if params["evaluation_mode"] == "paterson_stockmeyer":
+        per_group += ps_parameters(m)[1] * cost["mul"]
+    server = batches * (params["query_ciphertexts"] * cost["load"] + params["power_multiplications"] * cost["mul"])
+    server += answers * per_group
+    client = batches * params["query_ciphertexts"] * cost["encrypt"] + answers * cost["decrypt"]
+
+    # Запрос - симметричные шифротексты (один полином и seed), ответ - два полинома на меньшем модуле
+    query_bytes = batches * params["query_ciphertexts"] * degree * sum(data_modulus_bits(degree)) / 8
+    answer_bytes = answers * 2 * degree * answer_modulus_bits(degree, modulus) / 8
+    query_bytes *= cost["overhead"]
+    answer_bytes *= cost["overhead"]
+
+    server, client = server / 1000, client / 1000
+    return {
+        "server": server,
+        "client": client,
+        "query_bytes": int(query_bytes),
+        "answer_bytes": int(answer_bytes),
+        "latency": server_weight * server + client_weight * client + (query_bytes + answer_bytes) / bandwidth,
+    }
+
+
+def tune(sender_total: int, receiver_total: int, security_bits: int = 30, costs: dict = None, refine_top: int = 50,
+         **options) -> list:
+    """
+    Подбирает параметры протокола под размеры множеств и модель стоимости.
+    Все наборы ранжируются по оценке с нижней границей числа умножений, затем refine_top
+    лучших уточняются планом plan_powers и ранжируются заново.
+    :param costs: время операций (по умолчанию REFERENCE_COSTS)
+    :param refine_top: количество уточняемых наборов
+    :param options: max_load, noise_margin - для candidates; bandwidth, server_weight, client_weight - для estimate
+    :return: список (params, estimate), отсортированный по оценке задержки
+    """
+    costs = REFERENCE_COSTS if costs is None else costs
+    candidate_options = {key: options.pop(key) for key in ("max_load", "noise_margin") if key in options}
+    ranked = [
+        (params, estimate(params, costs, **options))
+        for params in candidates(sender_total, receiver_total, security_bits, **candidate_options)
+        if params["poly_modulus_degree"] in costs
+    ]
+    ranked.sort(key=lambda item: item[1]["latency"])
+    refined = [(params, estimate(params, costs, **options))
+               for params in (refine(params) for params, _ in ranked[:refine_top])]
+    refined.sort(key=lambda item: item[1]["latency"])
+    return refined + ranked[refine_top:]
+
+
+# Ключи config.yaml, которые задает подбор
+CONFIG_KEYS = ("sender_size", "sender_max_shards", "receiver_size", "receiver_max_batches", "output_bits",
+               "bin_security_bits", "poly_modulus_degree", "alpha", "ell", "evaluation_mode", "slot_packing")
+
+
+def render_config(params: dict, template_path: str) -> str:
+    """
+    Подставляет подобранные параметры в текст config.yaml, сохраняя остальные строки и комментарии.
+    """
+    with open(template_path, "r") as f:
+        text = f.read()
+    for key in CONFIG_KEYS:
+        value = params[key]
+        value = str(value).lower() if isinstance(value, bool) else value
+        text, count = re.subn(rf"^{key}:.*$", f"{key}: {value}", text, flags=re.MULTILINE)
+        if not count:
+            text += f"\n{key}: {value}\n"
+    return text
+
+
+def _format_row(params, result):
+    return (f"{params['poly_modulus_degree']:>6} {params['output_bits']:>3} {params['alpha']:>5} "
+            f"{params['minibin_capacity']:>4} {params['ell']:>3} {params['evaluation_mode'][:5]:>6} "
+            f"{params['shards']:>6} {params['batches']:>4} {params['depth']:>3} "
+            f"{params['noise_budget']:>7.1f} {result['server']:>8.3f} {result['client']:>8.3f} "
+            f"{(result['query_bytes'] + result['answer_bytes']) / 2 ** 20:>9.2f} {result['latency']:>8.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Подбор параметров протокола PSI под размеры множеств")
+    parser.add_argument("--sender-size", type=int, required=True, help="размер множества отправителя")
+    parser.add_argument("--receiver-size", type=int, required=True, help="размер множества получателя")
+    parser.add_argument("--security-bits", type=int, default=30, help="уровень безопасности для bin_capacity")
+    parser.add_argument("--bandwidth", type=float, default=12.5e6, help="пропускная способность, байт/с")
+    parser.add_argument("--server-weight", type=float, default=1, help="вес времени сервера")
+    parser.add_argument("--client-weight", type=float, default=1, help="вес времени клиента")
+    parser.add_argument("--max-load", type=float, default=0.4, help="заполнение таблицы кукушки")
+    parser.add_argument("--noise-margin", type=float, default=10, help="запас бюджета шума, бит")
+    parser.add_argument("--benchmark", action="store_true", help="измерить время операций на этой машине")
+    parser.add_argument("--top", type=int, default=10, help="количество выводимых вариантов")
+    parser.add_argument("--output", help="записать config.yaml с лучшими параметрами")
+    args = parser.parse_args(argv)
+
+    costs = calibrate() if args.benchmark else REFERENCE_COSTS
+    ranked = tune(args.sender_size, args.receiver_size, args.security_bits, costs,
+                  max_load=args.max_load, noise_margin=args.noise_margin, bandwidth=args.bandwidth,
+                  server_weight=args.server_weight, client_weight=args.client_weight)
+    if not ranked:
+        parser.error("нет корректных наборов параметров для заданных размеров")
+
+    print("   pmd  ob alpha    m ell   mode shards  bat dep  budget server,s client,s  traffic,MB  total,s")
+    for params, result in ranked[:args.top]:
+        print(_format_row(params, result))
+
+    best = ranked[0][0]
+    template = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml")
+    text = render_config(best, template)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        print(f"Конфигурация записана в {args.output}")
+    else:
+        print("\n".join(line for line in text.splitlines() if line.split(":")[0] in CONFIG_KEYS))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,9 @@
-from hashing import bin_capacity
-from math import log2
+from functools import lru_cache
+from math import isqrt
 import numpy as np
-from config import ell, alpha, plain_modulus
+from config import ell, plain_modulus, evaluation_mode, ps_low_degree
 
 base = 2 ** ell
-minibin_capacity = bin_capacity // alpha
-logB_ell = int(log2(minibin_capacity) / ell) + 1
 t = plain_modulus
 
 def int2base(number, base_value):
@@ -54,25 +52,235 @@ def power_reconstruct(window, exponent):
     return low_depth_multiplication(needed_powers)
 
 
-def windowing(y, bound, modulus):
+def window_exponents(bound, base_value=None):
     """
-    Создание матрицы степеней y для оконного метода
+    Показатели степеней y, которые клиент отправляет в оконном методе: (i + 1) * base^j <= bound
     """
-    windowed_y = [[None for j in range(logB_ell)] for i in range(base - 1)]
-    for j in range(logB_ell):
-        for i in range(base - 1):
-            if (i + 1) * base ** j - 1 < bound:
-                windowed_y[i][j] = pow(y, (i + 1) * base ** j, modulus)
-    return windowed_y
+    base_value = base if base_value is None else base_value
+    exponents = []
+    j = 0
+    while base_value ** j <= bound:
+        exponents += [(i + 1) * base_value ** j for i in range(base_value - 1)
+                      if (i + 1) * base_value ** j <= bound]
+        j += 1
+    return sorted(exponents)
+
+
+def ps_parameters(degree, low_degree=None):
+    """
+    Параметры схемы Патерсона-Стокмейера для полинома степени degree:
+    p(y) = sum_g y^(g*L) * q_g(y), где deg q_g < L.
+    :return: (L - число шагов "малыми" степенями, G - старший номер "гигантского" шага)
+    """
+    low_degree = ps_low_degree if low_degree is None else low_degree
+    low = low_degree or max(2, isqrt(degree) + (isqrt(degree) ** 2 < degree))
+    return low, degree // low
+
+
+def query_exponents(degree, mode=None, base_value=None):
+    """
+    Показатели степеней y, которые клиент шифрует и отправляет в запросе.
+    naive: оконные степени до degree;
+    paterson_stockmeyer: оконные степени до L - 1 и те оконные степени y^L до G, которые сервер
+    не может получить из остальных, не увеличив глубину плана степеней.
+    :param base_value: основание оконного метода (по умолчанию 2 ** ell)
+    """
+    mode = evaluation_mode if mode is None else mode
+    base_value = base if base_value is None else base_value
+    if mode == "naive":
+        return window_exponents(degree, base_value)
+    if mode == "paterson_stockmeyer":
+        low, giant = ps_parameters(degree)
+        return list(_ps_query_exponents(degree, low, giant, base_value))
+    raise ValueError(f'Неизвестный режим вычисления полиномов: {mode}')
+
+
+@lru_cache(maxsize=64)
+def _ps_query_exponents(degree, low, giant, base_value):
+    """
+    Показатели степеней запроса для paterson_stockmeyer: из оконных степеней y^L, начиная со старшей,
+    исключаются те, без которых максимальная глубина плана plan_powers не растет.
+    """
+    low_exponents = set(window_exponents(low - 1, base_value))
+    exponents = low_exponents | {low * e for e in window_exponents(giant, base_value)}
+    targets = tuple(power_targets(degree, "paterson_stockmeyer"))
+
+    def plan_depth(sources):
+        _, depths = plan_powers(tuple(sorted(sources)), targets)
+        return max(depths[k] for k in targets)
+
+    depth = plan_depth(exponents)
+    for exponent in sorted(exponents - low_exponents, reverse=True):
+        if plan_depth(exponents - {exponent}) <= depth:
+            exponents = exponents - {exponent}
+    return tuple(sorted(exponents))
+
+
+def power_targets(degree, mode=None):
+    """
+    Показатели степеней y, которые сервер должен получить для вычисления полиномов
+    """
+    mode = evaluation_mode if mode is None else mode
+    if mode == "paterson_stockmeyer":
+        low, giant = ps_parameters(degree)
+        return sorted(set(range(1, min(low - 1, degree) + 1)) | {low * g for g in range(1, giant + 1)})
+    return list(range(1, degree + 1))
+
+
+@lru_cache(maxsize=64)
+def plan_powers(sources, targets):
+    """
+    Планирование вычисления степеней y по имеющимся степеням одним графом умножений.
+
+    Каждая степень получается с минимально возможной мультипликативной глубиной; среди
+    разложений одинаковой глубины выбираются те, что переиспользуют уже нужные промежуточные
+    степени, чтобы сократить число умножений шифротекстов. Результат кешируется по параметрам.
+    :param sources: кортеж показателей доступных степеней
+    :param targets: кортеж показателей требуемых степеней
+    :return: (шаги (k, a, b) в порядке выполнения, где y^k = y^a * y^b; глубины степеней)
+    """
+    sources = set(sources)
+    top = max(targets)
+    inf = float('inf')
+
+    # Минимальная глубина для каждой степени до top
+    depth = [inf] * (top + 1)
+    for exponent in sources:
+        if exponent <= top:
+            depth[exponent] = 0
+    for k in range(2, top + 1):
+        if k not in sources:
+            depth[k] = min((max(depth[a], depth[k - a]) + 1 for a in range(1, k // 2 + 1)), default=inf)
+
+    unreachable = [k for k in targets if depth[k] == inf]
+    if unreachable:
+        raise ValueError(f'Степени {unreachable} невозможно получить из {sorted(sources)}')
+
+    def candidates(k):
+        return [(a, k - a) for a in range(1, k // 2 + 1)
+                if max(depth[a], depth[k - a]) + 1 == depth[k]]
+
+    # Выбор разложений: сначала произвольное минимальной глубины, затем уточнение с переиспользованием
+    target_set = set(targets)
+    split = {}
+    needed = set()
+    for _ in range(4):
+        previous = dict(split)
+        consumers = {}
+        for k in needed - sources:
+            for x in set(split[k]):
+                consumers.setdefault(x, set()).add(k)
+
+        def reused(x, k):
+            return x in sources or x in target_set or bool(consumers.get(x, set()) - {k})
+
+        stack = sorted(target_set, reverse=True)
+        closure = set()
+        while stack:
+            k = stack.pop()
+            if k in closure:
+                continue
+            closure.add(k)
+            if k in sources:
+                continue
+            split[k] = max(candidates(k), key=lambda pair: (sum(reused(x, k) for x in pair), pair[0]))
+            stack.extend(x for x in split[k] if x not in closure)
+        needed = closure
+        if split == previous:
+            break
+
+    steps = [(k, a, b) for k, (a, b) in sorted(split.items()) if k in needed]
+    return steps, {k: depth[k] for k in needed}
+
+
+def compute_powers(available, targets, multiply=None):
+    """
+    Вычисление требуемых степеней по плану plan_powers с запоминанием промежуточных результатов
+    :param available: словарь {показатель: зашифрованная степень}
+    :param targets: требуемые показатели
+    :param multiply: функция умножения двух степеней (по умолчанию оператор *)
+    :return: словарь {показатель: зашифрованная степень}, включающий все targets
+    """
+    steps, _ = plan_powers(tuple(sorted(available)), tuple(sorted(set(targets))))
+    powers = dict(available)
+    for k, a, b in steps:
+        powers[k] = multiply(powers[a], powers[b]) if multiply else powers[a] * powers[b]
+    return powers
+
+
+def mul_mod(a, b, modulus):
+    """
+    Поэлементное произведение a * b по модулю без переполнения uint64.
+    Аргументы должны быть уже приведены по модулю modulus.
+    """
+    a = np.asarray(a, dtype=np.uint64)
+    b = np.asarray(b, dtype=np.uint64)
+    if modulus <= 2 ** 32:
+        return (a * b) % np.uint64(modulus)
+    if modulus < 2 ** 47:
+        # Умножение на b по 16-битным частям, начиная со старшей
+        result = np.zeros(np.broadcast_shapes(a.shape, b.shape), dtype=np.uint64)
+        for shift in (48, 32, 16, 0):
+            limb = (b >> np.uint64(shift)) & np.uint64(0xFFFF)
+            result = ((result << np.uint64(16)) + a * limb) % np.uint64(modulus)
+        return result
+    return ((a.astype(object) * b.astype(object)) % modulus).astype(np.uint64)
+
+
+def pow_mod_batch(values, exponents, modulus):
+    """
+    Возведение всех значений в каждую из степеней exponents по модулю за один проход:
+    бинарное возведение сразу по всему массиву, квадраты values^(2^k) общие для всех показателей.
+    :param values: массив неотрицательных чисел (например, ячейки таблицы кукушки)
+    :param exponents: показатели степеней
+    :param modulus: модуль арифметики
+    :return: массив np.uint64 формы (len(exponents), len(values)), строка - одна степень
+    """
+    values = np.asarray(values, dtype=np.uint64) % np.uint64(modulus)
+    squares = [values]
+    for _ in range(1, max(exponents).bit_length()):
+        squares.append(mul_mod(squares[-1], squares[-1], modulus))
+
+    result = np.empty((len(exponents), values.size), dtype=np.uint64)
+    for row, exponent in enumerate(exponents):
+        power = None
+        for k in range(exponent.bit_length()):
+            if exponent >> k & 1:
+                power = squares[k] if power is None else mul_mod(power, squares[k], modulus)
+        result[row] = 1 if power is None else power
+    return result
+
+
+def coeffs_dtype(modulus):
+    """
+    Наименьший тип NumPy для хранения вычетов по модулю modulus
+    """
+    return np.uint32 if modulus <= 2 ** 32 else np.int64
+
+
+def coeffs_from_roots_batch(roots, modulus):
+    """
+    Вычисление коэффициентов полиномов по корням для целого тензора миникорзин.
+    :param roots: массив формы (..., degree) с корнями в последней оси
+    :param modulus: модуль арифметики
+    :return: массив int64 формы (..., degree + 1), коэффициенты от старшей степени к младшей
+    """
+    roots = (np.asarray(roots) % modulus).astype(np.uint64)
+    degree = roots.shape[-1]
+    coefficients = np.zeros(roots.shape[:-1] + (degree + 1,), dtype=np.uint64)
+    coefficients[..., 0] = 1
+    # Домножение на (x - root) сразу для всех миникорзин
+    for k in range(degree):
+        product = mul_mod(coefficients[..., :k + 1], roots[..., k:k + 1], modulus)
+        coefficients[..., 1:k + 2] = (coefficients[..., 1:k + 2] + (modulus - product)) % np.uint64(modulus)
+    return coefficients.astype(np.int64)
+
 
 def coeffs_from_roots(roots, modulus):
     """
     Вычисление коэффициентов полинома по его корням
     """
-    coefficients = np.array(1, dtype=np.int64)
-    for root in roots:
-        coefficients = np.convolve(coefficients, [1, -root]) % modulus
-    return coefficients
+    return coeffs_from_roots_batch(np.asarray(roots)[None, :], modulus)[0]
 
 
 def decompose_to_base(n, base_value):
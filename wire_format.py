@@ -0,0 +1,324 @@
+import hashlib
+import struct
+import zlib
+
+from config import poly_modulus_degree, plain_modulus, output_bits, alpha, evaluation_mode, slot_segments, \
+    wire_compression
+
+# Формат сообщений (все числа little-endian):
+#   заголовок _HEADER: магическая строка, версия, тип сообщения, режим вычисления, output_bits,
+#                      poly_modulus_degree, plain_modulus, alpha, minibin_capacity,
+#                      количество сегментов слотов, количество пакетов (таблиц кукушки), количество блоков
+#   запрос:  показатели степеней (uint32 на каждый шифротекст пакета), отпечаток публичного
+#            контекста (SHA-256), затем блок контекста (пустой, если сервер знает контекст
+#            по отпечатку) и блоки шифротекстов пакетов подряд
+#   ответ:   блоки шифротекстов пакетов подряд (ceil(alpha / сегменты) на шард пакета)
+#   блок:    uint32 длина + байты
+# Сжатое сообщение: магическая строка MAGIC_COMPRESSED, затем поток zlib исходного сообщения
+MAGIC = b"PSI"
+MAGIC_COMPRESSED = b"PSZ"
+VERSION = 4
+QUERY = 1
+ANSWER = 2
+
+_HEADER = struct.Struct("<3sBBBBIQHHHHI")
+_LENGTH = struct.Struct("<I")
+FINGERPRINT_SIZE = 32
+
+# Ограничение на количество блоков в сообщении из недоверенной сети
+MAX_BLOCKS = 1 << 16
+# Ограничение на размер распакованного сообщения
+MAX_MESSAGE_SIZE = 1 << 30
+
+_MODES = {"naive": 0, "paterson_stockmeyer": 1}
+_MODE_NAMES = {code: name for name, code in _MODES.items()}
+
+
+def protocol_params(minibin_capacity: int) -> dict:
+    """
+    Параметры протокола текущей конфигурации, передаваемые в заголовке сообщений.
+    :param minibin_capacity: емкость миникорзины (степень полиномов)
+    """
+    return {
+        "poly_modulus_degree": poly_modulus_degree,
+        "plain_modulus": plain_modulus,
+        "output_bits": output_bits,
+        "alpha": alpha,
+        "minibin_capacity": minibin_capacity,
+        "evaluation_mode": evaluation_mode,
+        "slot_segments": slot_segments,
+    }
+
+
+def context_fingerprint(public_ctx) -> bytes:
+    """
+    Отпечаток сериализованного публичного контекста (SHA-256), по которому сервер кеширует контекст.
+    """
+    return hashlib.sha256(public_ctx).digest()
+
+
+def check_params(received: dict, expected: dict):
+    """
+    Проверяет совпадение параметров из заголовка с ожидаемыми.
+    :raises ValueError: при несовпадении
+    """
+    mismatched = {key: (received[key], value) for key, value in expected.items() if received[key] != value}
+    if mismatched:
+        raise ValueError(f"Параметры сообщения не совпадают с конфигурацией (получено, ожидалось): {mismatched}")
+
+
+def _header(msg_type, params, batches, count):
+    return _HEADER.pack(
+        MAGIC, VERSION, msg_type, _MODES[params["evaluation_mode"]], params["output_bits"],
+        params["poly_modulus_degree"], params["plain_modulus"], params["alpha"],
+        params["minibin_capacity"], params["slot_segments"], batches, count,
+    )
+
+
+def _encode(msg_type, params, batches, blocks, prefix=b""):
+    parts = [_header(msg_type, params, batches, len(blocks)), prefix]
+    for block in blocks:
+        parts.append(_LENGTH.pack(len(block)))
+        parts.append(block)
+    return _compress(b"".join(parts))
+
+
+def _compress(message: bytes, level: int = None) -> bytes:
+    """Сжимает сообщение zlib, если задан уровень сжатия (wire_compression)"""
+    level = wire_compression if level is None else level
+    if not level:
+        return message
+    return MAGIC_COMPRESSED + zlib.compress(message, level)
+
+
+def _decompress(data):
+    """Распаковывает сжатое сообщение; несжатое возвращается без изменений"""
+    if bytes(data[:len(MAGIC_COMPRESSED)]) != MAGIC_COMPRESSED:
+        return data
+    decompressor = zlib.decompressobj()
+    try:
+        message = decompressor.decompress(memoryview(data)[len(MAGIC_COMPRESSED):], MAX_MESSAGE_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"Некорректное сообщение: ошибка распаковки ({e})") from e
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("Некорректное сообщение: сжатые данные обрезаны или слишком велики")
+    return message
+
+
+def _decode_header(view, msg_type):
+    if len(view) < _HEADER.size:
+        raise ValueError("Некорректное сообщение: слишком короткий заголовок")
+    magic, version, received_type, mode, bits, degree, modulus, alpha_value, capacity, segments, batches, count = \
+        _HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Некорректное сообщение: неизвестный формат {bytes(magic)!r} версии {version}")
+    if received_type != msg_type:
+        raise ValueError(f"Некорректное сообщение: ожидался тип {msg_type}, получен {received_type}")
+    if mode not in _MODE_NAMES or count > MAX_BLOCKS or batches < 1 or segments < 1:
+        raise ValueError("Некорректное сообщение: недопустимые значения заголовка")
+    params = {
+        "poly_modulus_degree": degree,
+        "plain_modulus": modulus,
+        "output_bits": bits,
+        "alpha": alpha_value,
+        "minibin_capacity": capacity,
+        "evaluation_mode": _MODE_NAMES[mode],
+        "slot_segments": segments,
+    }
+    return params, batches, count, _HEADER.size
+
+
+def _decode_blocks(view, offset, count):
+    """Разбирает блоки без копирования: возвращает срезы memoryview"""
+    blocks = []
+    for _ in range(count):
+        if offset + _LENGTH.size > len(view):
+            raise ValueError("Некорректное сообщение: обрезанный блок")
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("Некорректное сообщение: обрезанный блок")
+        blocks.append(view[offset:offset + length])
+        offset += length
+    if offset != len(view):
+        raise ValueError("Некорректное сообщение: лишние данные в конце")
+    return blocks
+
+
+def _split_batches(blocks, batches):
+    if len(blocks) % batches:
+        raise ValueError("Некорректное сообщение: количество шифротекстов не делится на количество пакетов")
+    size = len(blocks) // batches
+    return [blocks[i * size:(i + 1) * size] for i in range(batches)]
+
+
+def encode_query(params: dict, exponents, fingerprint: bytes, context, batches) -> bytes:
+    """
+    Кодирует запрос клиента.
+    :param params: параметры протокола (protocol_params)
+    :param exponents: показатели степеней y для шифротекстов каждого пакета
+    :param fingerprint: отпечаток публичного контекста
+    :param context: сериализованный публичный контекст или None, если сервер знает его по отпечатку
+    :param batches: для каждого пакета (таблицы кукушки) - сериализованные шифротексты степеней
+    """
+    if len(fingerprint) != FINGERPRINT_SIZE:
+        raise ValueError(f"Отпечаток контекста должен занимать {FINGERPRINT_SIZE} байта")
+    prefix = struct.pack(f"<{len(exponents)}I", *exponents) + bytes(fingerprint)
+    blocks = [context or b""] + [ct for batch in batches for ct in batch]
+    return _encode(QUERY, params, len(batches), blocks, prefix)
+
+
+def decode_query(data) -> dict:
+    """
+    Разбирает запрос клиента. Контекст и шифротексты возвращаются как memoryview без копирования.
+    :return: {"params", "exponents", "fingerprint", "context", "batches"}, batches - списки
+             шифротекстов пакетов, context - None, если передан только отпечаток
+    """
+    view = memoryview(_decompress(data))
+    params, batches, count, offset = _decode_header(view, QUERY)
+    if count < 1 or (count - 1) % batches:
+        raise ValueError("Некорректное сообщение: количество шифротекстов не соответствует пакетам")
+    exponents_count = (count - 1) // batches
+    exponents_size = 4 * exponents_count
+    if offset + exponents_size + FINGERPRINT_SIZE > len(view):
+        raise ValueError("Некорректное сообщение: обрезанный список степеней")
+    exponents = list(struct.unpack_from(f"<{exponents_count}I", view, offset))
+    offset += exponents_size
+    fingerprint = bytes(view[offset:offset + FINGERPRINT_SIZE])
+    blocks = _decode_blocks(view, offset + FINGERPRINT_SIZE, count)
+    return {"params": params, "exponents": exponents, "fingerprint": fingerprint,
+            "context": blocks[0] if len(blocks[0]) else None,
+            "batches": _split_batches(blocks[1:], batches)}
+
+
+def encode_answer(params: dict, batches) -> bytes:
+    """
+    Кодирует ответ сервера.
+    :param params: параметры протокола (protocol_params)
+    :param batches: для каждого пакета - сериализованные шифротексты ответов блоков
+    """
+    return _encode(ANSWER, params, len(batches), [ct for batch in batches for ct in batch])
+
+
+def decode_answer(data) -> dict:
+    """
+    Разбирает ответ сервера. Шифротексты возвращаются как memoryview без копирования.
+    :return: {"params", "batches"}, batches - списки шифротекстов пакетов
+    """
+    view = memoryview(_decompress(data))
+    params, batches, count, offset = _decode_header(view, ANSWER)
+    return {"params": params, "batches": _split_batches(_decode_blocks(view, offset, count), batches)}
+
+
+def iter_answer(params: dict, batches: int, count: int, blocks):
+    """
+    Кодирует ответ сервера по частям: заголовок, затем каждый блок, как только он готов.
+    Склеенные части разбираются decode_answer так же, как результат encode_answer.
+    :param params: параметры протокола (protocol_params)
+    :param batches: количество пакетов
+    :param count: общее количество блоков во всех пакетах
+    :param blocks: итератор сериализованных шифротекстов пакетов подряд
+    :return: генератор частей сообщения
+    """
+    # Сжатие сбрасывается после каждого блока, чтобы блок не задерживался в буфере zlib
+    compressor = zlib.compressobj(wire_compression) if wire_compression else None
+
+    def emit(data):
+        if compressor is None:
+            return data
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    if compressor is not None:
+        yield MAGIC_COMPRESSED
+    yield emit(_header(ANSWER, params, batches, count))
+    produced = 0
+    for block in blocks:
+        produced += 1
+        yield emit(_LENGTH.pack(len(block)) + bytes(block))
+    if produced != count:
+        raise RuntimeError(f"Ответ содержит {produced} блоков вместо {count}")
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class AnswerReader:
+    """
+    Потоковый разбор ответа сервера: шифротексты возвращаются по мере поступления данных,
+    не дожидаясь конца сообщения. Параметры и количество пакетов доступны после заголовка.
+    """
+
+    def __init__(self):
+        self.params = None
+        self.batches = None
+        self.count = None
+        self.received = 0
+        self._buffer = bytearray()
+        self._started = False
+        self._decompressor = None
+        self._size = 0
+
+    def feed(self, chunk) -> list:
+        """
+        Добавляет очередную часть сообщения.
+        :return: список готовых блоков (номер пакета, номер блока в пакете, байты шифротекста)
+        :raises ValueError: при некорректных данных
+        """
+        data = bytes(chunk)
+        if not self._started:
+            self._buffer += data
+            if len(self._buffer) < len(MAGIC_COMPRESSED):
+                return []
+            self._started = True
+            data = bytes(self._buffer)
+            self._buffer = bytearray()
+            if data.startswith(MAGIC_COMPRESSED):
+                self._decompressor = zlib.decompressobj()
+                data = data[len(MAGIC_COMPRESSED):]
+
+        if self._decompressor is not None:
+            try:
+                data = self._decompressor.decompress(data, MAX_MESSAGE_SIZE - self._size + 1)
+            except zlib.error as e:
+                raise ValueError(f"Некорректное сообщение: ошибка распаковки ({e})") from e
+            if self._decompressor.unconsumed_tail:
+                raise ValueError("Некорректное сообщение: слишком большой размер")
+        self._size += len(data)
+        if self._size > MAX_MESSAGE_SIZE:
+            raise ValueError("Некорректное сообщение: слишком большой размер")
+        self._buffer += data
+        return self._parse()
+
+    def _parse(self):
+        buffer = self._buffer
+        offset = 0
+        if self.params is None:
+            if len(buffer) < _HEADER.size:
+                return []
+            self.params, self.batches, self.count, offset = _decode_header(bytes(buffer[:_HEADER.size]), ANSWER)
+            if self.count % self.batches:
+                raise ValueError("Некорректное сообщение: количество шифротекстов не делится на количество пакетов")
+
+        blocks = []
+        per_batch = self.count // self.batches
+        while self.received < self.count and len(buffer) - offset >= _LENGTH.size:
+            (length,) = _LENGTH.unpack_from(buffer, offset)
+            if len(buffer) - offset - _LENGTH.size < length:
+                break
+            start = offset + _LENGTH.size
+            blocks.append((self.received // per_batch, self.received % per_batch, bytes(buffer[start:start + length])))
+            offset = start + length
+            self.received += 1
+        del buffer[:offset]
+        if self.received == self.count and buffer:
+            raise ValueError("Некорректное сообщение: лишние данные в конце")
+        return blocks
+
+    def finish(self):
+        """
+        Проверяет, что сообщение получено полностью.
+        :raises ValueError: если сообщение обрезано
+        """
+        if self._decompressor is not None and not self._decompressor.eof:
+            raise ValueError("Некорректное сообщение: сжатые данные обрезаны")
+        if self.params is None or self.received != self.count or self._buffer:
+            raise ValueError("Некорректное сообщение: обрезанный ответ")